@@ -0,0 +1,196 @@
+from functools import lru_cache
+import re
+from django.db import transaction
+from django.db.models import F, Q
+from apps.aws.bulk import BATCH_SIZE, chunked
+from apps.aws.policies import PREFIX_LENGTH, flatten_policy, policy_hash
+from apps.aws.models.aws_models import (
+    IAMPermission,
+    IAMPolicy,
+    IAMInlinePolicy,
+    IAMRole,
+)
+
+# Policy models whose statements are flattened, by IAMPermission foreign key
+POLICY_SOURCES = {
+    "policy": IAMPolicy,
+    "inline_policy": IAMInlinePolicy,
+}
+
+
+def refresh_permissions(policy_ids=None, inline_policy_ids=None, batch_size=BATCH_SIZE):
+    """
+    Re-derives the IAMPermission rows of the managed and inline policies whose
+    document changed since their rows were built, comparing document hashes.
+    Writes pass the policies they changed; without any, as after a sync, every
+    policy is compared. Rows of deleted policies go with them through the foreign
+    keys.
+    :param policy_ids: Optional pks of the IAMPolicy rows changed.
+    :param inline_policy_ids: Optional pks of the IAMInlinePolicy rows changed.
+    :return: The number of policies whose rows were rebuilt.
+    """
+    changed = {"policy": policy_ids, "inline_policy": inline_policy_ids}
+    targeted = policy_ids is not None or inline_policy_ids is not None
+    refreshed = 0
+    for field, model in POLICY_SOURCES.items():
+        policies = model.objects.all()
+        if targeted:
+            policies = policies.filter(pk__in=list(changed[field] or []))
+        stale = list(
+            policies.filter(
+                Q(document_hash="") | ~Q(permissions_hash=F("document_hash"))
+            ).values_list("pk", flat=True)
+        )
+
+        for batch in chunked(stale, batch_size):
+            rows, derived, unhashed = [], [], []
+            for policy in model.objects.filter(pk__in=batch).only(
+                "policy_document", "document_hash"
+            ):
+                document_hash = policy_hash(policy.policy_document)
+                if not policy.document_hash:
+                    unhashed.append((policy.pk, document_hash))
+                # Recorded even for a document without statements, which derives
+                # no rows
+                policy.permissions_hash = document_hash
+                derived.append(policy)
+                rows.extend(
+                    IAMPermission(
+                        **{f"{field}_id": policy.pk},
+                        document_hash=document_hash,
+                        **statement,
+                    )
+                    for statement in flatten_policy(policy.policy_document)
+                )
+            with transaction.atomic():
+                IAMPermission.objects.filter(**{f"{field}_id__in": batch}).delete()
+                IAMPermission.objects.bulk_create(rows, batch_size=batch_size)
+                model.objects.bulk_update(
+                    derived, ["permissions_hash"], batch_size=batch_size
+                )
+                # Rows written before document hashes were stored
+                for pk, document_hash in unhashed:
+                    model.objects.filter(pk=pk, document_hash="").update(
+                        document_hash=document_hash
+                    )
+            refreshed += len(batch)
+    return refreshed
+
+
+def prefixes(value):
+    value = value[:PREFIX_LENGTH]
+    return [value[:length] for length in range(len(value) + 1)]
+
+
+@lru_cache(maxsize=4096)
+def pattern_regex(pattern, ignore_case):
+    return re.compile(
+        re.escape(pattern).replace(r"\*", ".*").replace(r"\?", "."),
+        re.IGNORECASE if ignore_case else 0,
+    )
+
+
+def pattern_matches(pattern, value, ignore_case=False):
+    return pattern_regex(pattern, ignore_case).fullmatch(value) is not None
+
+
+def matching_statements(action, resource):
+    """
+    Finds the live policy statements applying to an action on a resource,
+    resolving wildcards in their action and resource patterns.
+    A pattern can only match a value that starts with its literal prefix, so the
+    candidates are the rows whose prefixes are prefixes of the action and the
+    resource, found through the prefix indexes; they are then matched exactly.
+    NotAction rows hold the actions excluded, so they are found by a second
+    query on the not_action index and the two results are combined.
+    Conditions, permission boundaries and organization policies are not evaluated.
+    :param action: An IAM action, e.g. "s3:PutObject".
+    :param resource: A resource ARN, e.g. "arn:aws:s3:::bucket/key".
+    :return: A list of (effect, source field, policy id) tuples, one per statement.
+    """
+    action = action.lower()
+    live = Q(policy__isnull=False, policy__deleted_at__isnull=True) | Q(
+        inline_policy__isnull=False, inline_policy__deleted_at__isnull=True
+    )
+    candidates = IAMPermission.objects.filter(
+        live, Q(resource_prefix__in=prefixes(resource)) | Q(not_resource=True)
+    )
+    fields = (
+        "policy_id",
+        "inline_policy_id",
+        "statement_index",
+        "effect",
+        "action",
+        "not_action",
+        "resource",
+        "not_resource",
+    )
+    # An OR across the two would leave the database scanning every row
+    rows = (
+        candidates.filter(action_prefix__in=prefixes(action))
+        .values_list(*fields)
+        .union(candidates.filter(not_action=True).values_list(*fields))
+    )
+
+    statements = {}
+    for policy_id, inline_policy_id, index, effect, *patterns in rows:
+        statement = statements.setdefault(
+            (policy_id, inline_policy_id, index),
+            {"effect": effect, "actions": set(), "resources": set()},
+        )
+        action_pattern, not_action, resource_pattern, not_resource = patterns
+        statement["actions"].add(action_pattern)
+        statement["not_action"] = not_action
+        statement["resources"].add(resource_pattern)
+        statement["not_resource"] = not_resource
+
+    matched = []
+    for (policy_id, inline_policy_id, _), statement in statements.items():
+        action_matched = any(
+            pattern_matches(pattern, action, ignore_case=True)
+            for pattern in statement["actions"]
+        )
+        resource_matched = any(
+            pattern_matches(pattern, resource) for pattern in statement["resources"]
+        )
+        if action_matched == statement["not_action"]:
+            continue
+        if resource_matched == statement["not_resource"]:
+            continue
+        source = (
+            ("policy", policy_id) if policy_id else ("inline_policy", inline_policy_id)
+        )
+        matched.append((statement["effect"], *source))
+    return matched
+
+
+def roles_allowed(action, resource):
+    """
+    Answers which roles can call an action on a resource: roles with a policy
+    statement allowing it and none denying it.
+    :param action: An IAM action, e.g. "s3:PutObject".
+    :param resource: A resource ARN, e.g. "arn:aws:s3:::bucket/key".
+    :return: A queryset of the live IAMRole rows allowed.
+    """
+    role_ids = {"Allow": set(), "Deny": set()}
+    sources = {"Allow": {}, "Deny": {}}
+    for effect, field, pk in matching_statements(action, resource):
+        sources[effect].setdefault(field, set()).add(pk)
+
+    for effect, effect_sources in sources.items():
+        if effect_sources.get("inline_policy"):
+            role_ids[effect].update(
+                IAMInlinePolicy.objects.filter(
+                    pk__in=effect_sources["inline_policy"]
+                ).values_list("role_id", flat=True)
+            )
+        if effect_sources.get("policy"):
+            role_ids[effect].update(
+                IAMRole.policies.through.objects.filter(
+                    iampolicy_id__in=effect_sources["policy"]
+                ).values_list("iamrole_id", flat=True)
+            )
+
+    return IAMRole.objects.filter(
+        pk__in=role_ids["Allow"] - role_ids["Deny"], deleted_at__isnull=True
+    )
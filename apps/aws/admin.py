@@ -1,7 +1,9 @@
 from django.contrib import admin
 from apps.aws.models.aws_models import (
+    InventorySync,
     EC2Instance,
     S3Bucket,
+    S3BucketLocation,
     IAMRole,
     IAMPolicy,
     IAMInlinePolicy,
@@ -51,8 +53,10 @@ class ApplicationPermissionAdmin(admin.ModelAdmin):
 # AWS models from aws_models.py
 
 # Register your models here
+admin.site.register(InventorySync)
 admin.site.register(EC2Instance)
 admin.site.register(S3Bucket)
+admin.site.register(S3BucketLocation)
 admin.site.register(IAMRole)
 admin.site.register(IAMPolicy)
 admin.site.register(IAMInlinePolicy)
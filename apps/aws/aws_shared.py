@@ -1,194 +1,622 @@
-from datetime import datetime
-import boto3
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from functools import partial
+import threading
+from django.db import connections
+from django.utils import timezone
+from apps.aws.access import refresh_permissions
+from apps.aws.clients import get_client
+from apps.aws.bulk import bulk_upsert, bulk_set_relations, sweep_unseen
+from apps.aws.pipeline import stream_upsert
+from apps.aws.policies import policy_hash
 from apps.aws.models.aws_models import (
+    InventorySync,
     IAMRole,
     IAMPolicy,
     IAMInlinePolicy,
     EC2Instance,
     S3Bucket,
+    S3BucketLocation,
     LambdaFunction,
     SQSQueue,
 )
 
-
-def populate_iam_roles_and_policies(region_name):
-    # Initialize boto3 IAM client
-    client = boto3.client("iam", region_name=region_name)
-
-    # Get list of all IAM roles
-    roles = client.list_roles()
-
-    for role_data in roles["Roles"]:
-        role, _ = IAMRole.objects.update_or_create(
-            role_name=role_data["RoleName"],
-            defaults={
-                "role_id": role_data["RoleId"],
-                "arn": role_data["Arn"],
-                "create_date": role_data["CreateDate"],
-            },
-        )
-
-        # Fetch and attach managed policies to the role
-        attached_policies = client.list_attached_role_policies(RoleName=role.role_name)
-        for policy in attached_policies["AttachedPolicies"]:
-            policy_details = client.get_policy(PolicyArn=policy["PolicyArn"])
-            policy_version = client.get_policy_version(
-                PolicyArn=policy["PolicyArn"],
-                VersionId=policy_details["Policy"]["DefaultVersionId"],
-            )
-            iam_policy, _ = IAMPolicy.objects.update_or_create(
-                policy_name=policy["PolicyName"],
-                defaults={
-                    "policy_id": policy_details["Policy"]["PolicyId"],
-                    "arn": policy_details["Policy"]["Arn"],
-                    "create_date": policy_details["Policy"]["CreateDate"],
-                    "policy_document": policy_version["PolicyVersion"]["Document"],
-                },
+# Maximum number of concurrent per-item API calls for each service
+SERVICE_CONCURRENCY = {
+    "iam": 8,
+    "s3": 8,
+    "sqs": 8,
+}
+
+# Queue attributes stored on SQSQueue; fetching "All" is slower and larger
+SQS_QUEUE_ATTRIBUTES = [
+    "QueueArn",
+    "CreatedTimestamp",
+    "VisibilityTimeout",
+    "MaximumMessageSize",
+    "MessageRetentionPeriod",
+]
+
+# Populators fetch from AWS concurrently but take turns writing to the database
+DB_WRITE_LOCK = threading.Lock()
+
+
+def paginate(client, operation, result_key, **kwargs):
+    """
+    Yields every item under result_key across all pages of a boto3 operation.
+    :param client: boto3 client exposing the operation.
+    :param operation: Name of the paginated operation, e.g. "list_roles".
+    :param result_key: Key holding the items in each page, e.g. "Roles".
+    """
+    paginator = client.get_paginator(operation)
+    for page in paginator.paginate(**kwargs):
+        yield from page.get(result_key, [])
+
+
+def run_concurrently(func, items, max_workers):
+    """
+    Applies func to every item on a bounded thread pool.
+    Database connections opened by a worker are closed when its task finishes.
+    :return: A list of results in the same order as items.
+    """
+
+    def task(item):
+        try:
+            return func(item)
+        finally:
+            connections.close_all()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(task, items))
+
+
+EMPTY_COUNTS = {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+
+
+def format_counts(counts):
+    return ", ".join(
+        f"{counts[key]} {key}"
+        for key in ("inserted", "updated", "unchanged", "deleted")
+    )
+
+
+def sync_inline_policies(roles, region_name, max_workers=None):
+    """
+    Makes the IAMInlinePolicy rows of the given roles match AWS.
+    Policy names are listed for every role and the policies fetched concurrently;
+    rows are then inserted, updated and deleted in bulk in a single transaction.
+    Roles that no longer exist in AWS are left untouched.
+    :param roles: An iterable of IAMRole rows.
+    :return: A dictionary of inserted, updated, unchanged and deleted counts.
+    """
+    client = get_client("iam", region_name=region_name)
+    max_workers = max_workers or SERVICE_CONCURRENCY["iam"]
+    roles = list(roles)
+
+    def list_policy_names(role):
+        try:
+            return list(
+                paginate(
+                    client, "list_role_policies", "PolicyNames", RoleName=role.role_name
+                )
             )
-            # Only add the policy if it's attached to the current role
-            role.policies.add(iam_policy)
-            print(
-                f"Attached policy: {iam_policy.policy_name} to role: {role.role_name}"
-            )
-
-    print(f"Populated IAM roles and policies for region: {region_name}")
-
-
-def populate_iam_inline_policies(region_name):
-    client = boto3.client("iam", region_name=region_name)
-
-    # Iterate over all roles in the database
-    for role in IAMRole.objects.all():
-        inline_policies = client.list_role_policies(RoleName=role.role_name)
+        except client.exceptions.NoSuchEntityException:
+            return None
 
-        for policy_name in inline_policies["PolicyNames"]:
-            policy = client.get_role_policy(
+    def fetch_policy(item):
+        role, policy_name = item
+        try:
+            return client.get_role_policy(
                 RoleName=role.role_name, PolicyName=policy_name
             )
-            IAMInlinePolicy.objects.update_or_create(
-                role=role,
-                policy_name=policy_name,
-                defaults={"policy_document": policy["PolicyDocument"]},
-            )
-
-    print(f"Populated IAM inline policies for region: {region_name}")
-
-
-def populate_ec2_instances(region_name):
-    client = boto3.client("ec2", region_name=region_name)
+        except client.exceptions.NoSuchEntityException:
+            # The policy was deleted after the names were listed
+            return None
+
+    policy_names = run_concurrently(list_policy_names, roles, max_workers)
+    found = [
+        (role, names) for role, names in zip(roles, policy_names) if names is not None
+    ]
+    items = [(role, policy_name) for role, names in found for policy_name in names]
+    policies = run_concurrently(fetch_policy, items, max_workers)
+
+    rows = [
+        {
+            "role_id": role.pk,
+            "policy_name": policy["PolicyName"],
+            "policy_document": policy["PolicyDocument"],
+            "document_hash": policy_hash(policy["PolicyDocument"]),
+        }
+        for (role, _), policy in zip(items, policies)
+        if policy is not None
+    ]
+    with DB_WRITE_LOCK:
+        counts = bulk_upsert(
+            IAMInlinePolicy,
+            rows,
+            scope={"role__in": [role.pk for role, _ in found]},
+            delete_missing=True,
+        )
+        refresh_permissions()
+    return counts
 
-    instances = client.describe_instances()
 
-    for reservation in instances["Reservations"]:
+def populate_iam_inline_policies(region_name, max_workers=None):
+    # Iterate over all roles in the database
+    counts = sync_inline_policies(IAMRole.objects.all(), region_name, max_workers)
+
+    print(
+        f"Populated IAM inline policies for region: {region_name} "
+        f"({format_counts(counts)})"
+    )
+    return counts
+
+
+def populate_iam(region_name, max_workers=None, sync=None):
+    """
+    Populates IAM roles, managed policies, their attachments and inline policies
+    from the get_account_authorization_details stream.
+    Roles, inline policies and customer managed policies all arrive in the stream;
+    AWS managed policies do not, so each attached one is fetched once per sync and
+    its document once per (ARN, version).
+    """
+    client = get_client("iam", region_name=region_name)
+
+    # Managed policy documents by (policy ARN, version id), for this sync only
+    documents = {}
+    roles, policies = [], {}
+    paginator = client.get_paginator("get_account_authorization_details")
+    for page in paginator.paginate(
+        Filter=["Role", "LocalManagedPolicy"], PaginationConfig={"PageSize": 1000}
+    ):
+        roles.extend(page.get("RoleDetailList", []))
+        for policy in page.get("Policies", []):
+            for version in policy["PolicyVersionList"]:
+                documents[(policy["Arn"], version["VersionId"])] = version["Document"]
+            policies[policy["Arn"]] = policy
+
+    def fetch_managed_policy(policy_arn):
+        policy = client.get_policy(PolicyArn=policy_arn)["Policy"]
+        key = (policy_arn, policy["DefaultVersionId"])
+        if key not in documents:
+            documents[key] = client.get_policy_version(
+                PolicyArn=policy_arn, VersionId=policy["DefaultVersionId"]
+            )["PolicyVersion"]["Document"]
+        return policy
+
+    attached_arns = {
+        attached["PolicyArn"]
+        for role_data in roles
+        for attached in role_data.get("AttachedManagedPolicies", [])
+    }
+    for policy in run_concurrently(
+        fetch_managed_policy,
+        sorted(attached_arns - set(policies)),
+        max_workers or SERVICE_CONCURRENCY["iam"],
+    ):
+        policies[policy["Arn"]] = policy
+
+    role_rows = [
+        {
+            "role_name": role_data["RoleName"],
+            "role_id": role_data["RoleId"],
+            "arn": role_data["Arn"],
+            "create_date": role_data["CreateDate"],
+            "instance_profiles": [
+                profile["InstanceProfileName"]
+                for profile in role_data.get("InstanceProfileList", [])
+            ],
+        }
+        for role_data in roles
+    ]
+    policy_rows = [
+        {
+            "policy_name": policy["PolicyName"],
+            "policy_id": policy["PolicyId"],
+            "arn": policy["Arn"],
+            "create_date": policy["CreateDate"],
+            "policy_document": documents[(policy["Arn"], policy["DefaultVersionId"])],
+            "document_hash": policy_hash(
+                documents[(policy["Arn"], policy["DefaultVersionId"])]
+            ),
+        }
+        for policy in policies.values()
+    ]
+
+    with DB_WRITE_LOCK:
+        role_counts = bulk_upsert(IAMRole, role_rows, sync=sync)
+        policy_counts = bulk_upsert(IAMPolicy, policy_rows, sync=sync)
+        role_ids = {key[0]: role.pk for key, role in role_counts["objects"].items()}
+        policy_ids = {
+            key[0]: policy.pk for key, policy in policy_counts["objects"].items()
+        }
+        bulk_set_relations(
+            IAMRole.policies,
+            {
+                role_ids[role_data["RoleName"]]: [
+                    policy_ids[attached["PolicyArn"]]
+                    for attached in role_data.get("AttachedManagedPolicies", [])
+                ]
+                for role_data in roles
+            },
+        )
+        inline_counts = bulk_upsert(
+            IAMInlinePolicy,
+            [
+                {
+                    "role_id": role_ids[role_data["RoleName"]],
+                    "policy_name": policy["PolicyName"],
+                    "policy_document": policy["PolicyDocument"],
+                    "document_hash": policy_hash(policy["PolicyDocument"]),
+                }
+                for role_data in roles
+                for policy in role_data.get("RolePolicyList", [])
+            ],
+            sync=sync,
+        )
+        refresh_permissions()
+
+    print(
+        f"Populated IAM for region: {region_name} "
+        f"(roles {format_counts(role_counts)}; "
+        f"policies {format_counts(policy_counts)}; "
+        f"inline policies {format_counts(inline_counts)})"
+    )
+    return role_counts
+
+
+def ec2_instance_row(instance_data, region_name):
+    return {
+        "instance_id": instance_data["InstanceId"],
+        "name": next(
+            (
+                tag["Value"]
+                for tag in instance_data.get("Tags", [])
+                if tag["Key"] == "Name"
+            ),
+            None,
+        ),
+        "instance_type": instance_data["InstanceType"],
+        "region": region_name,
+        "availability_zone": instance_data["Placement"]["AvailabilityZone"],
+        "public_ip": instance_data.get("PublicIpAddress"),
+        "private_ip": instance_data.get("PrivateIpAddress"),
+        "state": instance_data["State"]["Name"],
+        "launch_time": instance_data["LaunchTime"],
+        "iam_role": instance_data.get("IamInstanceProfile", {}).get("Arn"),
+    }
+
+
+def iter_ec2_instance_rows(region_name, **filters):
+    client = get_client("ec2", region_name=region_name)
+
+    for reservation in paginate(
+        client, "describe_instances", "Reservations", **filters
+    ):
         for instance_data in reservation["Instances"]:
-            EC2Instance.objects.update_or_create(
-                instance_id=instance_data["InstanceId"],
-                defaults={
-                    "name": next(
-                        (
-                            tag["Value"]
-                            for tag in instance_data.get("Tags", [])
-                            if tag["Key"] == "Name"
-                        ),
-                        None,
-                    ),
-                    "instance_type": instance_data["InstanceType"],
-                    "region": region_name,
-                    "availability_zone": instance_data["Placement"]["AvailabilityZone"],
-                    "public_ip": instance_data.get("PublicIpAddress"),
-                    "private_ip": instance_data.get("PrivateIpAddress"),
-                    "state": instance_data["State"]["Name"],
-                    "launch_time": instance_data["LaunchTime"],
-                    "iam_role": instance_data.get("IamInstanceProfile", {}).get("Arn"),
-                },
-            )
-
-    print(f"Populated EC2 instances for region: {region_name}")
-
-
-def populate_s3_buckets(region_name):
-    client = boto3.client("s3", region_name=region_name)
-
-    buckets = client.list_buckets()
-
-    for bucket_data in buckets["Buckets"]:
-        bucket_location = client.get_bucket_location(Bucket=bucket_data["Name"])
-        bucket_region = bucket_location["LocationConstraint"] or "us-east-1"
-        if bucket_region == region_name:
-            S3Bucket.objects.update_or_create(
-                name=bucket_data["Name"],
-                defaults={
+            yield ec2_instance_row(instance_data, region_name)
+
+
+def populate_ec2_instances(region_name, sync=None):
+    counts = stream_upsert(
+        [(EC2Instance, iter_ec2_instance_rows(region_name))],
+        sync=sync,
+        write_lock=DB_WRITE_LOCK,
+    )
+    print(
+        f"Populated EC2 instances for region: {region_name} "
+        f"({format_counts(counts.get(EC2Instance, EMPTY_COUNTS))})"
+    )
+    return counts
+
+
+def populate_s3_buckets(region_name, max_workers=None, regions=None, sync=None):
+    """
+    Populates the buckets located in the given regions.
+    list_buckets is account-wide, so a multi-region sync lists buckets once and
+    passes every synced region in regions rather than calling this per region.
+    :param regions: Regions to store buckets for; defaults to region_name alone.
+    """
+    regions = regions or [region_name]
+    client = get_client("s3", region_name=region_name)
+
+    def fetch_bucket_region(bucket_name):
+        try:
+            bucket_location = client.get_bucket_location(Bucket=bucket_name)
+        except client.exceptions.NoSuchBucket:
+            # The bucket was deleted between list_buckets and this call
+            return None
+        return bucket_location["LocationConstraint"] or "us-east-1"
+
+    buckets = client.list_buckets()["Buckets"]
+
+    # Bucket regions practically never change, so only buckets not seen before
+    # (or deleted and re-created since) are looked up
+    known = {location.name: location for location in S3BucketLocation.objects.all()}
+    new_buckets = [
+        bucket_data["Name"]
+        for bucket_data in buckets
+        if bucket_data["Name"] not in known
+        or known[bucket_data["Name"]].creation_date != bucket_data["CreationDate"]
+    ]
+    looked_up = dict(
+        zip(
+            new_buckets,
+            run_concurrently(
+                fetch_bucket_region,
+                new_buckets,
+                max_workers or SERVICE_CONCURRENCY["s3"],
+            ),
+        )
+    )
+    buckets = [
+        bucket_data
+        for bucket_data in buckets
+        if bucket_data["Name"] not in looked_up or looked_up[bucket_data["Name"]]
+    ]
+    bucket_regions = [
+        looked_up.get(bucket_data["Name"]) or known[bucket_data["Name"]].region
+        for bucket_data in buckets
+    ]
+
+    rows = [
+        {
+            "name": bucket_data["Name"],
+            "region": bucket_region,
+            "creation_date": bucket_data["CreationDate"],
+        }
+        for bucket_data, bucket_region in zip(buckets, bucket_regions)
+        if bucket_region in regions
+    ]
+
+    with DB_WRITE_LOCK:
+        bulk_upsert(
+            S3BucketLocation,
+            [
+                {
+                    "name": bucket_data["Name"],
                     "region": bucket_region,
                     "creation_date": bucket_data["CreationDate"],
-                },
-            )
-
-    print(f"Populated S3 buckets for region: {region_name}")
-
-
-def populate_lambda_functions(region_name):
-    client = boto3.client("lambda", region_name=region_name)
-
-    functions = client.list_functions()
-
-    for function_data in functions["Functions"]:
-        LambdaFunction.objects.update_or_create(
-            function_name=function_data["FunctionName"],
-            defaults={
-                "function_arn": function_data["FunctionArn"],
-                "runtime": function_data["Runtime"],
-                "handler": function_data["Handler"],
-                "role": function_data["Role"],
-                "code_size": function_data["CodeSize"],
-                "description": function_data.get("Description", ""),
-                "timeout": function_data["Timeout"],
-                "memory_size": function_data["MemorySize"],
-                "last_modified": function_data["LastModified"],
-                "region": region_name,
-            },
+                }
+                for bucket_data, bucket_region in zip(buckets, bucket_regions)
+            ],
+            delete_missing=True,
         )
-
-    print(f"Populated Lambda functions for region: {region_name}")
-
-
-def populate_sqs_queues(region_name):
-    client = boto3.client("sqs", region_name=region_name)
-
-    queues = client.list_queues()
-
-    if "QueueUrls" in queues:
-        for queue_url in queues["QueueUrls"]:
-            queue_attributes = client.get_queue_attributes(
-                QueueUrl=queue_url, AttributeNames=["All"]
+        counts = bulk_upsert(S3Bucket, rows, scope={"region__in": regions}, sync=sync)
+
+    print(
+        f"Populated S3 buckets for regions: {', '.join(regions)} "
+        f"({format_counts(counts)})"
+    )
+    return counts
+
+
+def lambda_function_row(function_data, region_name):
+    return {
+        "function_name": function_data["FunctionName"],
+        "function_arn": function_data["FunctionArn"],
+        "runtime": function_data["Runtime"],
+        "handler": function_data["Handler"],
+        "role": function_data["Role"],
+        "code_size": function_data["CodeSize"],
+        "description": function_data.get("Description", ""),
+        "timeout": function_data["Timeout"],
+        "memory_size": function_data["MemorySize"],
+        "last_modified": function_data["LastModified"],
+        "region": region_name,
+    }
+
+
+def iter_lambda_function_rows(region_name):
+    client = get_client("lambda", region_name=region_name)
+
+    for function_data in paginate(client, "list_functions", "Functions"):
+        yield lambda_function_row(function_data, region_name)
+
+
+def populate_lambda_functions(region_name, sync=None):
+    counts = stream_upsert(
+        [(LambdaFunction, iter_lambda_function_rows(region_name))],
+        sync=sync,
+        write_lock=DB_WRITE_LOCK,
+    )
+    print(
+        f"Populated Lambda functions for region: {region_name} "
+        f"({format_counts(counts.get(LambdaFunction, EMPTY_COUNTS))})"
+    )
+    return counts
+
+
+def sqs_queue_row(queue_url, queue_attributes, region_name):
+    return {
+        "queue_name": queue_attributes["QueueArn"].split(":")[-1],
+        "queue_url": queue_url,
+        "region": region_name,
+        "arn": queue_attributes["QueueArn"],
+        # Convert Unix timestamp to datetime object
+        "created_timestamp": datetime.fromtimestamp(
+            float(queue_attributes["CreatedTimestamp"]), tz=dt_timezone.utc
+        ),
+        "visibility_timeout": queue_attributes["VisibilityTimeout"],
+        "maximum_message_size": queue_attributes["MaximumMessageSize"],
+        "message_retention_period": queue_attributes["MessageRetentionPeriod"],
+    }
+
+
+def iter_sqs_queue_rows(region_name, max_workers=None):
+    client = get_client("sqs", region_name=region_name)
+
+    def fetch_queue_attributes(queue_url):
+        try:
+            return client.get_queue_attributes(
+                QueueUrl=queue_url, AttributeNames=SQS_QUEUE_ATTRIBUTES
             )["Attributes"]
-
-            # Convert Unix timestamp to datetime object
-            created_timestamp = datetime.utcfromtimestamp(
-                float(queue_attributes["CreatedTimestamp"])
-            )
-
-            SQSQueue.objects.update_or_create(
-                queue_name=queue_attributes["QueueArn"].split(":")[-1],
-                defaults={
-                    "queue_url": queue_url,
-                    "region": region_name,
-                    "arn": queue_attributes["QueueArn"],
-                    "created_timestamp": created_timestamp,
-                    "visibility_timeout": queue_attributes["VisibilityTimeout"],
-                    "maximum_message_size": queue_attributes["MaximumMessageSize"],
-                    "message_retention_period": queue_attributes[
-                        "MessageRetentionPeriod"
-                    ],
-                },
-            )
-
-    print(f"Populated SQS queues for region: {region_name}")
-
-
-def populate_aws_resources(region_name):
-    populate_iam_roles_and_policies(region_name)
-    populate_iam_inline_policies(region_name)
-    populate_ec2_instances(region_name)
-    populate_s3_buckets(region_name)
-    populate_lambda_functions(region_name)
-    populate_sqs_queues(region_name)
+        except client.exceptions.QueueDoesNotExist:
+            # The queue was deleted between list_queues and this call
+            return None
+
+    # list_queues only returns a NextToken when MaxResults is set
+    pages = client.get_paginator("list_queues").paginate(
+        PaginationConfig={"PageSize": 1000}
+    )
+    for page in pages:
+        # Attributes are fetched concurrently, one page of queues at a time
+        queue_urls = page.get("QueueUrls", [])
+        attributes = run_concurrently(
+            fetch_queue_attributes,
+            queue_urls,
+            max_workers or SERVICE_CONCURRENCY["sqs"],
+        )
+        for queue_url, queue_attributes in zip(queue_urls, attributes):
+            if queue_attributes is None:
+                continue
+            yield sqs_queue_row(queue_url, queue_attributes, region_name)
+
+
+def populate_sqs_queues(region_name, max_workers=None, sync=None):
+    counts = stream_upsert(
+        [(SQSQueue, iter_sqs_queue_rows(region_name, max_workers))],
+        sync=sync,
+        write_lock=DB_WRITE_LOCK,
+    )
+    print(
+        f"Populated SQS queues for region: {region_name} "
+        f"({format_counts(counts.get(SQSQueue, EMPTY_COUNTS))})"
+    )
+    return counts
+
+
+def populate_regional_resources(regions, max_workers=None, sync=None, max_streams=None):
+    """
+    Streams EC2 instances, Lambda functions and SQS queues of every region through
+    a single database writer, so memory stays flat whatever the account size.
+    :param regions: A list of region names.
+    :param max_workers: Maximum concurrent queue attribute calls per region.
+    :param max_streams: Maximum number of service streams fetched at the same time.
+    """
+    streams = []
+    for region_name in regions:
+        streams += [
+            (EC2Instance, iter_ec2_instance_rows(region_name)),
+            (LambdaFunction, iter_lambda_function_rows(region_name)),
+            (SQSQueue, iter_sqs_queue_rows(region_name, max_workers)),
+        ]
+    counts = stream_upsert(
+        streams, sync=sync, write_lock=DB_WRITE_LOCK, max_workers=max_streams
+    )
+    for model, model_counts in counts.items():
+        print(
+            f"Populated {model.__name__} rows for regions: "
+            f"{', '.join(regions)} ({format_counts(model_counts)})"
+        )
+    return counts
+
+
+def get_enabled_regions(region_name="us-east-1"):
+    """
+    Returns the names of the regions enabled for the account, sorted.
+    """
+    client = get_client("ec2", region_name=region_name)
+    response = client.describe_regions(
+        Filters=[
+            {
+                "Name": "opt-in-status",
+                "Values": ["opt-in-not-required", "opted-in"],
+            }
+        ]
+    )
+    return sorted(region["RegionName"] for region in response["Regions"])
+
+
+def get_populators(regions, concurrency=None, sync=None, max_streams=None):
+    """
+    Builds the populators for a sync of the given regions.
+    IAM and S3 are account-global and are scheduled once, from the first region;
+    EC2, Lambda and SQS are streamed from every region into one writer.
+    :param regions: A list of region names.
+    :param concurrency: Optional per-service overrides for SERVICE_CONCURRENCY.
+    :param sync: Optional InventorySync the populators record their rows against.
+    :param max_streams: Maximum number of regional service streams fetched at once.
+    """
+    limits = {**SERVICE_CONCURRENCY, **(concurrency or {})}
+    home_region = regions[0]
+
+    return [
+        partial(populate_iam, home_region, limits["iam"], sync=sync),
+        partial(
+            populate_s3_buckets, home_region, limits["s3"], regions=regions, sync=sync
+        ),
+        partial(
+            populate_regional_resources,
+            regions,
+            limits["sqs"],
+            sync=sync,
+            max_streams=max_streams,
+        ),
+    ]
+
+
+def sync_inventory(regions, concurrency=None, max_workers=16, delete_unseen=False):
+    """
+    Runs one incremental sync of the given regions and records it as an InventorySync.
+    Rows whose AWS data is unchanged are only marked as seen. Once every populator
+    has succeeded, rows the sync did not see are tombstoned (or deleted).
+    :param regions: A list of region names.
+    :param concurrency: Optional per-service overrides for SERVICE_CONCURRENCY.
+    :param max_workers: Maximum number of regional service streams fetched at once.
+    :param delete_unseen: Delete unseen rows instead of tombstoning them.
+    :return: The InventorySync, with change counts per model.
+    """
+    sync = InventorySync.objects.create(regions=regions)
+    try:
+        populators = get_populators(regions, concurrency, sync, max_workers)
+        run_concurrently(lambda populator: populator(), populators, len(populators))
+
+        scopes = [
+            (IAMRole, {}),
+            (IAMPolicy, {}),
+            (IAMInlinePolicy, {}),
+            (EC2Instance, {"region__in": regions}),
+            (S3Bucket, {"region__in": regions}),
+            (LambdaFunction, {"region__in": regions}),
+            (SQSQueue, {"region__in": regions}),
+        ]
+        for model, scope in scopes:
+            sweep_unseen(model, sync, scope, delete=delete_unseen)
+        sync.status = "succeeded"
+    except Exception:
+        sync.status = "failed"
+        raise
+    finally:
+        sync.finished_at = timezone.now()
+        sync.save()
+    return sync
+
+
+def populate_aws_resources(region_name, concurrency=None, delete_unseen=False):
+    """
+    Populates every inventory model for the region.
+    The service populators run concurrently, so a full refresh takes as long
+    as the slowest service rather than the sum of all of them.
+    :param concurrency: Optional per-service overrides for SERVICE_CONCURRENCY.
+    :param delete_unseen: Delete resources gone from AWS instead of tombstoning them.
+    """
+    return sync_inventory([region_name], concurrency, delete_unseen=delete_unseen)
+
+
+def populate_all_regions(
+    regions=None, concurrency=None, max_workers=16, delete_unseen=False
+):
+    """
+    Populates every inventory model across all enabled regions of the account.
+    Regional services fan out concurrently while IAM and S3 run exactly once,
+    so adding regions adds almost no IAM or S3 cost.
+    :param regions: Regions to sync; defaults to every enabled region.
+    :param concurrency: Optional per-service overrides for SERVICE_CONCURRENCY.
+    :param max_workers: Maximum number of regional service streams fetched at once.
+    :param delete_unseen: Delete resources gone from AWS instead of tombstoning them.
+    """
+    regions = list(regions or get_enabled_regions())
+    sync = sync_inventory(regions, concurrency, max_workers, delete_unseen)
+    print(f"Populated AWS resources for {len(regions)} regions")
+    return sync
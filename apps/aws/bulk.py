@@ -0,0 +1,241 @@
+import hashlib
+import json
+from django.db import connection, transaction
+from django.utils import timezone
+from apps.aws.models.aws_models import (
+    SyncedModel,
+    IAMRole,
+    IAMPolicy,
+    IAMInlinePolicy,
+    EC2Instance,
+    S3Bucket,
+    S3BucketLocation,
+    LambdaFunction,
+    SQSQueue,
+)
+
+# Natural key used to match AWS resources against existing rows
+NATURAL_KEYS = {
+    EC2Instance: ("instance_id",),
+    S3Bucket: ("name",),
+    S3BucketLocation: ("name",),
+    LambdaFunction: ("function_name", "region"),
+    SQSQueue: ("queue_name", "region"),
+    IAMRole: ("role_name",),
+    IAMPolicy: ("arn",),
+    IAMInlinePolicy: ("role_id", "policy_name"),
+}
+
+BATCH_SIZE = 500
+
+
+def chunked(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def fingerprint(row):
+    """
+    Returns a stable hash of a row's field values as fetched from AWS.
+    """
+    return hashlib.sha256(
+        json.dumps(row, sort_keys=True, default=str).encode("utf-8")
+    ).hexdigest()
+
+
+def bulk_upsert(
+    model, rows, scope=None, delete_missing=False, sync=None, batch_size=BATCH_SIZE
+):
+    """
+    Writes rows to the model, touching only those whose fields actually changed.
+    Existing rows are loaded once and matched on the model's natural key; new rows
+    are inserted with bulk_create and changed rows are written with bulk_update,
+    in chunks and inside a single transaction.
+    Rows of a SyncedModel are compared by fingerprint, and rows whose fingerprint
+    is unchanged are skipped apart from recording that the sync saw them.
+    :param model: One of the models in NATURAL_KEYS.
+    :param rows: An iterable of dictionaries of field values, including the key fields.
+    :param scope: Optional filter restricting the existing rows considered, e.g. a region.
+    :param delete_missing: Delete rows in scope that are not present in rows.
+    :param sync: Optional InventorySync recording the rows seen and the change counts.
+    :return: A dictionary of inserted, updated, unchanged and deleted counts, along
+        with the saved objects keyed by natural key.
+    """
+    key_fields = NATURAL_KEYS[model]
+    synced = issubclass(model, SyncedModel)
+
+    def key_of(values):
+        return tuple(values[field] for field in key_fields)
+
+    incoming = {key_of(row): row for row in rows}
+    existing = {
+        tuple(getattr(obj, field) for field in key_fields): obj
+        for obj in model.objects.filter(**(scope or {}))
+    }
+
+    fields = [
+        name
+        for name in dict.fromkeys(name for row in incoming.values() for name in row)
+        if name not in key_fields
+    ]
+    update_fields = list(fields)
+    if synced:
+        update_fields += ["fingerprint", "deleted_at"]
+        if sync is not None:
+            update_fields.append("last_seen_sync")
+
+    def is_changed(obj, values):
+        if synced:
+            return (
+                obj.fingerprint != values["fingerprint"] or obj.deleted_at is not None
+            )
+        return any(getattr(obj, name) != values[name] for name in fields)
+
+    to_create, to_update, unchanged = [], [], []
+    objects = {}
+    for key, row in incoming.items():
+        values = {
+            name: model._meta.get_field(name).to_python(value)
+            for name, value in row.items()
+        }
+        if synced:
+            values["fingerprint"] = fingerprint(row)
+            values["deleted_at"] = None
+            if sync is not None:
+                values["last_seen_sync"] = sync
+        obj = existing.get(key)
+        if obj is None:
+            obj = model(**values)
+            to_create.append(obj)
+        elif is_changed(obj, values):
+            for name in update_fields:
+                setattr(obj, name, values[name])
+            to_update.append(obj)
+        else:
+            unchanged.append(obj.pk)
+        objects[key] = obj
+
+    stale = [obj.pk for key, obj in existing.items() if key not in incoming]
+
+    with transaction.atomic():
+        create_options = {}
+        unique_key = (
+            len(key_fields) == 1 and model._meta.get_field(key_fields[0]).unique
+        )
+        if unique_key and fields:
+            # Rows written by a concurrent sync since we loaded them become updates
+            create_options = {
+                "update_conflicts": True,
+                "update_fields": update_fields,
+            }
+            if connection.features.supports_update_conflicts_with_target:
+                create_options["unique_fields"] = list(key_fields)
+        for batch in chunked(to_create, batch_size):
+            model.objects.bulk_create(batch, **create_options)
+        for batch in chunked(to_update, batch_size):
+            model.objects.bulk_update(batch, update_fields, batch_size=batch_size)
+        if synced and sync is not None:
+            for batch in chunked(unchanged, batch_size):
+                model.objects.filter(pk__in=batch).update(last_seen_sync=sync)
+
+        deleted = 0
+        if delete_missing:
+            for batch in chunked(stale, batch_size):
+                deleted += (
+                    model.objects.filter(pk__in=batch)
+                    .delete()[1]
+                    .get(model._meta.label, 0)
+                )
+
+    missing = [obj for obj in to_create if obj.pk is None]
+    if missing and len(key_fields) == 1:
+        # Backends such as MySQL do not return primary keys from bulk inserts
+        key_field = key_fields[0]
+        for batch in chunked(missing, batch_size):
+            saved = model.objects.in_bulk(
+                [getattr(obj, key_field) for obj in batch], field_name=key_field
+            )
+            for key_value, obj in saved.items():
+                objects[(key_value,)] = obj
+
+    counts = {
+        "inserted": len(to_create),
+        "updated": len(to_update),
+        "unchanged": len(unchanged),
+        "deleted": deleted,
+    }
+    if sync is not None:
+        sync.record(model, counts)
+    return {**counts, "objects": objects}
+
+
+def sweep_unseen(model, sync, scope=None, delete=False, batch_size=BATCH_SIZE):
+    """
+    Tombstones, or deletes, the rows in scope that the sync did not see.
+    Only call this once every populator of the sync has finished successfully.
+    :param model: A SyncedModel.
+    :param sync: The InventorySync that has just run.
+    :param scope: Optional filter restricting the rows swept, e.g. the synced regions.
+    :param delete: Delete the rows instead of setting deleted_at.
+    :return: The number of rows tombstoned or deleted.
+    """
+    unseen = model.objects.filter(**(scope or {})).exclude(last_seen_sync=sync)
+    if not delete:
+        unseen = unseen.filter(deleted_at__isnull=True)
+    unseen = list(unseen.values_list("pk", flat=True))
+    swept = 0
+    now = timezone.now()
+    for batch in chunked(unseen, batch_size):
+        with transaction.atomic():
+            if delete:
+                swept += (
+                    model.objects.filter(pk__in=batch)
+                    .delete()[1]
+                    .get(model._meta.label, 0)
+                )
+            else:
+                swept += model.objects.filter(pk__in=batch).update(deleted_at=now)
+    sync.record(model, {"deleted": swept})
+    return swept
+
+
+def bulk_set_relations(relation, targets, batch_size=BATCH_SIZE):
+    """
+    Makes a many-to-many relation hold exactly the given targets for each source,
+    e.g. the managed policies attached to each synced IAMRole.
+    :param relation: The many-to-many descriptor, e.g. IAMRole.policies.
+    :param targets: A dictionary mapping source ids to iterables of target ids.
+    :return: A dictionary of inserted and deleted counts.
+    """
+    through = relation.through
+    source_attname = f"{relation.field.m2m_field_name()}_id"
+    target_attname = f"{relation.field.m2m_reverse_field_name()}_id"
+
+    wanted = {
+        (source_id, target_id)
+        for source_id, target_ids in targets.items()
+        for target_id in target_ids
+    }
+    existing = {}
+    for batch in chunked(targets, batch_size):
+        for pk, source_id, target_id in through.objects.filter(
+            **{f"{source_attname}__in": batch}
+        ).values_list("pk", source_attname, target_attname):
+            existing[(source_id, target_id)] = pk
+
+    to_create = [
+        through(**{source_attname: source_id, target_attname: target_id})
+        for source_id, target_id in wanted
+        if (source_id, target_id) not in existing
+    ]
+    stale = [pk for pair, pk in existing.items() if pair not in wanted]
+
+    with transaction.atomic():
+        through.objects.bulk_create(
+            to_create, batch_size=batch_size, ignore_conflicts=True
+        )
+        for batch in chunked(stale, batch_size):
+            through.objects.filter(pk__in=batch).delete()
+
+    return {"inserted": len(to_create), "deleted": len(stale)}
@@ -0,0 +1,86 @@
+import threading
+import boto3
+from botocore.config import Config
+from django.conf import settings
+
+# Connections each client keeps open; enough for the populators' thread pools
+MAX_POOL_CONNECTIONS = getattr(settings, "AWS_MAX_POOL_CONNECTIONS", 32)
+# Adaptive mode also rate-limits the client itself once AWS starts throttling
+RETRY_MODE = getattr(settings, "AWS_RETRY_MODE", "adaptive")
+MAX_ATTEMPTS = getattr(settings, "AWS_MAX_ATTEMPTS", 10)
+
+_lock = threading.Lock()
+_sessions = {}
+_clients = {}
+
+
+def client_config():
+    return Config(
+        max_pool_connections=MAX_POOL_CONNECTIONS,
+        retries={"mode": RETRY_MODE, "max_attempts": MAX_ATTEMPTS},
+    )
+
+
+def get_session(credentials=None):
+    """
+    Returns the shared boto3 session for a set of credentials.
+    :param credentials: Optional (access key id, secret access key, session token)
+        tuple; None uses the default credential chain.
+    """
+    with _lock:
+        session = _sessions.get(credentials)
+        if session is None:
+            if credentials is None:
+                session = boto3.session.Session()
+            else:
+                access_key_id, secret_access_key, session_token = credentials
+                session = boto3.session.Session(
+                    aws_access_key_id=access_key_id,
+                    aws_secret_access_key=secret_access_key,
+                    aws_session_token=session_token,
+                )
+            _sessions[credentials] = session
+        return session
+
+
+def get_client(
+    service_name,
+    region_name=None,
+    aws_access_key_id=None,
+    aws_secret_access_key=None,
+    aws_session_token=None,
+):
+    """
+    Returns a boto3 client shared by every thread of the process.
+    Clients are created once per (service, region, credentials) and reuse their
+    credentials, endpoint metadata and connection pool across calls; boto3
+    clients, unlike sessions, are safe to share between threads.
+    :param service_name: e.g. "ec2".
+    :param region_name: Optional region; defaults to the session's region.
+    """
+    credentials = None
+    if aws_access_key_id or aws_secret_access_key or aws_session_token:
+        credentials = (aws_access_key_id, aws_secret_access_key, aws_session_token)
+    key = (service_name, region_name, credentials)
+
+    client = _clients.get(key)
+    if client is None:
+        session = get_session(credentials)
+        # Creating clients from a session is not thread-safe
+        with _lock:
+            client = _clients.get(key)
+            if client is None:
+                client = session.client(
+                    service_name, region_name=region_name, config=client_config()
+                )
+                _clients[key] = client
+    return client
+
+
+def clear_clients():
+    """
+    Drops every shared session and client, e.g. after credentials were rotated.
+    """
+    with _lock:
+        _sessions.clear()
+        _clients.clear()
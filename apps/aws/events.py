@@ -0,0 +1,397 @@
+from functools import reduce
+import json
+import operator
+import re
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from apps.aws.access import refresh_permissions
+from apps.aws.aws_shared import (
+    SQS_QUEUE_ATTRIBUTES,
+    format_counts,
+    iter_ec2_instance_rows,
+    lambda_function_row,
+    sqs_queue_row,
+)
+from apps.aws.clients import get_client
+from apps.aws.bulk import NATURAL_KEYS, BATCH_SIZE, bulk_upsert, chunked
+from apps.aws.pipeline import batch_scope
+from apps.aws.policies import policy_hash
+from apps.aws.models.aws_models import (
+    EC2Instance,
+    IAMInlinePolicy,
+    IAMRole,
+    LambdaFunction,
+    SQSQueue,
+)
+
+# SQS allows at most 10 messages per receive and per delete batch
+SQS_MAX_MESSAGES = 10
+
+
+def instance_ids(elements):
+    return [
+        item["instanceId"]
+        for item in (elements or {}).get("instancesSet", {}).get("items", [])
+    ]
+
+
+def function_name(detail):
+    name = detail["requestParameters"]["functionName"]
+    # Lambda accepts a function ARN wherever a name is expected
+    return name.split(":")[6] if name.startswith("arn:") else name
+
+
+def event_queue_url(elements):
+    return elements["queueUrl"]
+
+
+# CloudTrail event names handled, mapped to the model they change and a function
+# returning the keys of the resources affected
+EVENT_RESOURCES = {
+    "RunInstances": (
+        EC2Instance,
+        lambda detail: instance_ids(detail["responseElements"]),
+    ),
+    "StartInstances": (
+        EC2Instance,
+        lambda detail: instance_ids(detail["requestParameters"]),
+    ),
+    "StopInstances": (
+        EC2Instance,
+        lambda detail: instance_ids(detail["requestParameters"]),
+    ),
+    "TerminateInstances": (
+        EC2Instance,
+        lambda detail: instance_ids(detail["requestParameters"]),
+    ),
+    "CreateFunction": (LambdaFunction, lambda detail: [function_name(detail)]),
+    "UpdateFunctionConfiguration": (
+        LambdaFunction,
+        lambda detail: [function_name(detail)],
+    ),
+    "UpdateFunctionCode": (LambdaFunction, lambda detail: [function_name(detail)]),
+    "DeleteFunction": (LambdaFunction, lambda detail: [function_name(detail)]),
+    "CreateQueue": (
+        SQSQueue,
+        lambda detail: [event_queue_url(detail["responseElements"])],
+    ),
+    "SetQueueAttributes": (
+        SQSQueue,
+        lambda detail: [event_queue_url(detail["requestParameters"])],
+    ),
+    "DeleteQueue": (
+        SQSQueue,
+        lambda detail: [event_queue_url(detail["requestParameters"])],
+    ),
+    "PutRolePolicy": (
+        IAMInlinePolicy,
+        lambda detail: [
+            (
+                detail["requestParameters"]["roleName"],
+                detail["requestParameters"]["policyName"],
+            )
+        ],
+    ),
+    "DeleteRolePolicy": (
+        IAMInlinePolicy,
+        lambda detail: [
+            (
+                detail["requestParameters"]["roleName"],
+                detail["requestParameters"]["policyName"],
+            )
+        ],
+    ),
+}
+
+
+def parse_event(body):
+    """
+    Extracts the CloudTrail record from an SQS message body.
+    Accepts EventBridge events (optionally wrapped in an SNS notification) as well
+    as bare CloudTrail records.
+    :return: A tuple of (event name, region, CloudTrail record), or None if the
+        message is not an API call handled here.
+    """
+    try:
+        event = json.loads(body)
+        if event.get("Type") == "Notification":
+            event = json.loads(event["Message"])
+    except (AttributeError, TypeError, ValueError, KeyError):
+        return None
+    if not isinstance(event, dict):
+        return None
+
+    detail = event.get("detail", event)
+    if not isinstance(detail, dict) or detail.get("errorCode"):
+        return None
+    # Lambda event names carry an API version, e.g. CreateFunction20150331v2
+    event_name = re.sub(r"\d{8}(v\d+)?$", "", detail.get("eventName", ""))
+    if event_name not in EVENT_RESOURCES:
+        return None
+    region_name = detail.get("awsRegion") or event.get("region")
+    return event_name, region_name, detail
+
+
+def fetch_ec2_instances(region_name, keys):
+    # A filter, unlike InstanceIds, does not fail on instances that no longer exist
+    rows = []
+    for batch in chunked(keys, 200):
+        rows.extend(
+            iter_ec2_instance_rows(
+                region_name, Filters=[{"Name": "instance-id", "Values": batch}]
+            )
+        )
+    return rows
+
+
+def fetch_lambda_functions(region_name, keys):
+    client = get_client("lambda", region_name=region_name)
+    rows = []
+    for name in keys:
+        try:
+            function_data = client.get_function(FunctionName=name)["Configuration"]
+        except client.exceptions.ResourceNotFoundException:
+            continue
+        rows.append(lambda_function_row(function_data, region_name))
+    return rows
+
+
+def fetch_sqs_queues(region_name, keys):
+    client = get_client("sqs", region_name=region_name)
+    rows = []
+    for url in keys:
+        try:
+            queue_attributes = client.get_queue_attributes(
+                QueueUrl=url, AttributeNames=SQS_QUEUE_ATTRIBUTES
+            )["Attributes"]
+        except client.exceptions.QueueDoesNotExist:
+            continue
+        rows.append(sqs_queue_row(url, queue_attributes, region_name))
+    return rows
+
+
+def fetch_inline_policies(region_name, keys):
+    client = get_client("iam", region_name=region_name)
+    roles = dict(
+        IAMRole.objects.filter(role_name__in={role for role, _ in keys}).values_list(
+            "role_name", "pk"
+        )
+    )
+    rows = []
+    for role_name, policy_name in keys:
+        # Roles not synced yet are picked up with their policies by the next scan
+        if role_name not in roles:
+            continue
+        try:
+            policy = client.get_role_policy(RoleName=role_name, PolicyName=policy_name)
+        except client.exceptions.NoSuchEntityException:
+            continue
+        rows.append(
+            {
+                "role_id": roles[role_name],
+                "policy_name": policy_name,
+                "policy_document": policy["PolicyDocument"],
+                "document_hash": policy_hash(policy["PolicyDocument"]),
+            }
+        )
+    return rows
+
+
+def event_keys(model, region_name, keys):
+    """
+    Converts the keys extracted from events to the model's natural keys, so that
+    resources that no longer exist can be matched against existing rows.
+    """
+    if model is EC2Instance:
+        return [(key,) for key in keys]
+    if model is LambdaFunction:
+        return [(key, region_name) for key in keys]
+    if model is SQSQueue:
+        return [(key.rstrip("/").split("/")[-1], region_name) for key in keys]
+    roles = dict(
+        IAMRole.objects.filter(role_name__in={role for role, _ in keys}).values_list(
+            "role_name", "pk"
+        )
+    )
+    return [(roles[role], policy) for role, policy in keys if role in roles]
+
+
+FETCHERS = {
+    EC2Instance: fetch_ec2_instances,
+    LambdaFunction: fetch_lambda_functions,
+    SQSQueue: fetch_sqs_queues,
+    IAMInlinePolicy: fetch_inline_policies,
+}
+
+
+def remove_rows(model, keys, delete=False, batch_size=BATCH_SIZE):
+    """
+    Tombstones, or deletes, the rows matching the given natural keys.
+    :return: The number of rows tombstoned or deleted.
+    """
+    key_fields = NATURAL_KEYS[model]
+    removed = 0
+    now = timezone.now()
+    for batch in chunked(keys, batch_size):
+        rows = model.objects.filter(
+            reduce(operator.or_, (Q(**dict(zip(key_fields, key))) for key in batch))
+        )
+        if delete:
+            removed += rows.delete()[1].get(model._meta.label, 0)
+        else:
+            removed += rows.filter(deleted_at__isnull=True).update(deleted_at=now)
+    return removed
+
+
+def row_ids(model, keys, batch_size=BATCH_SIZE):
+    """
+    :return: The primary keys of the rows matching the given natural keys.
+    """
+    key_fields = NATURAL_KEYS[model]
+    ids = []
+    for batch in chunked(keys, batch_size):
+        ids.extend(
+            model.objects.filter(
+                reduce(operator.or_, (Q(**dict(zip(key_fields, key))) for key in batch))
+            ).values_list("pk", flat=True)
+        )
+    return ids
+
+
+def apply_events(events, delete=False):
+    """
+    Brings the inventory rows touched by a batch of events up to date.
+    Events only say which resources changed, so the current state of each affected
+    resource is fetched from AWS, once per resource, and written with bulk_upsert;
+    resources that no longer exist are tombstoned like in a full sync. Applying
+    the same events twice, or out of order, therefore leaves the same rows.
+    :param events: An iterable of (event name, region, CloudTrail record) tuples,
+        as returned by parse_event.
+    :param delete: Delete rows of removed resources instead of setting deleted_at.
+    :return: A dictionary of inserted, updated, unchanged and deleted counts per model.
+    """
+    affected = {}
+    for event_name, region_name, detail in events:
+        model, get_keys = EVENT_RESOURCES[event_name]
+        try:
+            keys = get_keys(detail)
+        except (KeyError, TypeError):
+            continue
+        affected.setdefault((model, region_name), {}).update(dict.fromkeys(keys))
+
+    counts = {}
+    # Natural keys of the inline policies written, whose permissions follow
+    inline_policies = []
+    for (model, region_name), keys in affected.items():
+        keys = list(keys)
+        rows = FETCHERS[model](region_name, keys)
+        found = {tuple(row[field] for field in NATURAL_KEYS[model]) for row in rows}
+        gone = [key for key in event_keys(model, region_name, keys) if key not in found]
+
+        with transaction.atomic():
+            result = (
+                bulk_upsert(model, rows, scope=batch_scope(model, rows))
+                if rows
+                else {"inserted": 0, "updated": 0, "unchanged": 0}
+            )
+            deleted = remove_rows(model, gone, delete=delete)
+        if model is IAMInlinePolicy:
+            inline_policies.extend(found)
+
+        totals = counts.setdefault(
+            model, {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+        )
+        for key in ("inserted", "updated", "unchanged"):
+            totals[key] += result[key]
+        totals["deleted"] += deleted
+
+    if inline_policies:
+        # Removed policies need no refresh: matching skips tombstoned ones
+        refresh_permissions(inline_policy_ids=row_ids(IAMInlinePolicy, inline_policies))
+    return counts
+
+
+def receive_events(sqs_client, queue_url, max_messages=100, wait_time=20):
+    """
+    Long-polls the queue until max_messages have arrived or it has been drained.
+    Only the first receive waits; later ones return whatever is already queued.
+    :return: A list of SQS messages.
+    """
+    messages = []
+    while len(messages) < max_messages:
+        response = sqs_client.receive_message(
+            QueueUrl=queue_url,
+            MaxNumberOfMessages=min(SQS_MAX_MESSAGES, max_messages - len(messages)),
+            WaitTimeSeconds=0 if messages else wait_time,
+        )
+        if not response.get("Messages"):
+            break
+        messages.extend(response["Messages"])
+    return messages
+
+
+def delete_messages(sqs_client, queue_url, messages):
+    for batch in chunked(messages, SQS_MAX_MESSAGES):
+        sqs_client.delete_message_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(index), "ReceiptHandle": message["ReceiptHandle"]}
+                for index, message in enumerate(batch)
+            ],
+        )
+
+
+def run_event_worker(
+    queue_url,
+    region_name,
+    sqs_client=None,
+    batch_size=100,
+    wait_time=20,
+    delete=False,
+    max_polls=None,
+):
+    """
+    Applies the inventory changes announced on an SQS queue of EventBridge or
+    CloudTrail events, one batch of messages at a time.
+    Messages are deleted once their batch has been applied; if applying fails they
+    are left on the queue and delivered again after the visibility timeout.
+    :param queue_url: URL of the queue receiving the events.
+    :param region_name: Region of the queue.
+    :param sqs_client: Optional SQS client, e.g. one created inside a moto mock.
+    :param max_polls: Stop after this many polls; runs forever when None.
+    :return: A dictionary of inserted, updated, unchanged and deleted counts per model.
+    """
+    sqs_client = sqs_client or get_client("sqs", region_name=region_name)
+    counts = {}
+    polls = 0
+    while max_polls is None or polls < max_polls:
+        polls += 1
+        messages = receive_events(sqs_client, queue_url, batch_size, wait_time)
+        if not messages:
+            continue
+
+        events = [parse_event(message["Body"]) for message in messages]
+        try:
+            batch_counts = apply_events(
+                [event for event in events if event], delete=delete
+            )
+        except Exception as e:
+            print(f"Error applying {len(messages)} events: {e}")
+            continue
+        delete_messages(sqs_client, queue_url, messages)
+
+        for model, model_counts in batch_counts.items():
+            totals = counts.setdefault(
+                model, {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+            )
+            for key in totals:
+                totals[key] += model_counts[key]
+        print(
+            f"Applied {len(messages)} events: "
+            + "; ".join(
+                f"{model.__name__} {format_counts(model_counts)}"
+                for model, model_counts in batch_counts.items()
+            )
+        )
+    return counts
@@ -0,0 +1,362 @@
+import importlib.util
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from collections import Counter
+from datetime import datetime, timezone
+import boto3
+from botocore.client import BaseClient
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.backends.signals import connection_created
+from apps.aws.aws_shared import populate_aws_resources
+
+# Synthetic account sizes, in total resources split across the benchmarked services
+DEFAULT_SIZES = [10, 1000, 10000]
+
+SERVICES = ["ec2", "s3", "iam", "lambda", "sqs"]
+
+# Number of IAM roles sharing each customer managed policy
+ROLES_PER_POLICY = 25
+
+TRUST_POLICY = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Principal": {"Service": "lambda.amazonaws.com"},
+            "Action": "sts:AssumeRole",
+        }
+    ],
+}
+
+
+def policy_document(index):
+    return json.dumps(
+        {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": "Allow",
+                    "Action": ["s3:GetObject", "sqs:SendMessage"],
+                    "Resource": f"arn:aws:s3:::bucket-{index}/*",
+                }
+            ],
+        }
+    )
+
+
+def lambda_package():
+    package = io.BytesIO()
+    with zipfile.ZipFile(package, "w") as archive:
+        archive.writestr("handler.py", "def handler(event, context):\n    return 1\n")
+    return package.getvalue()
+
+
+def build_account(size, region_name):
+    """
+    Creates a synthetic account in moto with size resources spread evenly across
+    EC2 instances, S3 buckets, IAM roles, Lambda functions and SQS queues.
+    Every IAM role has an inline policy and attaches a customer managed policy
+    shared with ROLES_PER_POLICY other roles.
+    :param size: Total number of resources to create.
+    :param region_name: The region to create the regional resources in.
+    :return: A dictionary of the number of resources created per service.
+    """
+    per_service = max(1, size // len(SERVICES))
+
+    iam = boto3.client("iam", region_name=region_name)
+    policy_arns = [
+        iam.create_policy(
+            PolicyName=f"benchmark-shared-{index}",
+            PolicyDocument=policy_document(index),
+        )["Policy"]["Arn"]
+        for index in range(max(1, per_service // ROLES_PER_POLICY))
+    ]
+    role_arn = None
+    for index in range(per_service):
+        role_name = f"benchmark-role-{index}"
+        role_arn = iam.create_role(
+            RoleName=role_name, AssumeRolePolicyDocument=json.dumps(TRUST_POLICY)
+        )["Role"]["Arn"]
+        iam.attach_role_policy(
+            RoleName=role_name, PolicyArn=policy_arns[index % len(policy_arns)]
+        )
+        iam.put_role_policy(
+            RoleName=role_name,
+            PolicyName="benchmark-inline",
+            PolicyDocument=policy_document(index),
+        )
+
+    ec2 = boto3.client("ec2", region_name=region_name)
+    remaining = per_service
+    while remaining:
+        count = min(remaining, 1000)
+        ec2.run_instances(
+            ImageId="ami-12c6146b",
+            MinCount=count,
+            MaxCount=count,
+            InstanceType="t3.micro",
+        )
+        remaining -= count
+
+    s3 = boto3.client("s3", region_name=region_name)
+    location = (
+        {}
+        if region_name == "us-east-1"
+        else {"CreateBucketConfiguration": {"LocationConstraint": region_name}}
+    )
+    for index in range(per_service):
+        s3.create_bucket(Bucket=f"benchmark-bucket-{index}", **location)
+
+    lambda_client = boto3.client("lambda", region_name=region_name)
+    package = lambda_package()
+    for index in range(per_service):
+        lambda_client.create_function(
+            FunctionName=f"benchmark-function-{index}",
+            Runtime="python3.12",
+            Role=role_arn,
+            Handler="handler.handler",
+            Code={"ZipFile": package},
+        )
+
+    sqs = boto3.client("sqs", region_name=region_name)
+    for index in range(per_service):
+        sqs.create_queue(QueueName=f"benchmark-queue-{index}")
+
+    return {service: per_service for service in SERVICES}
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=settings.BASE_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+class CallCounter:
+    """
+    Counts AWS API calls per operation and database queries across all threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.api_calls = Counter()
+        self.queries = 0
+
+    def wrap_api_call(self, make_api_call):
+        def counted(client, operation_name, api_params):
+            service_name = client.meta.service_model.service_name
+            with self.lock:
+                self.api_calls[f"{service_name}.{operation_name}"] += 1
+            return make_api_call(client, operation_name, api_params)
+
+        return counted
+
+    def count_query(self, execute, sql, params, many, context):
+        with self.lock:
+            self.queries += 1
+        return execute(sql, params, many, context)
+
+    def watch_connection(self, sender, connection, **kwargs):
+        # The main connection is reopened, and already counted, per test database
+        if self.count_query not in connection.execute_wrappers:
+            connection.execute_wrappers.append(self.count_query)
+
+    def reset(self):
+        with self.lock:
+            self.api_calls.clear()
+            self.queries = 0
+
+
+class Command(BaseCommand):
+    help = (
+        "Benchmarks populate_aws_resources against synthetic moto accounts and "
+        "writes wall time, API calls, DB queries and peak memory per size to a JSON "
+        "file"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            default=",".join(str(size) for size in DEFAULT_SIZES),
+            help="Comma separated account sizes, in total resources",
+        )
+        parser.add_argument("--region", default="us-east-1")
+        parser.add_argument(
+            "--runs",
+            type=int,
+            default=2,
+            help="Syncs per size; the first is cold, later ones are incremental",
+        )
+        parser.add_argument(
+            "--output",
+            help="Result file, defaults to data/benchmarks/inventory_sync-<commit>.json",
+        )
+
+    def handle(self, *args, **options):
+        if importlib.util.find_spec("moto") is None:
+            raise CommandError("The inventory sync benchmark requires moto")
+
+        sizes = [int(size) for size in options["sizes"].split(",") if size]
+        commit = git_commit()
+        output = options["output"] or os.path.join(
+            settings.DATA_DIR,
+            "benchmarks",
+            f"inventory_sync-{commit[:12] or 'local'}.json",
+        )
+
+        if len(sizes) == 1:
+            results = [self.benchmark(sizes[0], options["region"], options["runs"])]
+        else:
+            # Each size runs in its own process, starting from a clean interpreter
+            results = [
+                self.benchmark_in_subprocess(size, options["region"], options["runs"])
+                for size in sizes
+            ]
+
+        report = {
+            "benchmark": "inventory_sync",
+            "commit": commit,
+            "created_at": datetime.now(timezone.utc).isoformat(),
+            "database": connection.vendor,
+            "python": sys.version.split()[0],
+            "results": results,
+        }
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+        for result in results:
+            for run in result["runs"]:
+                print(
+                    f"size={result['size']} run={run['run']}: "
+                    f"{run['wall_time_seconds']:.2f}s, "
+                    f"{run['api_call_count']} API calls, "
+                    f"{run['db_query_count']} queries, "
+                    f"peak memory {run['peak_memory_kb']} KB"
+                )
+        print(f"Wrote benchmark results to {output}")
+
+    def benchmark_in_subprocess(self, size, region_name, runs):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            output = os.path.join(tmpdir, "result.json")
+            subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "django",
+                    "benchmark_inventory_sync",
+                    f"--sizes={size}",
+                    f"--region={region_name}",
+                    f"--runs={runs}",
+                    f"--output={output}",
+                ],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                env={**os.environ, "PYTHONPATH": os.pathsep.join(sys.path)},
+            )
+            with open(output, "r", encoding="utf-8") as f:
+                return json.load(f)["results"][0]
+
+    def benchmark(self, size, region_name, runs):
+        """
+        Builds a synthetic account of the given size and syncs it runs times into a
+        throwaway test database.
+        The syncs are then repeated into a fresh database with tracemalloc on, to
+        measure the peak memory each allocates apart from the account fixture;
+        tracing slows the sync several times over, so it is kept out of the timed
+        runs.
+        :return: A dictionary of the account built and the measurements of each run.
+        """
+        # pylint: disable=import-outside-toplevel
+        from moto import mock_aws
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            if connection.vendor == "sqlite":
+                # An in-memory database cannot be shared by the sync's threads
+                connection.settings_dict["TEST"]["NAME"] = os.path.join(
+                    tmpdir, "benchmark.sqlite3"
+                )
+            counter = CallCounter()
+            # Counted on the client class so that every session and client is covered
+            make_api_call = BaseClient._make_api_call
+            BaseClient._make_api_call = counter.wrap_api_call(make_api_call)
+            connection_created.connect(counter.watch_connection)
+            connection.execute_wrappers.append(counter.count_query)
+            try:
+                with mock_aws():
+                    started = time.perf_counter()
+                    resources = build_account(size, region_name)
+                    build_seconds = time.perf_counter() - started
+
+                    measurements = self.sync_runs(region_name, runs, counter)
+                    traced = self.sync_runs(region_name, runs, counter, trace=True)
+            finally:
+                connection.execute_wrappers.remove(counter.count_query)
+                connection_created.disconnect(counter.watch_connection)
+                BaseClient._make_api_call = make_api_call
+
+        for measurement, traced_measurement in zip(measurements, traced):
+            measurement["peak_memory_kb"] = traced_measurement["peak_memory_kb"]
+        return {
+            "size": size,
+            "region": region_name,
+            "resources": resources,
+            "build_seconds": build_seconds,
+            "runs": measurements,
+        }
+
+    def sync_runs(self, region_name, runs, counter, trace=False):
+        """
+        Syncs the account runs times into a new test database; the first sync is
+        cold, later ones are incremental.
+        :param trace: Record the peak memory allocated by each sync.
+        :return: A list of the measurements of each run.
+        """
+        old_name = connection.creation.create_test_db(
+            verbosity=0, autoclobber=True, serialize=False
+        )
+        measurements = []
+        try:
+            for run in range(1, runs + 1):
+                counter.reset()
+                if trace:
+                    tracemalloc.start()
+                started = time.perf_counter()
+                sync = populate_aws_resources(region_name)
+                wall_time = time.perf_counter() - started
+                measurement = {
+                    "run": run,
+                    "status": sync.status,
+                    "wall_time_seconds": wall_time,
+                    "api_call_count": sum(counter.api_calls.values()),
+                    "api_calls": dict(sorted(counter.api_calls.items())),
+                    "db_query_count": counter.queries,
+                    "counts": sync.counts,
+                }
+                if trace:
+                    measurement["peak_memory_kb"] = (
+                        tracemalloc.get_traced_memory()[1] // 1024
+                    )
+                    tracemalloc.stop()
+                measurements.append(measurement)
+        finally:
+            if tracemalloc.is_tracing():
+                tracemalloc.stop()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+        return measurements
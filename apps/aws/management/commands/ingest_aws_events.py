@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from apps.aws.events import run_event_worker
+
+
+class Command(BaseCommand):
+    help = (
+        "Long-polls an SQS queue of EventBridge/CloudTrail events and applies the "
+        "inventory changes they announce"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("queue_url")
+        parser.add_argument("--region", default="us-east-1")
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--wait-time", type=int, default=20)
+        parser.add_argument(
+            "--delete",
+            action="store_true",
+            help="Delete rows of removed resources instead of tombstoning them",
+        )
+
+    def handle(self, *args, **options):
+        run_event_worker(
+            options["queue_url"],
+            options["region"],
+            batch_size=options["batch_size"],
+            wait_time=options["wait_time"],
+            delete=options["delete"],
+        )
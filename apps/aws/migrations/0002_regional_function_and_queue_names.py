@@ -0,0 +1,31 @@
+# Generated by Django 5.1 on 2026-10-17 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aws", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="lambdafunction",
+            name="function_name",
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AlterField(
+            model_name="sqsqueue",
+            name="queue_name",
+            field=models.CharField(max_length=255),
+        ),
+        migrations.AlterUniqueTogether(
+            name="lambdafunction",
+            unique_together={("function_name", "region")},
+        ),
+        migrations.AlterUniqueTogether(
+            name="sqsqueue",
+            unique_together={("queue_name", "region")},
+        ),
+    ]
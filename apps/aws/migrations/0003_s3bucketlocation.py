@@ -0,0 +1,30 @@
+# Generated by Django 5.1 on 2026-10-17 19:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aws", "0002_regional_function_and_queue_names"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="S3BucketLocation",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("name", models.CharField(max_length=255, unique=True)),
+                ("region", models.CharField(max_length=20)),
+                ("creation_date", models.DateTimeField()),
+            ],
+        ),
+    ]
@@ -0,0 +1,39 @@
+# Generated by Django 5.1 on 2026-10-17 19:16
+
+from django.db import migrations, models
+from apps.aws.policies import policy_hash
+
+
+def hash_policy_documents(apps, schema_editor):
+    for model_name in ("IAMPolicy", "IAMInlinePolicy"):
+        model = apps.get_model("aws", model_name)
+        policies = list(model.objects.only("pk", "policy_document"))
+        for policy in policies:
+            policy.document_hash = policy_hash(policy.policy_document)
+        model.objects.bulk_update(policies, ["document_hash"], batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aws", "0004_inventory_sync"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="iaminlinepolicy",
+            name="document_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="iampolicy",
+            name="document_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="iamrole",
+            name="instance_profiles",
+            field=models.JSONField(blank=True, default=list),
+        ),
+        migrations.RunPython(hash_policy_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,93 @@
+# Generated by Django 5.1 on 2026-10-17 19:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aws", "0005_policy_hashes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="iampermission",
+            name="action_prefix",
+            field=models.CharField(default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="iampermission",
+            name="document_hash",
+            field=models.CharField(default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="iampermission",
+            name="effect",
+            field=models.CharField(
+                choices=[("Allow", "Allow"), ("Deny", "Deny")],
+                default="Allow",
+                max_length=5,
+            ),
+        ),
+        migrations.AddField(
+            model_name="iampermission",
+            name="inline_policy",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="permissions",
+                to="aws.iaminlinepolicy",
+            ),
+        ),
+        migrations.AddField(
+            model_name="iampermission",
+            name="not_action",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="iampermission",
+            name="not_resource",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="iampermission",
+            name="policy",
+            field=models.ForeignKey(
+                blank=True,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="permissions",
+                to="aws.iampolicy",
+            ),
+        ),
+        migrations.AddField(
+            model_name="iampermission",
+            name="resource_prefix",
+            field=models.CharField(default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="iampermission",
+            name="statement_index",
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name="iampermission",
+            name="resource",
+            field=models.CharField(max_length=2048),
+        ),
+        migrations.AddIndex(
+            model_name="iampermission",
+            index=models.Index(
+                fields=["action_prefix", "resource_prefix"],
+                name="aws_iamperm_action__152225_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="iampermission",
+            index=models.Index(
+                fields=["resource_prefix"], name="aws_iamperm_resourc_bbaf0c_idx"
+            ),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-17 19:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aws", "0006_iam_permission_statements"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="iampolicy",
+            name="arn",
+            field=models.CharField(max_length=255, unique=True),
+        ),
+        migrations.AlterField(
+            model_name="iampolicy",
+            name="policy_name",
+            field=models.CharField(max_length=255),
+        ),
+    ]
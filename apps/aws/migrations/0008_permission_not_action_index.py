@@ -0,0 +1,20 @@
+# Generated by Django 5.1 on 2026-10-17 19:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aws", "0007_policy_arn_key"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="iampermission",
+            index=models.Index(
+                fields=["not_action", "resource_prefix"],
+                name="aws_iamperm_not_act_5dccf3_idx",
+            ),
+        ),
+    ]
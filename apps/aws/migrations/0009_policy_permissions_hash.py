@@ -0,0 +1,23 @@
+# Generated by Django 5.1 on 2026-10-17 20:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("aws", "0008_permission_not_action_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="iaminlinepolicy",
+            name="permissions_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+        migrations.AddField(
+            model_name="iampolicy",
+            name="permissions_hash",
+            field=models.CharField(blank=True, default="", max_length=64),
+        ),
+    ]
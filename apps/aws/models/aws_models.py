@@ -1,8 +1,52 @@
 from django.db import models
-import boto3
+from apps.aws.clients import get_client
+from apps.aws.policies import load_policy, policy_hash
 
 
-class EC2Instance(models.Model):
+class InventorySync(models.Model):
+    STATUS_CHOICES = [
+        ("running", "Running"),
+        ("succeeded", "Succeeded"),
+        ("failed", "Failed"),
+    ]
+
+    started_at = models.DateTimeField(auto_now_add=True)
+    finished_at = models.DateTimeField(blank=True, null=True)
+    regions = models.JSONField(default=list)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="running")
+    # Inserted, updated, unchanged and deleted row counts per model
+    counts = models.JSONField(default=dict)
+
+    def __str__(self):
+        return f"Sync {self.pk}: {self.status}"
+
+    def record(self, model, counts):
+        totals = self.counts.setdefault(
+            model.__name__,
+            {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0},
+        )
+        for key in totals:
+            totals[key] += counts.get(key, 0)
+
+
+class SyncedModel(models.Model):
+    # Hash of the AWS data the row was last written from
+    fingerprint = models.CharField(max_length=64, blank=True, default="")
+    last_seen_sync = models.ForeignKey(
+        "InventorySync",
+        blank=True,
+        null=True,
+        on_delete=models.SET_NULL,
+        related_name="+",
+    )
+    # Set when a sync no longer finds the resource in AWS
+    deleted_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        abstract = True
+
+
+class EC2Instance(SyncedModel):
     instance_id = models.CharField(max_length=20, unique=True)
     name = models.CharField(max_length=255, blank=True, null=True)
     instance_type = models.CharField(max_length=20)
@@ -18,7 +62,7 @@ class EC2Instance(models.Model):
         return f"{self.name}" or f"{self.instance_id}"
 
 
-class S3Bucket(models.Model):
+class S3Bucket(SyncedModel):
     name = models.CharField(max_length=255, unique=True)
     region = models.CharField(max_length=20)
     creation_date = models.DateTimeField()
@@ -27,79 +71,162 @@ class S3Bucket(models.Model):
         return f"{self.name}"
 
 
-class IAMPolicy(models.Model):
-    policy_name = models.CharField(max_length=255, unique=True)
+class S3BucketLocation(models.Model):
+    # Region of every bucket in the account, kept across syncs so that
+    # get_bucket_location is only called for newly seen buckets
+    name = models.CharField(max_length=255, unique=True)
+    region = models.CharField(max_length=20)
+    creation_date = models.DateTimeField()
+
+    def __str__(self):
+        return f"{self.name}: {self.region}"
+
+
+class IAMPolicy(SyncedModel):
+    # A customer managed policy may share its name with an AWS managed one
+    policy_name = models.CharField(max_length=255)
     policy_id = models.CharField(max_length=128, unique=True)
-    arn = models.CharField(max_length=255)
+    arn = models.CharField(max_length=255, unique=True)
     create_date = models.DateTimeField()
     policy_document = models.JSONField()
+    # Hash of the canonical policy document, see apps.aws.policies
+    document_hash = models.CharField(max_length=64, blank=True, default="")
+    # document_hash the IAMPermission rows were last derived from, set even when
+    # the document has no statements, see apps.aws.access
+    permissions_hash = models.CharField(max_length=64, blank=True, default="")
 
     def __str__(self):
         return f"{self.policy_name}"
 
 
-class IAMInlinePolicy(models.Model):
+class IAMInlinePolicy(SyncedModel):
     role = models.ForeignKey(
         "IAMRole", related_name="inline_policies", on_delete=models.CASCADE
     )
     policy_name = models.CharField(max_length=255)
     policy_document = models.JSONField()
+    # Hash of the canonical policy document, see apps.aws.policies
+    document_hash = models.CharField(max_length=64, blank=True, default="")
+    # document_hash the IAMPermission rows were last derived from, set even when
+    # the document has no statements, see apps.aws.access
+    permissions_hash = models.CharField(max_length=64, blank=True, default="")
 
     def __str__(self):
         return f"{self.role.role_name} - {self.policy_name}"
 
 
-class IAMRole(models.Model):
+class IAMRole(SyncedModel):
     role_name = models.CharField(max_length=255, unique=True)
     role_id = models.CharField(max_length=128, unique=True)
     arn = models.CharField(max_length=255)
     create_date = models.DateTimeField()
     policies = models.ManyToManyField("IAMPolicy", related_name="roles")
+    instance_profiles = models.JSONField(default=list, blank=True)
     # Inline policies are linked through a ForeignKey in IAMInlinePolicy
 
     def __str__(self):
         return f"{self.role_name}"
 
     def sync_inline_policies(self, region):
-        client = boto3.client("iam", region_name=region)
-        policies = client.list_role_policies(RoleName=self.role_name)
-        for policy_name in policies["PolicyNames"]:
-            policy = client.get_role_policy(
-                RoleName=self.role_name, PolicyName=policy_name
-            )
-            IAMInlinePolicy.objects.update_or_create(
-                role=self,
-                policy_name=policy_name,
-                defaults={"policy_document": policy["PolicyDocument"]},
-            )
+        """
+        Makes the stored inline policies of the role match AWS, including deleting
+        those removed from it. Use apps.aws.aws_shared.sync_inline_policies to sync
+        many roles in one batch.
+        :return: A dictionary of inserted, updated, unchanged and deleted counts.
+        """
+        # pylint: disable=import-outside-toplevel
+        from apps.aws.aws_shared import sync_inline_policies
+
+        return sync_inline_policies([self], region)
 
     def attach_inline_policy(self, policy_name, policy_document, region):
-        client = boto3.client("iam", region_name=region)
+        """
+        Puts the inline policy on the role, unless the stored copy already holds
+        an equivalent document.
+        :return: True if the policy was written to IAM.
+        """
+        # pylint: disable=import-outside-toplevel
+        from apps.aws.access import refresh_permissions
+
+        document_hash = policy_hash(policy_document)
+        if IAMInlinePolicy.objects.filter(
+            role=self,
+            policy_name=policy_name,
+            document_hash=document_hash,
+            deleted_at__isnull=True,
+        ).exists():
+            return False
+
+        client = get_client("iam", region_name=region)
         client.put_role_policy(
             RoleName=self.role_name,
             PolicyName=policy_name,
             PolicyDocument=policy_document,
         )
-        IAMInlinePolicy.objects.create(
-            role=self, policy_name=policy_name, policy_document=policy_document
+        policy, _ = IAMInlinePolicy.objects.update_or_create(
+            role=self,
+            policy_name=policy_name,
+            defaults={
+                "policy_document": load_policy(policy_document),
+                "document_hash": document_hash,
+                "deleted_at": None,
+            },
         )
+        refresh_permissions(inline_policy_ids=[policy.pk])
+        return True
 
     def delete_inline_policy(self, policy_name, region):
-        client = boto3.client("iam", region_name=region)
+        client = get_client("iam", region_name=region)
         client.delete_role_policy(RoleName=self.role_name, PolicyName=policy_name)
         IAMInlinePolicy.objects.filter(role=self, policy_name=policy_name).delete()
 
 
 class IAMPermission(models.Model):
+    # One action and resource pair of a statement in a managed or inline policy,
+    # derived during syncs, see apps.aws.access
+    EFFECT_CHOICES = [
+        ("Allow", "Allow"),
+        ("Deny", "Deny"),
+    ]
+
+    policy = models.ForeignKey(
+        "IAMPolicy",
+        blank=True,
+        null=True,
+        related_name="permissions",
+        on_delete=models.CASCADE,
+    )
+    inline_policy = models.ForeignKey(
+        "IAMInlinePolicy",
+        blank=True,
+        null=True,
+        related_name="permissions",
+        on_delete=models.CASCADE,
+    )
+    # document_hash of the policy the rows were derived from
+    document_hash = models.CharField(max_length=64, default="")
+    statement_index = models.IntegerField(default=0)
+    effect = models.CharField(max_length=5, choices=EFFECT_CHOICES, default="Allow")
     action = models.CharField(max_length=255)
-    resource = models.CharField(max_length=255)
+    action_prefix = models.CharField(max_length=255, default="")
+    not_action = models.BooleanField(default=False)
+    resource = models.CharField(max_length=2048)
+    resource_prefix = models.CharField(max_length=255, default="")
+    not_resource = models.BooleanField(default=False)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["action_prefix", "resource_prefix"]),
+            models.Index(fields=["resource_prefix"]),
+            models.Index(fields=["not_action", "resource_prefix"]),
+        ]
 
     def __str__(self):
         return f"Action: {self.action}, Resource: {self.resource}"
 
 
-class LambdaFunction(models.Model):
-    function_name = models.CharField(max_length=255, unique=True)
+class LambdaFunction(SyncedModel):
+    function_name = models.CharField(max_length=255)
     function_arn = models.CharField(max_length=255, unique=True)
     runtime = models.CharField(max_length=64)
     handler = models.CharField(max_length=255)
@@ -111,12 +238,16 @@ class LambdaFunction(models.Model):
     last_modified = models.DateTimeField()
     region = models.CharField(max_length=64)
 
+    class Meta:
+        # Function names are only unique within a region
+        unique_together = ("function_name", "region")
+
     def __str__(self):
         return f"{self.function_name}"
 
 
-class SQSQueue(models.Model):
-    queue_name = models.CharField(max_length=255, unique=True)
+class SQSQueue(SyncedModel):
+    queue_name = models.CharField(max_length=255)
     queue_url = models.CharField(max_length=255, unique=True)
     region = models.CharField(max_length=64)
     arn = models.CharField(max_length=255, unique=True)
@@ -125,5 +256,9 @@ class SQSQueue(models.Model):
     maximum_message_size = models.IntegerField()
     message_retention_period = models.IntegerField()
 
+    class Meta:
+        # Queue names are only unique within a region
+        unique_together = ("queue_name", "region")
+
     def __str__(self):
         return f"{self.queue_name}"
@@ -1,11 +1,26 @@
 import os
 import json
-import time
-import boto3
 from django.conf import settings
+from django.core.cache import cache
 from django.db import models
 
 from qux.models import QuxModel
+from apps.aws.clients import get_client
+from apps.aws.policies import ROLE_POLICY_SIZE_LIMIT, compact_statements, policy_size
+from apps.aws.roles import (
+    ROLE_APPLY_CONCURRENCY,
+    add_role_to_instance_profile,
+    apply_roles,
+    associate_instance_profile,
+    create_instance_profile,
+    create_role,
+    put_inline_policy,
+    record_role,
+    role_drift,
+    run_step,
+    skip_step,
+    wait_for_instance_profile,
+)
 
 
 # Define a mapping of permissions to AWS actions based on resource types
@@ -47,6 +62,8 @@ PERMISSION_ACTIONS_MAP = {
     "sqs": {"all": "sqs:*"},
 }
 
+PERMISSION_INDEX_CACHE_KEY = "aws:permission_index"
+
 
 class Resource(QuxModel):
     ENVIRONMENT_CHOICES = [
@@ -87,48 +104,24 @@ class Application(QuxModel):
     def __str__(self):
         return f"{self.known_as}: ({self.repo_name})"
 
-    def generate_role(self, environment):
+    def build_role(self, environment, index=None):
         """
-        Generate a role with permissions for the application in the given environment.
-
-        Args:
-            environment (str): The environment (e.g., 'dev', 'prod', 'stage').
-
-        Returns:
-            str: Path to the JSON file containing the role with permissions.
+        Builds the role with permissions for the application in the given environment.
+        :param environment: The environment (e.g., 'dev', 'prod', 'stage').
+        :param index: Optional permission index, fetched from the cache by default.
+        :return: The role and its inline policy, or None if it has no permissions.
         """
         # Generate role name
         role_name = f"E9_{self.repo_name}_{environment}"
 
-        # Fetch application permissions for the given environment
-        app_permissions = ApplicationPermission.objects.filter(
-            application=self, resource__environment=environment
-        )
-
-        # Create permissions structure
-        permissions = []
-        for app_permission in app_permissions:
-            resource_type = app_permission.resource.resource_type.lower()
-            permission = app_permission.permission.name.lower()
-
-            # Get the AWS actions based on the resource type and permission
-            actions = PERMISSION_ACTIONS_MAP.get(resource_type, {}).get(permission, [])
-
-            if not actions:
-                print(
-                    f"Warning: No actions found for resource type '{resource_type}'"
-                    f"with permission '{permission}'."
-                )
-                continue
-
-            resource_arn = app_permission.resource.name
-
-            permission_entry = {
-                "Effect": "Allow",
-                "Action": actions,
-                "Resource": resource_arn,
-            }
-            permissions.append(permission_entry)
+        # Statements are compiled for every application once and cached
+        index = get_permission_index() if index is None else index
+        permissions, missing = index.get((self.pk, environment), ([], []))
+        for resource_type, permission in missing:
+            print(
+                f"Warning: No actions found for resource type '{resource_type}'"
+                f"with permission '{permission}'."
+            )
 
         if not permissions:
             print(
@@ -136,19 +129,47 @@ class Application(QuxModel):
             )
             return None
 
+        # Statements sharing the same actions become one multi-resource statement
+        compacted = compact_statements(permissions)
+        size = policy_size(compacted)
+        if len(compacted) < len(permissions):
+            print(
+                f"Compacted {len(permissions)} statements into {len(compacted)} for "
+                f"{role_name} ({policy_size(permissions)} -> {size} characters)."
+            )
+        if size > ROLE_POLICY_SIZE_LIMIT:
+            print(
+                f"Warning: The policy for {role_name} exceeds the "
+                f"{ROLE_POLICY_SIZE_LIMIT} character IAM limit."
+            )
+
         # Role structure with inline policy
-        role_data = {
+        return {
             "RoleName": role_name,
             "InlinePolicy": {
                 "PolicyName": f"{role_name}_policy",
-                "Permissions": permissions,
+                "Permissions": compacted,
             },
         }
 
+    def generate_role(self, environment):
+        """
+        Generate a role with permissions for the application in the given environment.
+
+        Args:
+            environment (str): The environment (e.g., 'dev', 'prod', 'stage').
+
+        Returns:
+            str: Path to the JSON file containing the role with permissions.
+        """
+        role_data = self.build_role(environment)
+        if role_data is None:
+            return None
+
         # Save to JSON file
         roles_dir = os.path.join(settings.DATA_DIR, "roles")
         os.makedirs(roles_dir, exist_ok=True)
-        json_file_path = os.path.join(roles_dir, f"{role_name}.json")
+        json_file_path = os.path.join(roles_dir, f"{role_data['RoleName']}.json")
         with open(json_file_path, "w", encoding="utf-8") as json_file:
             json.dump(role_data, json_file, indent=4)
 
@@ -162,10 +183,11 @@ class Application(QuxModel):
         :param json_file_name: Path to the JSON file containing the IAM role and inline policy details.
         :param ec2_instance_id: ID of the EC2 instance to which the IAM role will be attached.
         :param region: AWS region where the EC2 instance is located (default is 'us-west-2').
+        :return: Whether the role was attached, with the status and duration of each step.
         """
         # Initialize the boto3 clients for IAM and EC2
-        iam_client = boto3.client("iam", region_name=region)
-        ec2_client = boto3.client("ec2", region_name=region)
+        iam_client = get_client("iam", region_name=region)
+        ec2_client = get_client("ec2", region_name=region)
 
         # Read the JSON policy file
         try:
@@ -173,98 +195,120 @@ class Application(QuxModel):
                 policy_data = json.load(f)
         except FileNotFoundError:
             print(f"Error: The file '{json_file_name}' does not exist.")
-            return
+            return None
         except json.JSONDecodeError:
             print(f"Error: The file '{json_file_name}' is not a valid JSON file.")
-            return
+            return None
 
-        # Extract information from the JSON file
         role_name = policy_data["RoleName"]
-        policy_name = policy_data["InlinePolicy"]["PolicyName"]
-        permissions_policy = {
-            "Version": "2012-10-17",
-            "Statement": policy_data["InlinePolicy"]["Permissions"],
+        steps = []
+        result = {
+            "role_name": role_name,
+            "instance_id": ec2_instance_id,
+            "succeeded": False,
+            "steps": steps,
         }
 
-        # Trust policy JSON for EC2
-        trust_policy = {
-            "Version": "2012-10-17",
-            "Statement": [
-                {
-                    "Effect": "Allow",
-                    "Principal": {"Service": "ec2.amazonaws.com"},
-                    "Action": "sts:AssumeRole",
-                }
-            ],
-        }
+        # Only the parts that differ from the IAM inventory are written
+        reasons = role_drift([policy_data]).get(role_name, [])
+        created = profile_created = added = False
 
-        # Step 1: Create IAM Role
         try:
-            iam_client.create_role(
-                RoleName=role_name,
-                AssumeRolePolicyDocument=json.dumps(trust_policy),
-                Description=f"Role for EC2 with inline permissions for {role_name}",
-            )
-            print(f"IAM Role '{role_name}' created successfully.")
-        except iam_client.exceptions.EntityAlreadyExistsException:
-            print(f"IAM Role '{role_name}' already exists.")
+            # Step 1: Create IAM Role
+            if "role" in reasons:
+                created = run_step(
+                    steps, "create_role", create_role, iam_client, role_name
+                )
+                print(
+                    f"IAM Role '{role_name}' "
+                    + ("created successfully." if created else "already exists.")
+                )
+            else:
+                skip_step(steps, "create_role")
 
-        # Step 2: Attach Inline Policy to IAM Role
-        try:
-            iam_client.put_role_policy(
-                RoleName=role_name,
-                PolicyName=policy_name,
-                PolicyDocument=json.dumps(permissions_policy),
+            # Step 2: Attach Inline Policy to IAM Role
+            if "inline_policy" in reasons:
+                run_step(
+                    steps, "put_role_policy", put_inline_policy, iam_client, policy_data
+                )
+                print(f"Inline policy attached to IAM Role '{role_name}' successfully.")
+            else:
+                skip_step(steps, "put_role_policy")
+
+            # Step 3: Create an Instance Profile
+            # Step 4: Add the IAM Role to the Instance Profile
+            if "instance_profile" in reasons:
+                profile_created = run_step(
+                    steps,
+                    "create_instance_profile",
+                    create_instance_profile,
+                    iam_client,
+                    role_name,
+                )
+                print(
+                    f"IAM Instance Profile '{role_name}' "
+                    + (
+                        "created successfully."
+                        if profile_created
+                        else "already exists."
+                    )
+                )
+                added = run_step(
+                    steps,
+                    "add_role_to_instance_profile",
+                    add_role_to_instance_profile,
+                    iam_client,
+                    role_name,
+                )
+                if added:
+                    print(f"IAM Role '{role_name}' added to Instance Profile.")
+            else:
+                skip_step(steps, "create_instance_profile")
+                skip_step(steps, "add_role_to_instance_profile")
+
+            # Step 5: Wait for the Instance Profile, only if something was created
+            changed = created or profile_created or added
+            if changed:
+                run_step(
+                    steps,
+                    "wait_for_instance_profile",
+                    wait_for_instance_profile,
+                    iam_client,
+                    role_name,
+                )
+            else:
+                skip_step(steps, "wait_for_instance_profile")
+
+            # Step 6: Attach IAM Instance Profile to EC2 Instance
+            associated = run_step(
+                steps,
+                "associate_instance_profile",
+                associate_instance_profile,
+                ec2_client,
+                role_name,
+                ec2_instance_id,
+                retry=changed,
             )
             print(
-                f"Inline policy '{policy_name}' attached to IAM Role '{role_name}' successfully."
+                f"IAM Instance Profile '{role_name}' "
+                + ("attached to" if associated else "already attached to")
+                + f" EC2 Instance '{ec2_instance_id}'."
             )
-        except Exception as e:
-            print(f"Failed to attach inline policy to IAM Role: {e}")
-            return
-
-        # Step 3: Create an Instance Profile
-        try:
-            iam_client.create_instance_profile(InstanceProfileName=role_name)
-            print(f"IAM Instance Profile '{role_name}' created successfully.")
-        except iam_client.exceptions.EntityAlreadyExistsException:
-            print(f"IAM Instance Profile '{role_name}' already exists.")
 
-        # Wait for the Instance Profile to be created
-        time.sleep(5)  # Wait 5 seconds to ensure the instance profile is available
-
-        # Step 4: Add the IAM Role to the Instance Profile
-        try:
-            iam_client.add_role_to_instance_profile(
-                InstanceProfileName=role_name, RoleName=role_name
-            )
-            print(
-                f"IAM Role '{role_name}' added to Instance Profile '{role_name}' successfully."
-            )
-        except iam_client.exceptions.LimitExceededException:
-            print(f"Cannot add more roles to the Instance Profile '{role_name}'.")
+            if reasons:
+                run_step(steps, "record_role", record_role, iam_client, policy_data)
         except Exception as e:
-            print(f"Failed to add IAM Role to Instance Profile: {e}")
-            return
-
-        # Step 5: Attach IAM Instance Profile to EC2 Instance
-        try:
-            ec2_client.associate_iam_instance_profile(
-                IamInstanceProfile={"Name": role_name}, InstanceId=ec2_instance_id
-            )
-            print(
-                f"IAM Instance Profile '{role_name}' attached to EC2 Instance '{ec2_instance_id}' successfully."
-            )
-        except ec2_client.exceptions.ClientError as e:
-            print(f"Error attaching IAM Instance Profile to EC2 Instance: {e}")
+            print(f"Failed to attach IAM Role '{role_name}': {e}")
+            return result
 
-        # Example usage
-        # create_iam_role_and_attach("your_policy.json", "i-0abc123def456ghi7")
+        result["succeeded"] = True
+        return result
 
     def create_role_and_attach(self, ec2_instance_id, region, env):
         json_file_path = self.generate_role(env)
         if json_file_path:
-            self.attach_role(json_file_path, ec2_instance_id, region)
+            return self.attach_role(json_file_path, ec2_instance_id, region)
+        return None
 
 
 class Permission(QuxModel):
@@ -297,3 +341,108 @@ class ApplicationPermission(QuxModel):
 
     def __str__(self):
         return f"{self.application} - {self.resource} - {self.permission}"
+
+
+def build_permission_index():
+    """
+    Compiles the policy statements of every application and environment in a
+    single joined query.
+    :return: A dictionary mapping (application id, environment) to a tuple of the
+        statements and the (resource type, permission) pairs with no known actions.
+    """
+    index = {}
+    rows = ApplicationPermission.objects.order_by("pk").values_list(
+        "application_id",
+        "resource__environment",
+        "resource__resource_type",
+        "resource__name",
+        "permission__name",
+    )
+    for application_id, environment, resource_type, resource_arn, permission in rows:
+        resource_type = resource_type.lower()
+        permission = permission.lower()
+        statements, missing = index.setdefault((application_id, environment), ([], []))
+
+        # Get the AWS actions based on the resource type and permission
+        actions = PERMISSION_ACTIONS_MAP.get(resource_type, {}).get(permission, [])
+        if not actions:
+            missing.append((resource_type, permission))
+            continue
+
+        statements.append(
+            {
+                "Effect": "Allow",
+                "Action": actions,
+                "Resource": resource_arn,
+            }
+        )
+    return index
+
+
+def get_permission_index():
+    """
+    Returns the compiled permission index, building it on a cache miss.
+    The index is dropped by signals whenever a Resource, Permission or
+    ApplicationPermission is saved or deleted; with the default per-process cache
+    other processes only see changes once their copy expires.
+    """
+    index = cache.get(PERMISSION_INDEX_CACHE_KEY)
+    if index is None:
+        index = build_permission_index()
+        cache.set(PERMISSION_INDEX_CACHE_KEY, index)
+    return index
+
+
+def invalidate_permission_index():
+    cache.delete(PERMISSION_INDEX_CACHE_KEY)
+
+
+def generate_all_roles(environments=None):
+    """
+    Generates the roles of every application in every environment in one pass and
+    saves them to a single JSON file.
+    :param environments: Environments to generate roles for; defaults to all of them.
+    :return: Path to the JSON file containing the roles, or None if there are none.
+    """
+    environments = environments or [
+        environment for environment, _ in Resource.ENVIRONMENT_CHOICES
+    ]
+    index = get_permission_index()
+    # Only applications with permissions somewhere can produce a role
+    application_ids = {application_id for application_id, _ in index}
+
+    roles = []
+    for application in Application.objects.filter(pk__in=application_ids).order_by(
+        "pk"
+    ):
+        for environment in environments:
+            if (application.pk, environment) not in index:
+                continue
+            role_data = application.build_role(environment, index=index)
+            if role_data is not None:
+                roles.append(role_data)
+
+    if not roles:
+        print("No valid permissions generated for any application.")
+        return None
+
+    roles_dir = os.path.join(settings.DATA_DIR, "roles")
+    os.makedirs(roles_dir, exist_ok=True)
+    json_file_path = os.path.join(roles_dir, "roles.json")
+    with open(json_file_path, "w", encoding="utf-8") as json_file:
+        json.dump({"Roles": roles}, json_file, indent=4)
+
+    print(f"{len(roles)} roles with permissions saved to {json_file_path}")
+    return json_file_path
+
+
+def create_all_roles(region, environments=None, max_workers=ROLE_APPLY_CONCURRENCY):
+    """
+    Generates the roles of every application and environment and applies them,
+    with their instance profiles, to IAM concurrently.
+    :return: A dictionary mapping each role name to None, or the error raised.
+    """
+    json_file_path = generate_all_roles(environments)
+    if json_file_path is None:
+        return {}
+    return apply_roles(json_file_path, region, max_workers=max_workers)
@@ -0,0 +1,110 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from itertools import takewhile
+import queue
+import threading
+from django.db import connections
+from apps.aws.bulk import BATCH_SIZE, NATURAL_KEYS, bulk_upsert
+
+# Maximum number of batches waiting for the writer
+QUEUE_SIZE = 8
+
+
+def batched(rows, size):
+    """
+    Groups an iterable of rows into lists of at most size rows, lazily.
+    """
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def batch_scope(model, batch):
+    """
+    Returns a filter matching the existing rows for the natural keys in the batch.
+    """
+    return {
+        f"{field}__in": {row[field] for row in batch} for field in NATURAL_KEYS[model]
+    }
+
+
+def stream_upsert(
+    streams,
+    sync=None,
+    write_lock=None,
+    max_workers=None,
+    batch_size=BATCH_SIZE,
+    queue_size=QUEUE_SIZE,
+):
+    """
+    Writes streams of rows to the database with constant memory.
+    Each stream is consumed by its own producer thread, which cuts it into fixed-size
+    batches and puts them on a bounded queue; the calling thread is the single writer
+    and upserts one batch per transaction. Producers block while the queue is full,
+    so at most queue_size batches are held in memory, and fetching the next pages
+    from AWS overlaps with writing the previous ones.
+    :param streams: A list of (model, rows) tuples, where rows is a lazy iterable
+        of dictionaries as accepted by bulk_upsert, e.g. a generator over API pages.
+    :param sync: Optional InventorySync recording the rows seen and the change counts.
+    :param write_lock: Optional lock held while each batch is written.
+    :param max_workers: Maximum number of streams consumed at the same time.
+    :return: A dictionary of inserted, updated, unchanged and deleted counts per model.
+    """
+    done = object()
+    batches = queue.Queue(maxsize=queue_size)
+    # Set when the writer fails, so that producers stop fetching pages
+    stop = threading.Event()
+    errors = []
+
+    def produce(model, rows):
+        try:
+            rows = takewhile(lambda _: not stop.is_set(), rows)
+            for batch in batched(rows, batch_size):
+                if stop.is_set():
+                    break
+                batches.put((model, batch))
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connections.close_all()
+            batches.put((done, None))
+
+    counts = {}
+    with ThreadPoolExecutor(max_workers=max_workers or len(streams) or 1) as executor:
+        for model, rows in streams:
+            executor.submit(produce, model, rows)
+
+        remaining = len(streams)
+        try:
+            while remaining:
+                model, batch = batches.get()
+                if model is done:
+                    remaining -= 1
+                    continue
+                with write_lock or nullcontext():
+                    result = bulk_upsert(
+                        model, batch, scope=batch_scope(model, batch), sync=sync
+                    )
+                totals = counts.setdefault(
+                    model, {"inserted": 0, "updated": 0, "unchanged": 0, "deleted": 0}
+                )
+                for key in totals:
+                    totals[key] += result[key]
+        except BaseException:
+            stop.set()
+            # Producers blocked on the full queue only exit once it has room, and
+            # the executor waits for them; drain it until every one has finished
+            while remaining:
+                model, _ = batches.get()
+                if model is done:
+                    remaining -= 1
+            raise
+
+    if errors:
+        raise errors[0]
+    return counts
@@ -0,0 +1,150 @@
+import hashlib
+import json
+from urllib.parse import unquote
+
+# Statement elements holding one value or a list of values in any order
+LIST_ELEMENTS = ("Action", "NotAction", "Resource", "NotResource")
+
+
+def as_list(value):
+    return [value] if isinstance(value, str) else list(value or [])
+
+
+def load_policy(document):
+    """
+    Returns a policy document as a dictionary, decoding the URL-encoded JSON some
+    IAM APIs return.
+    """
+    if isinstance(document, str):
+        try:
+            return json.loads(document)
+        except ValueError:
+            return json.loads(unquote(document))
+    return document
+
+
+def canonical_policy(document):
+    """
+    Normalises a policy document so that documents granting the same permissions
+    compare equal: statements and their action and resource lists are sorted and
+    deduplicated, actions are lowercased (IAM matches them case-insensitively) and
+    statement ids and duplicate statements are dropped.
+    """
+    document = load_policy(document) or {}
+    statements = document.get("Statement") or []
+    # A policy with a single statement may hold it directly
+    if isinstance(statements, dict):
+        statements = [statements]
+
+    canonical = {}
+    for statement in statements:
+        statement = {key: value for key, value in statement.items() if key != "Sid"}
+        for key in LIST_ELEMENTS:
+            if key in statement:
+                values = as_list(statement[key])
+                if key.endswith("Action"):
+                    values = [value.lower() for value in values]
+                statement[key] = sorted(set(values))
+        canonical[json.dumps(statement, sort_keys=True)] = statement
+    return {
+        "Version": document.get("Version", "2008-10-17"),
+        "Statement": [canonical[key] for key in sorted(canonical)],
+    }
+
+
+def policy_hash(document):
+    """
+    Returns the sha256 of the canonical form of a policy document.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            canonical_policy(document), sort_keys=True, separators=(",", ":")
+        ).encode("utf-8")
+    ).hexdigest()
+
+
+# Longest indexed prefix of an action or resource pattern
+PREFIX_LENGTH = 255
+
+
+def pattern_prefix(pattern):
+    """
+    Returns the literal part of an IAM pattern before its first wildcard; a value
+    can only match the pattern if it starts with this prefix.
+    """
+    for index, char in enumerate(pattern):
+        if char in "*?":
+            return pattern[:index][:PREFIX_LENGTH]
+    return pattern[:PREFIX_LENGTH]
+
+
+def flatten_policy(document):
+    """
+    Yields one entry per action and resource pair of every statement in a policy.
+    Statements using NotAction or NotResource yield the excluded patterns with
+    not_action or not_resource set. Conditions are not kept.
+    """
+    for index, statement in enumerate(canonical_policy(document)["Statement"]):
+        not_action = "NotAction" in statement
+        not_resource = "NotResource" in statement
+        actions = statement.get("NotAction" if not_action else "Action", [])
+        resources = statement.get("NotResource" if not_resource else "Resource", ["*"])
+        for action in actions:
+            for resource in resources:
+                yield {
+                    "statement_index": index,
+                    "effect": statement.get("Effect", "Allow"),
+                    "action": action,
+                    "action_prefix": pattern_prefix(action),
+                    "not_action": not_action,
+                    "resource": resource,
+                    "resource_prefix": pattern_prefix(resource),
+                    "not_resource": not_resource,
+                }
+
+
+# Maximum size of the inline policies of a role, not counting whitespace
+ROLE_POLICY_SIZE_LIMIT = 10240
+
+
+def policy_size(statements):
+    return len(
+        json.dumps(
+            {"Version": "2012-10-17", "Statement": statements}, separators=(",", ":")
+        )
+    )
+
+
+def compact_statements(statements):
+    """
+    Merges statements with the same effect and set of actions into a single
+    statement over all of their resources, with duplicate actions and resources
+    removed. Statements with any other elements are kept as they are.
+    :param statements: A list of policy statements.
+    :return: The compacted list of statements, in order of first appearance.
+    """
+    merged = {}
+    compacted = []
+    for statement in statements:
+        if set(statement) - {"Effect", "Action", "Resource"}:
+            if statement not in compacted:
+                compacted.append(statement)
+            continue
+        actions = sorted(set(as_list(statement["Action"])))
+        key = (statement["Effect"], tuple(actions))
+        if key not in merged:
+            merged[key] = {
+                "Effect": statement["Effect"],
+                "Action": actions,
+                "Resource": [],
+            }
+            compacted.append(merged[key])
+        merged[key]["Resource"].extend(as_list(statement["Resource"]))
+
+    for statement in merged.values():
+        resources = sorted(set(statement["Resource"]))
+        # A wildcard resource already covers every other resource
+        if "*" in resources:
+            resources = ["*"]
+        statement["Resource"] = resources[0] if len(resources) == 1 else resources
+    return compacted
@@ -0,0 +1,343 @@
+from concurrent.futures import ThreadPoolExecutor
+import json
+import time
+from apps.aws.access import refresh_permissions
+from apps.aws.clients import get_client
+from apps.aws.bulk import BATCH_SIZE, chunked
+from apps.aws.models.aws_models import IAMRole, IAMInlinePolicy
+from apps.aws.policies import policy_hash
+
+# Maximum number of roles applied to IAM at the same time
+ROLE_APPLY_CONCURRENCY = 8
+
+# Seconds, at one check per second, to wait for a new instance profile
+INSTANCE_PROFILE_WAIT_ATTEMPTS = 20
+
+# Trust policy JSON for EC2
+EC2_TRUST_POLICY = {
+    "Version": "2012-10-17",
+    "Statement": [
+        {
+            "Effect": "Allow",
+            "Principal": {"Service": "ec2.amazonaws.com"},
+            "Action": "sts:AssumeRole",
+        }
+    ],
+}
+
+
+def permissions_policy(role_data):
+    return {
+        "Version": "2012-10-17",
+        "Statement": role_data["InlinePolicy"]["Permissions"],
+    }
+
+
+def create_role(iam_client, role_name):
+    """
+    :return: True if the role was created, False if it already existed.
+    """
+    try:
+        iam_client.create_role(
+            RoleName=role_name,
+            AssumeRolePolicyDocument=json.dumps(EC2_TRUST_POLICY),
+            Description=f"Role for EC2 with inline permissions for {role_name}",
+        )
+    except iam_client.exceptions.EntityAlreadyExistsException:
+        return False
+    return True
+
+
+def put_inline_policy(iam_client, role_data):
+    iam_client.put_role_policy(
+        RoleName=role_data["RoleName"],
+        PolicyName=role_data["InlinePolicy"]["PolicyName"],
+        PolicyDocument=json.dumps(permissions_policy(role_data)),
+    )
+
+
+def create_instance_profile(iam_client, role_name):
+    """
+    :return: True if the instance profile was created, False if it already existed.
+    """
+    try:
+        iam_client.create_instance_profile(InstanceProfileName=role_name)
+    except iam_client.exceptions.EntityAlreadyExistsException:
+        return False
+    return True
+
+
+def add_role_to_instance_profile(iam_client, role_name):
+    """
+    :return: True if the role was added, False if the profile already holds a role.
+    """
+    try:
+        iam_client.add_role_to_instance_profile(
+            InstanceProfileName=role_name, RoleName=role_name
+        )
+    except iam_client.exceptions.LimitExceededException:
+        # An instance profile holds a single role
+        return False
+    return True
+
+
+def role_drift(roles):
+    """
+    Compares generated roles with the IAM inventory, without calling AWS.
+    A role differs in "role" if it is not in the inventory, in "inline_policy" if
+    the stored inline policy hashes differently, and in "instance_profile" if the
+    role is not in its instance profile.
+    :param roles: A list of roles as written by Application.generate_role.
+    :return: A dictionary mapping the name of each role that differs to a list of
+        what differs; roles in sync are left out.
+    """
+    names = [role_data["RoleName"] for role_data in roles]
+    stored, hashes = {}, {}
+    for batch in chunked(names, BATCH_SIZE):
+        for role in IAMRole.objects.filter(
+            role_name__in=batch, deleted_at__isnull=True
+        ).only("role_name", "instance_profiles"):
+            stored[role.role_name] = role
+        for role_name, policy_name, document_hash in IAMInlinePolicy.objects.filter(
+            role__role_name__in=batch, deleted_at__isnull=True
+        ).values_list("role__role_name", "policy_name", "document_hash"):
+            hashes[(role_name, policy_name)] = document_hash
+
+    drift = {}
+    for role_data in roles:
+        role_name = role_data["RoleName"]
+        role = stored.get(role_name)
+        if role is None:
+            drift[role_name] = ["role", "inline_policy", "instance_profile"]
+            continue
+        reasons = []
+        key = (role_name, role_data["InlinePolicy"]["PolicyName"])
+        if hashes.get(key) != policy_hash(permissions_policy(role_data)):
+            reasons.append("inline_policy")
+        if role_name not in role.instance_profiles:
+            reasons.append("instance_profile")
+        if reasons:
+            drift[role_name] = reasons
+    return drift
+
+
+def drift_report(json_file_name):
+    """
+    Lists the roles in a roles file that differ from the IAM inventory.
+    :param json_file_name: Path to a file written by generate_all_roles.
+    :return: A dictionary mapping each role that differs to a list of what differs.
+    """
+    with open(json_file_name, "r", encoding="utf-8") as f:
+        drift = role_drift(json.load(f)["Roles"])
+    for role_name, reasons in drift.items():
+        print(f"IAM Role '{role_name}' differs: {', '.join(reasons)}")
+    return drift
+
+
+def apply_role(iam_client, role_data, reasons=None):
+    """
+    Creates the role, its inline policy and its instance profile, reusing the role
+    and instance profile if they already exist.
+    :param iam_client: boto3 IAM client.
+    :param role_data: A role as written by Application.generate_role.
+    :param reasons: What differs, as reported by role_drift; only the matching
+        calls are made. Everything is applied when None.
+    :return: True if anything other than the inline policy was created.
+    """
+    reasons = (
+        ["role", "inline_policy", "instance_profile"] if reasons is None else reasons
+    )
+    role_name = role_data["RoleName"]
+    created = profile_created = added = False
+    if "role" in reasons:
+        created = create_role(iam_client, role_name)
+    if "inline_policy" in reasons:
+        put_inline_policy(iam_client, role_data)
+    if "instance_profile" in reasons:
+        profile_created = create_instance_profile(iam_client, role_name)
+        added = add_role_to_instance_profile(iam_client, role_name)
+    return created or profile_created or added
+
+
+def record_role(iam_client, role_data, refresh=True):
+    """
+    Writes an applied role through to the IAM inventory, so that the next drift
+    check sees it in sync without waiting for a sync.
+    :param refresh: Re-derive the permissions of the changed inline policy; pass
+        False when recording many roles and call refresh_permissions once after.
+    :return: The recorded IAMInlinePolicy.
+    """
+    role_name = role_data["RoleName"]
+    role = IAMRole.objects.filter(role_name=role_name, deleted_at__isnull=True).first()
+    if role is None:
+        data = iam_client.get_role(RoleName=role_name)["Role"]
+        role, _ = IAMRole.objects.update_or_create(
+            role_name=role_name,
+            defaults={
+                "role_id": data["RoleId"],
+                "arn": data["Arn"],
+                "create_date": data["CreateDate"],
+                "deleted_at": None,
+            },
+        )
+    if role_name not in role.instance_profiles:
+        role.instance_profiles = [*role.instance_profiles, role_name]
+        role.save(update_fields=["instance_profiles"])
+
+    document = permissions_policy(role_data)
+    policy, _ = IAMInlinePolicy.objects.update_or_create(
+        role=role,
+        policy_name=role_data["InlinePolicy"]["PolicyName"],
+        defaults={
+            "policy_document": document,
+            "document_hash": policy_hash(document),
+            "deleted_at": None,
+        },
+    )
+    if refresh:
+        refresh_permissions(inline_policy_ids=[policy.pk])
+    return policy
+
+
+def wait_for_instance_profile(iam_client, role_name):
+    iam_client.get_waiter("instance_profile_exists").wait(
+        InstanceProfileName=role_name,
+        WaiterConfig={"Delay": 1, "MaxAttempts": INSTANCE_PROFILE_WAIT_ATTEMPTS},
+    )
+
+
+def retry_with_backoff(func, should_retry, attempts=5, base_delay=0.5, max_delay=8):
+    """
+    Calls func until it succeeds, sleeping exponentially longer between attempts
+    while should_retry(error) holds for the error raised.
+    :return: What func returned, or None if attempts is not positive.
+    """
+    for attempt in range(attempts):
+        try:
+            return func()
+        except Exception as e:
+            if attempt == attempts - 1 or not should_retry(e):
+                raise
+            time.sleep(min(max_delay, base_delay * 2**attempt))
+    return None
+
+
+def associate_instance_profile(ec2_client, role_name, instance_id, retry=False):
+    """
+    Associates the instance profile with an EC2 instance, unless it already is.
+    :param retry: Retry with backoff while EC2 does not see a newly created
+        instance profile yet.
+    :return: True if the association was made, False if it already existed.
+    """
+    associations = ec2_client.describe_iam_instance_profile_associations(
+        Filters=[
+            {"Name": "instance-id", "Values": [instance_id]},
+            {"Name": "state", "Values": ["associating", "associated"]},
+        ]
+    )["IamInstanceProfileAssociations"]
+    if any(
+        association["IamInstanceProfile"]["Arn"].endswith(f"/{role_name}")
+        for association in associations
+    ):
+        return False
+
+    def associate():
+        ec2_client.associate_iam_instance_profile(
+            IamInstanceProfile={"Name": role_name}, InstanceId=instance_id
+        )
+
+    # IAM changes take a few seconds to become visible to EC2
+    retry_with_backoff(
+        associate,
+        lambda e: retry
+        and getattr(e, "response", {}).get("Error", {}).get("Code")
+        == "InvalidParameterValue",
+    )
+    return True
+
+
+def run_step(steps, name, func, *args, **kwargs):
+    """
+    Runs one step of a pipeline and appends its status and duration to steps.
+    """
+    started = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+    except Exception as e:
+        steps.append(
+            {
+                "step": name,
+                "status": "failed",
+                "seconds": time.perf_counter() - started,
+                "error": str(e),
+            }
+        )
+        raise
+    steps.append(
+        {"step": name, "status": "ok", "seconds": time.perf_counter() - started}
+    )
+    return result
+
+
+def skip_step(steps, name):
+    steps.append({"step": name, "status": "skipped", "seconds": 0})
+
+
+def apply_roles(json_file_name, region, max_workers=ROLE_APPLY_CONCURRENCY):
+    """
+    Applies every role in a consolidated roles file to IAM concurrently.
+    A failure is recorded against its role and does not stop the other roles.
+    :param json_file_name: Path to the file written by generate_all_roles.
+    :param region: AWS region used for the IAM client.
+    :param max_workers: Maximum number of roles applied at the same time.
+    :return: A dictionary mapping each role name to None, or the error raised.
+        Roles that already match the IAM inventory are skipped.
+    """
+    with open(json_file_name, "r", encoding="utf-8") as f:
+        roles = json.load(f)["Roles"]
+
+    # Roles already matching the inventory need no IAM calls at all
+    drift = role_drift(roles)
+    for role_name, reasons in drift.items():
+        print(f"IAM Role '{role_name}' differs: {', '.join(reasons)}")
+    changed = [role_data for role_data in roles if role_data["RoleName"] in drift]
+
+    # boto3 clients are thread-safe, so the workers share one
+    iam_client = get_client("iam", region_name=region)
+
+    def apply(role_data):
+        try:
+            apply_role(iam_client, role_data, drift[role_data["RoleName"]])
+        except Exception as e:
+            return e
+        return None
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        errors = dict(
+            zip(
+                [role_data["RoleName"] for role_data in changed],
+                executor.map(apply, changed),
+            )
+        )
+
+    results = {role_data["RoleName"]: None for role_data in roles}
+    recorded = []
+    for role_data in changed:
+        role_name = role_data["RoleName"]
+        if errors[role_name] is None:
+            try:
+                recorded.append(record_role(iam_client, role_data, refresh=False).pk)
+            except Exception as e:
+                errors[role_name] = e
+        results[role_name] = errors[role_name]
+    if recorded:
+        refresh_permissions(inline_policy_ids=recorded)
+
+    failed = {name: error for name, error in results.items() if error}
+    for role_name, error in failed.items():
+        print(f"Failed to apply IAM Role '{role_name}': {error}")
+    print(
+        f"Applied {len(changed) - len(failed)} of {len(changed)} changed IAM Roles; "
+        f"{len(roles) - len(changed)} unchanged."
+    )
+    return results
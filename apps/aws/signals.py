@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from apps.aws.models.models import (
+    Resource,
+    Permission,
+    ApplicationPermission,
+    invalidate_permission_index,
+)
+
+
+@receiver(post_save, sender=Resource)
+@receiver(post_delete, sender=Resource)
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+@receiver(post_save, sender=ApplicationPermission)
+@receiver(post_delete, sender=ApplicationPermission)
+def permission_index_changed(sender, **kwargs):
+    invalidate_permission_index()
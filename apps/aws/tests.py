@@ -0,0 +1,647 @@
+import json
+import os
+import tempfile
+import threading
+from unittest import mock
+from urllib.parse import quote
+from django.test import TestCase
+from django.utils import timezone
+from moto import mock_aws
+from apps.aws.access import refresh_permissions, roles_allowed
+from apps.aws.aws_shared import populate_iam
+from apps.aws.bulk import bulk_upsert, sweep_unseen
+from apps.aws.clients import clear_clients, get_client
+from apps.aws.events import run_event_worker
+from apps.aws.models.aws_models import (
+    EC2Instance,
+    IAMInlinePolicy,
+    IAMPolicy,
+    IAMRole,
+    InventorySync,
+    SQSQueue,
+)
+from apps.aws.pipeline import stream_upsert
+from apps.aws.policies import policy_hash
+from apps.aws.roles import apply_roles, apply_role, record_role, role_drift
+
+REGION = "us-east-1"
+
+
+def cloudtrail_event(event_name, **detail):
+    """
+    :return: The body of an EventBridge "AWS API Call via CloudTrail" event.
+    """
+    return json.dumps(
+        {
+            "detail-type": "AWS API Call via CloudTrail",
+            "region": REGION,
+            "detail": {"eventName": event_name, "awsRegion": REGION, **detail},
+        }
+    )
+
+
+def queue_row(name, region=REGION, visibility_timeout=30):
+    return {
+        "queue_name": name,
+        "queue_url": f"https://sqs.{region}.amazonaws.com/123456789012/{name}",
+        "region": region,
+        "arn": f"arn:aws:sqs:{region}:123456789012:{name}",
+        "created_timestamp": "2024-01-01T00:00:00+00:00",
+        "visibility_timeout": visibility_timeout,
+        "maximum_message_size": 262144,
+        "message_retention_period": 345600,
+    }
+
+
+class BulkUpsertTests(TestCase):
+    def test_writes_only_changed_rows(self):
+        counts = bulk_upsert(SQSQueue, [queue_row("a"), queue_row("b")])
+        self.assertEqual((counts["inserted"], counts["updated"]), (2, 0))
+
+        counts = bulk_upsert(
+            SQSQueue, [queue_row("a"), queue_row("b", visibility_timeout=60)]
+        )
+        self.assertEqual(
+            (counts["inserted"], counts["updated"], counts["unchanged"]), (0, 1, 1)
+        )
+        self.assertEqual(SQSQueue.objects.get(queue_name="b").visibility_timeout, 60)
+
+    def test_records_rows_seen_by_sync(self):
+        bulk_upsert(SQSQueue, [queue_row("a")])
+        sync = InventorySync.objects.create()
+
+        counts = bulk_upsert(SQSQueue, [queue_row("a")], sync=sync)
+
+        self.assertEqual(counts["unchanged"], 1)
+        self.assertEqual(SQSQueue.objects.get().last_seen_sync, sync)
+        self.assertEqual(sync.counts["SQSQueue"]["unchanged"], 1)
+
+    def test_revives_tombstoned_row(self):
+        bulk_upsert(SQSQueue, [queue_row("a")])
+        SQSQueue.objects.update(deleted_at=timezone.now())
+
+        counts = bulk_upsert(SQSQueue, [queue_row("a")])
+
+        self.assertEqual(counts["updated"], 1)
+        self.assertIsNone(SQSQueue.objects.get().deleted_at)
+
+    def test_delete_missing_stays_in_scope(self):
+        bulk_upsert(
+            SQSQueue,
+            [queue_row("a"), queue_row("b"), queue_row("c", region="eu-west-1")],
+        )
+
+        counts = bulk_upsert(
+            SQSQueue,
+            [queue_row("a")],
+            scope={"region": REGION},
+            delete_missing=True,
+        )
+
+        self.assertEqual(counts["deleted"], 1)
+        self.assertEqual(
+            set(SQSQueue.objects.values_list("queue_name", flat=True)), {"a", "c"}
+        )
+
+
+class SweepUnseenTests(TestCase):
+    def setUp(self):
+        bulk_upsert(
+            SQSQueue,
+            [queue_row("a"), queue_row("b"), queue_row("c", region="eu-west-1")],
+        )
+        self.sync = InventorySync.objects.create()
+        bulk_upsert(SQSQueue, [queue_row("a")], sync=self.sync)
+
+    def test_tombstones_unseen_rows_in_scope(self):
+        swept = sweep_unseen(SQSQueue, self.sync, scope={"region": REGION})
+
+        self.assertEqual(swept, 1)
+        tombstoned = SQSQueue.objects.filter(deleted_at__isnull=False)
+        self.assertEqual(list(tombstoned.values_list("queue_name", flat=True)), ["b"])
+        self.assertEqual(self.sync.counts["SQSQueue"]["deleted"], 1)
+
+        # Rows already tombstoned are not counted again
+        self.assertEqual(sweep_unseen(SQSQueue, self.sync, scope={"region": REGION}), 0)
+
+    def test_deletes_unseen_rows(self):
+        swept = sweep_unseen(SQSQueue, self.sync, delete=True)
+
+        self.assertEqual(swept, 2)
+        self.assertEqual(
+            list(SQSQueue.objects.values_list("queue_name", flat=True)), ["a"]
+        )
+
+
+class StreamUpsertTests(TestCase):
+    def test_writer_failure_stops_producers(self):
+        fetched = []
+
+        def rows(stream):
+            for index in range(1000):
+                fetched.append(stream)
+                yield {"queue_name": f"q{stream}-{index}", "region": "us-east-1"}
+
+        writes = []
+
+        def write(model, batch, **kwargs):
+            writes.append(len(batch))
+            if len(writes) == 2:
+                raise RuntimeError("write failed")
+            return {"inserted": len(batch), "updated": 0, "unchanged": 0, "deleted": 0}
+
+        outcome = {}
+
+        def sync():
+            try:
+                stream_upsert(
+                    [(SQSQueue, rows(stream)) for stream in range(3)],
+                    batch_size=10,
+                    queue_size=1,
+                )
+            except RuntimeError as e:
+                outcome["error"] = e
+
+        with mock.patch("apps.aws.pipeline.bulk_upsert", side_effect=write):
+            thread = threading.Thread(target=sync, daemon=True)
+            thread.start()
+            thread.join(10)
+
+        self.assertFalse(thread.is_alive(), "stream_upsert hung after a failed write")
+        self.assertEqual(str(outcome.get("error")), "write failed")
+        # Producers stopped fetching instead of reading their streams to the end
+        self.assertLess(len(fetched), 3000)
+
+
+class EventWorkerTests(TestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        # Shared clients created outside the mock would carry real credentials
+        clear_clients()
+        self.addCleanup(clear_clients)
+        self.sqs = get_client("sqs", region_name=REGION)
+        self.queue_url = self.sqs.create_queue(QueueName="inventory-events")["QueueUrl"]
+
+    def send(self, *bodies):
+        for body in bodies:
+            self.sqs.send_message(QueueUrl=self.queue_url, MessageBody=body)
+
+    def run_worker(self, max_polls=1):
+        return run_event_worker(
+            self.queue_url,
+            REGION,
+            sqs_client=self.sqs,
+            wait_time=0,
+            max_polls=max_polls,
+        )
+
+    def assert_queue_empty(self):
+        attributes = self.sqs.get_queue_attributes(
+            QueueUrl=self.queue_url,
+            AttributeNames=[
+                "ApproximateNumberOfMessages",
+                "ApproximateNumberOfMessagesNotVisible",
+            ],
+        )["Attributes"]
+        self.assertEqual(attributes["ApproximateNumberOfMessages"], "0")
+        self.assertEqual(attributes["ApproximateNumberOfMessagesNotVisible"], "0")
+
+    def test_run_instances_inserts_row(self):
+        instance_id = get_client("ec2", region_name=REGION).run_instances(
+            ImageId="ami-12c6146b", MinCount=1, MaxCount=1
+        )["Instances"][0]["InstanceId"]
+        self.send(
+            cloudtrail_event(
+                "RunInstances",
+                responseElements={
+                    "instancesSet": {"items": [{"instanceId": instance_id}]}
+                },
+            )
+        )
+
+        counts = self.run_worker()
+
+        self.assertEqual(counts[EC2Instance]["inserted"], 1)
+        instance = EC2Instance.objects.get(instance_id=instance_id)
+        self.assertEqual(instance.region, REGION)
+        self.assertIsNone(instance.deleted_at)
+        self.assert_queue_empty()
+
+    def test_terminate_instances_tombstones_row(self):
+        # An instance EC2 no longer describes, e.g. one terminated an hour ago
+        EC2Instance.objects.create(
+            instance_id="i-0123456789abcdef0",
+            instance_type="t3.micro",
+            region=REGION,
+            availability_zone=f"{REGION}a",
+            state="running",
+            launch_time=timezone.now(),
+        )
+        self.send(
+            cloudtrail_event(
+                "TerminateInstances",
+                requestParameters={
+                    "instancesSet": {"items": [{"instanceId": "i-0123456789abcdef0"}]}
+                },
+            )
+        )
+
+        counts = self.run_worker()
+
+        self.assertEqual(counts[EC2Instance]["deleted"], 1)
+        instance = EC2Instance.objects.get(instance_id="i-0123456789abcdef0")
+        self.assertIsNotNone(instance.deleted_at)
+
+    def test_create_and_delete_queue(self):
+        url = self.sqs.create_queue(QueueName="orders")["QueueUrl"]
+        self.send(cloudtrail_event("CreateQueue", responseElements={"queueUrl": url}))
+
+        counts = self.run_worker()
+
+        self.assertEqual(counts[SQSQueue]["inserted"], 1)
+        self.assertIsNone(SQSQueue.objects.get(queue_url=url).deleted_at)
+
+        self.sqs.delete_queue(QueueUrl=url)
+        self.send(cloudtrail_event("DeleteQueue", requestParameters={"queueUrl": url}))
+
+        counts = self.run_worker()
+
+        self.assertEqual(counts[SQSQueue]["deleted"], 1)
+        self.assertIsNotNone(SQSQueue.objects.get(queue_url=url).deleted_at)
+        self.assert_queue_empty()
+
+    def test_malformed_messages_are_deleted(self):
+        url = self.sqs.create_queue(QueueName="orders")["QueueUrl"]
+        self.send(
+            "not json",
+            json.dumps(["not", "an", "event"]),
+            cloudtrail_event("CreateQueue", responseElements={}),
+            cloudtrail_event("DescribeInstances"),
+        )
+        self.send(cloudtrail_event("CreateQueue", responseElements={"queueUrl": url}))
+
+        counts = self.run_worker(max_polls=2)
+
+        self.assertEqual(counts[SQSQueue]["inserted"], 1)
+        self.assertTrue(SQSQueue.objects.filter(queue_url=url).exists())
+        self.assert_queue_empty()
+
+
+class PolicyHashTests(TestCase):
+    def test_equivalent_documents_hash_equal(self):
+        document = {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Sid": "Read",
+                    "Effect": "Allow",
+                    "Action": ["s3:GetObject", "s3:ListBucket"],
+                    "Resource": "*",
+                },
+                {"Effect": "Deny", "Action": "iam:*", "Resource": "*"},
+            ],
+        }
+        reordered = {
+            "Version": "2012-10-17",
+            "Statement": [
+                {"Effect": "Deny", "Action": ["IAM:*"], "Resource": ["*"]},
+                {
+                    "Effect": "Allow",
+                    "Action": ["s3:listbucket", "s3:GetObject", "s3:GetObject"],
+                    "Resource": ["*"],
+                },
+                {"Effect": "Deny", "Action": "iam:*", "Resource": "*"},
+            ],
+        }
+        self.assertEqual(policy_hash(document), policy_hash(reordered))
+        # IAM APIs return documents as URL-encoded JSON
+        self.assertEqual(
+            policy_hash(document), policy_hash(quote(json.dumps(document)))
+        )
+
+    def test_different_documents_hash_differently(self):
+        def document(action="s3:GetObject", resource="arn:aws:s3:::bucket/*"):
+            return {
+                "Version": "2012-10-17",
+                "Statement": {
+                    "Effect": "Allow",
+                    "Action": action,
+                    "Resource": resource,
+                },
+            }
+
+        self.assertNotEqual(
+            policy_hash(document()), policy_hash(document(action="s3:PutObject"))
+        )
+        # Resource ARNs, unlike actions, are case-sensitive
+        self.assertNotEqual(
+            policy_hash(document()),
+            policy_hash(document(resource="arn:aws:s3:::Bucket/*")),
+        )
+
+
+def policy_document(*statements):
+    return {"Version": "2012-10-17", "Statement": list(statements)}
+
+
+class RolesAllowedTests(TestCase):
+    def setUp(self):
+        self.roles = {
+            name: IAMRole.objects.create(
+                role_name=name,
+                role_id=f"AROA{name.upper()}",
+                arn=f"arn:aws:iam::123456789012:role/{name}",
+                create_date=timezone.now(),
+            )
+            for name in ("reader", "writer", "admin", "restricted")
+        }
+        read_only = IAMPolicy.objects.create(
+            policy_name="S3ReadOnly",
+            policy_id="ANPAREADONLY",
+            arn="arn:aws:iam::aws:policy/S3ReadOnly",
+            create_date=timezone.now(),
+            policy_document=policy_document(
+                {"Effect": "Allow", "Action": "s3:Get*", "Resource": "*"}
+            ),
+        )
+        for name in ("reader", "restricted"):
+            self.roles[name].policies.add(read_only)
+        self.inline_policy(
+            "writer",
+            {
+                "Effect": "Allow",
+                "Action": ["s3:GetObject", "s3:PutObject"],
+                "Resource": "arn:aws:s3:::uploads/*",
+            },
+        )
+        self.inline_policy(
+            "admin",
+            {"Effect": "Allow", "Action": "*", "Resource": "*"},
+            {"Effect": "Deny", "NotAction": "s3:*", "Resource": "*"},
+        )
+        self.inline_policy(
+            "restricted",
+            {
+                "Effect": "Deny",
+                "Action": "s3:GetObject",
+                "NotResource": "arn:aws:s3:::public/*",
+            },
+        )
+        refresh_permissions()
+
+    def inline_policy(self, role_name, *statements):
+        document = policy_document(*statements)
+        return IAMInlinePolicy.objects.create(
+            role=self.roles[role_name],
+            policy_name=f"{role_name}-inline",
+            policy_document=document,
+            document_hash=policy_hash(document),
+        )
+
+    def allowed(self, action, resource):
+        return set(roles_allowed(action, resource).values_list("role_name", flat=True))
+
+    def test_matches_wildcards(self):
+        self.assertEqual(
+            self.allowed("s3:GetObject", "arn:aws:s3:::uploads/report.csv"),
+            {"reader", "writer", "admin"},
+        )
+        self.assertEqual(
+            self.allowed("s3:PutObject", "arn:aws:s3:::uploads/report.csv"),
+            {"writer", "admin"},
+        )
+        self.assertEqual(
+            self.allowed("s3:PutObject", "arn:aws:s3:::other/report.csv"), {"admin"}
+        )
+
+    def test_actions_match_case_insensitively(self):
+        self.assertIn("writer", self.allowed("S3:PUTOBJECT", "arn:aws:s3:::uploads/a"))
+
+    def test_not_action_and_not_resource_denies(self):
+        # The Deny on everything but s3:* leaves admin only S3
+        self.assertEqual(self.allowed("ec2:RunInstances", "*"), set())
+        self.assertIn(
+            "restricted",
+            self.allowed("s3:GetObject", "arn:aws:s3:::public/index.html"),
+        )
+
+    def test_ignores_deleted_policies_and_roles(self):
+        IAMInlinePolicy.objects.filter(role__role_name="writer").update(
+            deleted_at=timezone.now()
+        )
+        IAMRole.objects.filter(role_name="reader").update(deleted_at=timezone.now())
+        self.assertEqual(
+            self.allowed("s3:GetObject", "arn:aws:s3:::uploads/report.csv"),
+            {"admin"},
+        )
+
+    def test_follows_changed_documents(self):
+        policy = IAMInlinePolicy.objects.get(role__role_name="writer")
+        policy.policy_document = policy_document(
+            {"Effect": "Allow", "Action": "s3:PutObject", "Resource": "*"}
+        )
+        policy.document_hash = policy_hash(policy.policy_document)
+        policy.save()
+        refresh_permissions()
+
+        self.assertIn("writer", self.allowed("s3:PutObject", "arn:aws:s3:::other/a"))
+        self.assertNotIn(
+            "writer", self.allowed("s3:GetObject", "arn:aws:s3:::uploads/a")
+        )
+
+    def test_refreshes_only_changed_policies(self):
+        empty = self.inline_policy("reader")
+        # Derived once despite having no statements
+        self.assertEqual(refresh_permissions(), 1)
+        self.assertEqual(refresh_permissions(), 0)
+
+        policy = IAMInlinePolicy.objects.get(role__role_name="writer")
+        policy.policy_document = policy_document(
+            {"Effect": "Allow", "Action": "s3:PutObject", "Resource": "*"}
+        )
+        policy.document_hash = policy_hash(policy.policy_document)
+        policy.save()
+
+        self.assertEqual(refresh_permissions(inline_policy_ids=[empty.pk]), 0)
+        self.assertNotIn("writer", self.allowed("s3:PutObject", "arn:aws:s3:::a/b"))
+        self.assertEqual(refresh_permissions(inline_policy_ids=[policy.pk]), 1)
+        self.assertIn("writer", self.allowed("s3:PutObject", "arn:aws:s3:::a/b"))
+
+
+def role_data(name, actions=("s3:GetObject",)):
+    return {
+        "RoleName": name,
+        "InlinePolicy": {
+            "PolicyName": f"{name}-permissions",
+            "Permissions": [
+                {"Effect": "Allow", "Action": list(actions), "Resource": "*"}
+            ],
+        },
+    }
+
+
+class ApplyRolesTests(TestCase):
+    def setUp(self):
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        clear_clients()
+        self.addCleanup(clear_clients)
+        self.iam = get_client("iam", region_name=REGION)
+
+    def write_roles(self, roles):
+        handle, path = tempfile.mkstemp(suffix=".json")
+        with os.fdopen(handle, "w", encoding="utf-8") as f:
+            json.dump({"Roles": roles}, f)
+        self.addCleanup(os.remove, path)
+        return path
+
+    def test_role_drift(self):
+        roles = [role_data("app-a"), role_data("app-b")]
+        self.assertEqual(
+            role_drift(roles),
+            {
+                "app-a": ["role", "inline_policy", "instance_profile"],
+                "app-b": ["role", "inline_policy", "instance_profile"],
+            },
+        )
+
+        apply_roles(self.write_roles(roles), REGION)
+
+        self.assertEqual(role_drift(roles), {})
+        self.assertEqual(
+            role_drift([role_data("app-a", actions=("s3:PutObject",))]),
+            {"app-a": ["inline_policy"]},
+        )
+        IAMRole.objects.filter(role_name="app-b").update(instance_profiles=[])
+        self.assertEqual(role_drift(roles), {"app-b": ["instance_profile"]})
+
+    def test_apply_roles_is_idempotent(self):
+        path = self.write_roles([role_data("app-a"), role_data("app-b")])
+
+        results = apply_roles(path, REGION)
+
+        self.assertEqual(results, {"app-a": None, "app-b": None})
+        role_names = {role["RoleName"] for role in self.iam.list_roles()["Roles"]}
+        self.assertTrue({"app-a", "app-b"} <= role_names)
+        profile = self.iam.get_instance_profile(InstanceProfileName="app-a")
+        self.assertEqual(
+            [role["RoleName"] for role in profile["InstanceProfile"]["Roles"]],
+            ["app-a"],
+        )
+        self.assertEqual(
+            self.iam.get_role_policy(RoleName="app-a", PolicyName="app-a-permissions")[
+                "PolicyDocument"
+            ]["Statement"][0]["Action"],
+            ["s3:GetObject"],
+        )
+
+        # Roles already in the inventory make no IAM calls the second time
+        with mock.patch("apps.aws.roles.apply_role") as patched_apply_role:
+            results = apply_roles(path, REGION)
+        patched_apply_role.assert_not_called()
+        self.assertEqual(results, {"app-a": None, "app-b": None})
+
+    def test_apply_roles_updates_changed_policy(self):
+        apply_roles(self.write_roles([role_data("app-a")]), REGION)
+        changed = role_data("app-a", actions=("s3:GetObject", "s3:PutObject"))
+
+        results = apply_roles(self.write_roles([changed]), REGION)
+
+        self.assertEqual(results, {"app-a": None})
+        document = self.iam.get_role_policy(
+            RoleName="app-a", PolicyName="app-a-permissions"
+        )["PolicyDocument"]
+        self.assertEqual(
+            document["Statement"][0]["Action"], ["s3:GetObject", "s3:PutObject"]
+        )
+        self.assertEqual(role_drift([changed]), {})
+        self.assertEqual(
+            set(
+                roles_allowed("s3:PutObject", "arn:aws:s3:::b/k").values_list(
+                    "role_name", flat=True
+                )
+            ),
+            {"app-a"},
+        )
+
+    def allowed(self, action, resource):
+        return set(roles_allowed(action, resource).values_list("role_name", flat=True))
+
+    def test_recorded_roles_are_queryable(self):
+        data = role_data("app-a", actions=("sqs:SendMessage",))
+        apply_role(self.iam, data)
+
+        record_role(self.iam, data)
+
+        self.assertEqual(self.allowed("sqs:SendMessage", "arn:aws:sqs:::q"), {"app-a"})
+
+    def test_attached_inline_policies_are_queryable(self):
+        apply_roles(self.write_roles([role_data("app-a")]), REGION)
+        role = IAMRole.objects.get(role_name="app-a")
+
+        role.attach_inline_policy(
+            "extra",
+            json.dumps(
+                policy_document(
+                    {"Effect": "Allow", "Action": "sqs:SendMessage", "Resource": "*"}
+                )
+            ),
+            REGION,
+        )
+
+        self.assertEqual(self.allowed("sqs:SendMessage", "arn:aws:sqs:::q"), {"app-a"})
+
+
+class PopulateIAMTests(TestCase):
+    def setUp(self):
+        # moto only knows the AWS managed policies when asked to load them
+        environ = mock.patch.dict(
+            os.environ, {"MOTO_IAM_LOAD_MANAGED_POLICIES": "true"}
+        )
+        environ.start()
+        self.addCleanup(environ.stop)
+        aws = mock_aws()
+        aws.start()
+        self.addCleanup(aws.stop)
+        clear_clients()
+        self.addCleanup(clear_clients)
+        self.iam = get_client("iam", region_name=REGION)
+
+    def test_keeps_policies_sharing_a_name(self):
+        customer_arn = self.iam.create_policy(
+            PolicyName="ReadOnlyAccess",
+            PolicyDocument=json.dumps(
+                policy_document(
+                    {"Effect": "Allow", "Action": "s3:GetObject", "Resource": "*"}
+                )
+            ),
+        )["Policy"]["Arn"]
+        managed_arn = "arn:aws:iam::aws:policy/ReadOnlyAccess"
+        self.iam.create_role(
+            RoleName="app",
+            AssumeRolePolicyDocument=json.dumps(
+                policy_document(
+                    {
+                        "Effect": "Allow",
+                        "Principal": {"Service": "ec2.amazonaws.com"},
+                        "Action": "sts:AssumeRole",
+                    }
+                )
+            ),
+        )
+        for arn in (customer_arn, managed_arn):
+            self.iam.attach_role_policy(RoleName="app", PolicyArn=arn)
+
+        populate_iam(REGION)
+
+        self.assertEqual(
+            set(
+                IAMRole.objects.get(role_name="app").policies.values_list(
+                    "arn", flat=True
+                )
+            ),
+            {customer_arn, managed_arn},
+        )
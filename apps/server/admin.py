@@ -3,6 +3,7 @@ from .models import (
     AnsiblePlay,
     GitHubRepository,
     EC2Instance,
+    GoldenImage,
     DjangoService,
     DjangoProject,
 )
@@ -10,8 +11,8 @@ from .models import (
 
 @admin.register(AnsiblePlay)
 class AnsiblePlayAdmin(admin.ModelAdmin):
-    list_display = ("name", "order", "enabled", "yml_file")
-    list_filter = ("enabled",)
+    list_display = ("name", "order", "enabled", "bake", "yml_file")
+    list_filter = ("enabled", "bake")
     search_fields = ("name", "description")
     ordering = ("order",)
 
@@ -32,6 +33,14 @@ class EC2InstanceAdmin(admin.ModelAdmin):
     ordering = ("-created_at",)
 
 
+@admin.register(GoldenImage)
+class GoldenImageAdmin(admin.ModelAdmin):
+    list_display = ("ami_source", "region", "ami_id", "status", "created_at")
+    search_fields = ("ami_source", "ami_id", "bake_hash")
+    list_filter = ("status", "region", "ami_source")
+    ordering = ("-created_at",)
+
+
 @admin.register(DjangoService)
 class DjangoServiceAdmin(admin.ModelAdmin):
     list_display = ("service", "domain", "hostname", "python_version")
@@ -49,6 +58,7 @@ class DjangoProjectAdmin(admin.ModelAdmin):
         "git_repo",
         "aws_region",
         "public_ip_address",
+        "provisioning_state",
     )
     search_fields = (
         "environment",
@@ -56,7 +66,7 @@ class DjangoProjectAdmin(admin.ModelAdmin):
         "public_ip_address",
         "public_dns_name",
     )
-    list_filter = ("environment", "aws_region")
+    list_filter = ("environment", "aws_region", "provisioning_state")
     ordering = ("service", "environment")
 
 
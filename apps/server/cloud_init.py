@@ -0,0 +1,125 @@
+import os
+import shlex
+from django.conf import settings
+import yaml
+from apps.server.models.static_models import Dotfile, SudoUser, UbuntuPackage
+
+# Written by the last boot command; the commands run under "set -e", so only
+# once all of the others have succeeded
+READY_MARKER = "/var/lib/quxcloud/bootstrap-complete"
+
+# Playbooks whose tasks, other than those tagged "host", the user-data performs
+CLOUD_INIT_PLAYBOOKS = ("ubuntu.yml", "sudoer.yml", "user.yml")
+
+DOTFILE_URL = "https://raw.githubusercontent.com/quxdev/qconfig/main/shell/{}"
+
+GOOGLE_SIGNING_KEY_URL = "https://dl.google.com/linux/linux_signing_key.pub"
+
+
+def download(url, dest, force=True, owner=None):
+    """
+    :return: A shell command downloading url to dest; unless force is set, an
+        existing dest is kept.
+    """
+    command = f"curl -fsSL -o {shlex.quote(dest)} {shlex.quote(url)}"
+    if owner:
+        command += f" && chown {shlex.quote(f'{owner}:{owner}')} {shlex.quote(dest)}"
+    if not force:
+        command = f"test -e {shlex.quote(dest)} || ({command})"
+    return command
+
+
+def render_user_data(packages=None, users=None, dotfiles=None):
+    """
+    Renders the host-independent setup of the Ubuntu, Sudoers and User plays as
+    cloud-init user-data, so that it runs while the instance boots rather than
+    play by play over SSH. The hostname is left to the plays' "host" tasks.
+    :param packages: Package names; defaults to UbuntuPackage.extravars().
+    :param users: User dictionaries; defaults to SudoUser.extravars().
+    :param dotfiles: Dotfile names; defaults to Dotfile.extravars().
+    :return: The user-data, a #cloud-config document.
+    """
+    packages = UbuntuPackage.extravars() if packages is None else packages
+    users = SudoUser.extravars() if users is None else users
+    dotfiles = Dotfile.extravars() if dotfiles is None else dotfiles
+
+    ssl_options_file = os.path.join(
+        settings.BASE_DIR,
+        "apps",
+        "server",
+        "ansible_playbooks",
+        "project",
+        "files",
+        "etc",
+        "letsencrypt",
+        "options-ssl-apache.conf",
+    )
+    with open(ssl_options_file, "r", encoding="utf-8") as f:
+        ssl_options = f.read()
+
+    # runcmd is run as a single shell script: stop at the first failing command
+    runcmd = ["set -e"]
+    runcmd.extend(
+        download(DOTFILE_URL.format(dotfile), f"/root/.{dotfile}")
+        for dotfile in dotfiles
+    )
+    cloud_users = ["default"]
+    for user in users:
+        login = user["login"]
+        home = f"/home/{login}"
+        entry = {"name": login, "shell": "/bin/bash"}
+        if user.get("sudo"):
+            entry["groups"] = "sudo"
+        if user.get("github"):
+            entry["ssh_import_id"] = [f"gh:{user['github']}"]
+        cloud_users.append(entry)
+
+        if user.get("key"):
+            authorized_keys = f"{home}/.ssh/authorized_keys"
+            runcmd.append(
+                f"install -d -m 700 -o {shlex.quote(login)} -g {shlex.quote(login)} "
+                f"{shlex.quote(f'{home}/.ssh')} && "
+                f"curl -fsSL {shlex.quote(user['key'])} >> "
+                f"{shlex.quote(authorized_keys)} && "
+                f"chown {shlex.quote(f'{login}:{login}')} {shlex.quote(authorized_keys)}"
+            )
+        runcmd.extend(
+            download(
+                DOTFILE_URL.format(dotfile),
+                f"{home}/.{dotfile}",
+                force=False,
+                owner=login,
+            )
+            for dotfile in dotfiles
+        )
+
+    runcmd.extend(
+        [
+            # Not piped, so that a failed download stops the script
+            download(GOOGLE_SIGNING_KEY_URL, "/tmp/linux_signing_key.pub"),
+            "gpg --batch --yes --dearmor -o /etc/apt/trusted.gpg.d/google.gpg "
+            "/tmp/linux_signing_key.pub",
+            "a2enmod wsgi ssl",
+            f"mkdir -p {os.path.dirname(READY_MARKER)} && touch {READY_MARKER}",
+        ]
+    )
+
+    config = {
+        "package_update": True,
+        "package_upgrade": True,
+        "packages": list(packages),
+        "users": cloud_users,
+        "write_files": [
+            {
+                "path": "/etc/sudoers.d/90-sudo-nopasswd",
+                "content": "%sudo ALL=(ALL) NOPASSWD:ALL\n",
+                "permissions": "0440",
+            },
+            {
+                "path": "/etc/letsencrypt/options-ssl-apache.conf",
+                "content": ssl_options,
+            },
+        ],
+        "runcmd": runcmd,
+    }
+    return "#cloud-config\n" + yaml.safe_dump(config, sort_keys=False)
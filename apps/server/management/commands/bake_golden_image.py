@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand, CommandError
+from apps.server.models import EC2Instance
+
+
+class Command(BaseCommand):
+    help = (
+        "Bakes the host-independent Ansible plays into a golden AMI that new "
+        "instances of an EC2Instance template in the region are launched from"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("name", help="Name of the EC2Instance template")
+        parser.add_argument("--region", default="us-east-1")
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Bake a new image even if a matching one exists",
+        )
+
+    def handle(self, *args, **options):
+        try:
+            template = EC2Instance.objects.get(name=options["name"])
+        except EC2Instance.DoesNotExist as e:
+            raise CommandError(f"No EC2Instance named {options['name']}") from e
+        if (
+            template.bake_golden_image(options["region"], force=options["force"])
+            is None
+        ):
+            raise CommandError("Baking the golden AMI failed")
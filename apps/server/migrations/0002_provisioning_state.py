@@ -0,0 +1,51 @@
+# Generated by Django 5.1 on 2026-10-17 19:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("server", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="djangoproject",
+            name="provisioning_error",
+            field=models.TextField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="djangoproject",
+            name="provisioning_state",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("requested", "Requested"),
+                    ("pending", "Pending"),
+                    ("running", "Running"),
+                    ("reachable", "Reachable"),
+                    ("failed", "Failed"),
+                ],
+                max_length=20,
+                null=True,
+            ),
+        ),
+        migrations.AddField(
+            model_name="djangoproject",
+            name="provisioning_updated_at",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Not part of the provisioning state: brings the migration state up to
+        # the EC2Instance ami_id and ami_source defaults already in the model
+        migrations.AlterField(
+            model_name="ec2instance",
+            name="ami_id",
+            field=models.CharField(default="ami-0522ab6e1ddcc7055", max_length=100),
+        ),
+        migrations.AlterField(
+            model_name="ec2instance",
+            name="ami_source",
+            field=models.CharField(default="Ubuntu 24.04 LTS", max_length=50),
+        ),
+    ]
@@ -0,0 +1,66 @@
+# Generated by Django 5.1 on 2026-10-17 19:26
+
+from django.db import migrations, models
+
+
+def mark_baked_plays(apps, schema_editor):
+    AnsiblePlay = apps.get_model("server", "AnsiblePlay")
+    AnsiblePlay.objects.filter(name__in=["Ubuntu", "Sudoers"]).update(bake=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("server", "0002_provisioning_state"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ansibleplay",
+            name="bake",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name="GoldenImage",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("region", models.CharField(max_length=50)),
+                ("ami_source", models.CharField(max_length=50)),
+                ("bake_hash", models.CharField(max_length=64)),
+                ("base_ami_id", models.CharField(max_length=100)),
+                ("ami_id", models.CharField(blank=True, max_length=100, null=True)),
+                (
+                    "status",
+                    models.CharField(
+                        choices=[
+                            ("baking", "Baking"),
+                            ("available", "Available"),
+                            ("failed", "Failed"),
+                        ],
+                        default="baking",
+                        max_length=20,
+                    ),
+                ),
+                ("error", models.TextField(blank=True, null=True)),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("updated_at", models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                "indexes": [
+                    models.Index(
+                        fields=["region", "ami_source", "bake_hash"],
+                        name="server_gold_region_f36b77_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(mark_baked_plays, migrations.RunPython.noop),
+    ]
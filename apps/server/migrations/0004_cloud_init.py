@@ -0,0 +1,21 @@
+# Generated by Django 5.1 on 2026-10-17 19:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("server", "0003_golden_image"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="ec2instance",
+            name="cloud_init",
+            field=models.BooleanField(
+                default=False,
+                help_text="Bootstrap new instances with cloud-init user-data rendered from the Ubuntu packages, sudo users and dotfiles.",
+            ),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.1 on 2026-10-17 19:43
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("server", "0004_cloud_init"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="djangoproject",
+            name="cloud_init",
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -1,8 +1,97 @@
+import hashlib
+import json
 import os
+import re
+import tempfile
 from django.conf import settings
 
 from django.db import models
 import ansible_runner
+import yaml
+
+
+# Name of the empty play marking where an AnsiblePlay starts in a composite playbook
+COMPOSITE_MARKER = "AnsiblePlay {}"
+COMPOSITE_MARKER_PATTERN = re.compile(r"^AnsiblePlay (\d+)$")
+
+
+def artifacts_dir():
+    return os.path.join(settings.BASE_DIR, "data", "artifacts")
+
+
+def inventory_hosts(hosts):
+    """
+    :param hosts: A host, a list of hosts, or a dictionary mapping each host to
+        its own variables.
+    :return: A dictionary mapping each host to its variables.
+    """
+    if isinstance(hosts, str):
+        return {hosts: {}}
+    if isinstance(hosts, dict):
+        return {host: dict(host_vars or {}) for host, host_vars in hosts.items()}
+    return {host: {} for host in hosts}
+
+
+def host_results(runner, hosts):
+    """
+    :param runner: The ansible-runner result of a play.
+    :param hosts: The hosts the play ran on.
+    :return: A dictionary mapping each host to "successful", "failed" or
+        "unreachable"; hosts the play never reached get the runner's status.
+    """
+    stats = runner.stats or {}
+    results = {}
+    for host in hosts:
+        if host in stats.get("dark", {}):
+            results[host] = "unreachable"
+        elif host in stats.get("failures", {}):
+            results[host] = "failed"
+        elif host in stats.get("processed", {}):
+            results[host] = "successful"
+        else:
+            results[host] = runner.status
+    return results
+
+
+def run_playbook(
+    playbook_path,
+    hosts,
+    extravars=None,
+    tags=None,
+    skip_tags=None,
+    forks=None,
+    strategy=None,
+    envvars=None,
+):
+    """
+    Runs a playbook using ansible-runner, once across all the hosts; see
+    AnsiblePlay.run_play for the parameters.
+    :param envvars: Optional Ansible environment variables to set.
+    """
+    envvars = {
+        "ANSIBLE_PRIVATE_KEY_FILE": os.getenv("PRIVATE_KEY_FILE_PATH"),
+        "ANSIBLE_REMOTE_USER": "ubuntu",
+        **(envvars or {}),
+    }
+    if strategy:
+        envvars["ANSIBLE_STRATEGY"] = strategy
+    inventory = {"all": {"hosts": inventory_hosts(hosts)}}
+
+    runner_private_dir = os.path.join(
+        settings.BASE_DIR, "apps", "server", "ansible_playbooks"
+    )
+    result = ansible_runner.run(
+        private_data_dir=runner_private_dir,
+        playbook=playbook_path,
+        inventory=inventory,
+        extravars=extravars,
+        envvars=envvars,
+        artifact_dir=artifacts_dir(),
+        tags=tags,
+        skip_tags=skip_tags,
+        forks=forks,
+    )
+    return result
 
 
 class AnsiblePlay(models.Model):
@@ -11,58 +100,225 @@ class AnsiblePlay(models.Model):
     order = models.IntegerField(default=0)
     enabled = models.BooleanField(default=True)
     yml_file = models.CharField(max_length=255, blank=True, null=True)
+    # Plays whose tasks, other than those tagged "host", are baked into golden AMIs
+    bake = models.BooleanField(default=False)
 
     def __str__(self):
         return f"{self.name}"
 
     @classmethod
-    def run_all_enabled_plays(cls, instance_ip, extravars=None):
+    def run_all_enabled_plays(
+        cls, hosts, extravars=None, forks=None, strategy=None, composite=False
+    ):
         """
-        Runs all enabled plays in the correct order using ansible-runner.
+        Runs all enabled plays in the correct order using ansible-runner, each play
+        once across all the hosts. A host that fails a play is left out of the
+        following plays; the other hosts carry on.
+        :param hosts: A host, a list of hosts, or a dictionary mapping each host to
+            its own variables.
         :param extravars: A dictionary of extra variables to pass to each playbook.
+        :param forks: Optional number of hosts worked on in parallel.
+        :param strategy: Optional Ansible strategy, e.g. "free".
+        :param composite: Run all the plays in a single invocation; see
+            run_composite.
+        :return: A dictionary mapping each play run to the status of each host.
         """
+        if composite:
+            return cls.run_composite(
+                hosts, extravars=extravars, forks=forks, strategy=strategy
+            )
+
+        hosts = inventory_hosts(hosts)
+        results = {}
         plays = cls.objects.filter(enabled=True).order_by("order")
         for play in plays:
+            if not hosts:
+                break  # Stop execution once every host has failed
             print(f"Running play: {play.name}")
-            result = play.run_play(instance_ip, extravars=extravars)
-            if result.status != "successful":
-                print(f"Play {play.name} failed with status: {result.status}")
-                break  # Stop execution if a play fails
+            result = play.run_play(
+                hosts, extravars=extravars, forks=forks, strategy=strategy
+            )
+            results[play.name] = host_results(result, hosts)
+            failed = [
+                host
+                for host, status in results[play.name].items()
+                if status != "successful"
+            ]
+            for host in failed:
+                print(f"Play {play.name} failed on {host}: {results[play.name][host]}")
+                del hosts[host]
 
-            print(f"Play {play.name} completed successfully.")
+            print(
+                f"Play {play.name} completed on "
+                f"{len(results[play.name]) - len(failed)} of "
+                f"{len(results[play.name])} hosts."
+            )
+        return results
 
-    def run_play(self, instance_ip, extravars=None):
+    def run_play(
+        self,
+        hosts,
+        extravars=None,
+        tags=None,
+        skip_tags=None,
+        forks=None,
+        strategy=None,
+    ):
         """
-        Runs the play using ansible-runner with the provided extra variables.
-        :param extravars: A dictionary of extra variables to pass to the playbook.
+        Runs the play using ansible-runner with the provided extra variables, once
+        across all the hosts. Use host_results for the outcome on each host.
+        :param hosts: A host, a list of hosts, or a dictionary mapping each host to
+            its own variables.
+        :param extravars: A dictionary of extra variables to pass to the playbook;
+            they override host variables of the same name.
+        :param tags: Optional comma-separated tags; only tasks tagged with one run.
+        :param skip_tags: Optional comma-separated tags of tasks not to run.
+        :param forks: Optional number of hosts worked on in parallel; defaults to
+            forks in ansible.cfg.
+        :param strategy: Optional Ansible strategy, e.g. "free" to let each host
+            run through the play at its own pace.
         """
 
-        envvars = {
-            "ANSIBLE_PRIVATE_KEY_FILE": os.getenv("PRIVATE_KEY_FILE_PATH"),
-            "ANSIBLE_REMOTE_USER": "ubuntu",
-        }
-        inventory_content = f"{instance_ip}"
+        return run_playbook(
+            self.playbook_path(),
+            hosts,
+            extravars=extravars,
+            tags=tags,
+            skip_tags=skip_tags,
+            forks=forks,
+            strategy=strategy,
+        )
 
-        runner_private_dir = os.path.join(
-            settings.BASE_DIR, "apps", "server", "ansible_playbooks"
+    @classmethod
+    def composite_playbook(cls, plays):
+        """
+        Writes a playbook importing the playbooks of the plays in order, by
+        absolute path, into the artifacts directory. Each import is preceded by an
+        empty play named after the AnsiblePlay id, marking where its plays start.
+        :param plays: The plays to import.
+        :return: The path of the composite playbook.
+        """
+        content = "---\n" + "".join(
+            f"- name: {COMPOSITE_MARKER.format(play.pk)}\n"
+            "  hosts: all\n"
+            "  gather_facts: false\n"
+            "  tasks: []\n"
+            f"- import_playbook: {json.dumps(play.playbook_path())}\n"
+            for play in plays
         )
-        playbook_path = os.path.join(
-            runner_private_dir,
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()[:12]
+        directory = os.path.join(artifacts_dir(), "composite")
+        path = os.path.join(directory, f"composite-{digest}.yml")
+        if not os.path.exists(path):
+            os.makedirs(directory, exist_ok=True)
+            # Written aside and renamed, so that a concurrent run never reads a
+            # partial playbook
+            with tempfile.NamedTemporaryFile(
+                "w", encoding="utf-8", dir=directory, suffix=".tmp", delete=False
+            ) as f:
+                f.write(content)
+            os.replace(f.name, path)
+        return path
+
+    @classmethod
+    def run_composite(
+        cls, hosts, plays=None, extravars=None, forks=None, strategy=None
+    ):
+        """
+        Runs plays as a single composite playbook in one ansible-runner invocation,
+        so that interpreter start-up, SSH connections and fact gathering are paid
+        once rather than once per play. Facts are only gathered by the first play
+        that needs them. As with run_all_enabled_plays, a host that fails a play is
+        left out of the following plays.
+        :param hosts: A host, a list of hosts, or a dictionary mapping each host to
+            its own variables.
+        :param plays: The plays to run in order; defaults to every enabled play.
+        :param extravars: A dictionary of extra variables to pass to each playbook.
+        :param forks: Optional number of hosts worked on in parallel.
+        :param strategy: Optional Ansible strategy, e.g. "free".
+        :return: A dictionary mapping each play run to the status of each host.
+        """
+        hosts = inventory_hosts(hosts)
+        if plays is None:
+            plays = cls.objects.filter(enabled=True).order_by("order")
+        plays = list(plays)
+        if not plays or not hosts:
+            return {}
+
+        # Plays are attributed to the AnsiblePlay of the last marker play started
+        owners = {play.pk: play.name for play in plays}
+
+        print(f"Running plays: {', '.join(play.name for play in plays)}")
+        result = run_playbook(
+            cls.composite_playbook(plays),
+            hosts,
+            extravars=extravars,
+            forks=forks,
+            strategy=strategy,
+            envvars={"ANSIBLE_GATHERING": "smart"},
+        )
+
+        results = {}
+        active = set(hosts)
+        current = None
+        for event in result.events:
+            data = event.get("event_data", {})
+            if event.get("event") == "playbook_on_play_start":
+                marker = COMPOSITE_MARKER_PATTERN.match(data.get("play") or "")
+                if marker:
+                    current = owners.get(int(marker.group(1)))
+                    results[current] = {host: "successful" for host in active}
+            elif current in results and data.get("host") in results[current]:
+                if event.get("event") == "runner_on_unreachable":
+                    results[current][data["host"]] = "unreachable"
+                elif event.get("event") == "runner_on_failed" and not data.get(
+                    "ignore_errors"
+                ):
+                    results[current][data["host"]] = "failed"
+                else:
+                    continue
+                active.discard(data["host"])
+
+        for name, play_results in results.items():
+            failed = [
+                host for host, status in play_results.items() if status != "successful"
+            ]
+            for host in failed:
+                print(f"Play {name} failed on {host}: {play_results[host]}")
+            print(
+                f"Play {name} completed on {len(play_results) - len(failed)} of "
+                f"{len(play_results)} hosts."
+            )
+        if result.status != "successful" and not results:
+            print(f"Composite playbook failed with status: {result.status}")
+        return results
+
+    def playbook_path(self):
+        return os.path.join(
+            settings.BASE_DIR,
+            "apps",
+            "server",
+            "ansible_playbooks",
             "project",
             "tasks",
             str(self.yml_file),
         )
-        artifacts_dir = os.path.join(settings.BASE_DIR, "data", "artifacts")
-        print(playbook_path)
-        result = ansible_runner.run(
-            private_data_dir=runner_private_dir,
-            playbook=playbook_path,
-            inventory=inventory_content,
-            extravars=extravars,
-            envvars=envvars,
-            artifact_dir=artifacts_dir,
-        )
-        return result
+
+    @classmethod
+    def bake_hash(cls, extravars):
+        """
+        Hashes what a golden AMI is built from: the variables the baked plays are
+        run with, such as the package set, and the baked playbooks themselves, so
+        that changing either calls for a new image.
+        :param extravars: The extra variables passed to the baked plays.
+        """
+        digest = hashlib.sha256()
+        digest.update(json.dumps(extravars, sort_keys=True).encode("utf-8"))
+        for play in cls.objects.filter(enabled=True, bake=True).order_by("order"):
+            digest.update(play.name.encode("utf-8"))
+            with open(play.playbook_path(), "rb") as f:
+                digest.update(f.read())
+        return digest.hexdigest()
 
     @classmethod
     def populate(cls, data):
@@ -82,6 +338,7 @@ def populate_plays():
             "order": 0,
             "enabled": True,
             "yml_file": "ubuntu.yml",
+            "bake": True,
         },
         {
             "name": "Nodejs",
@@ -103,6 +360,7 @@ def populate_plays():
             "order": 3,
             "enabled": True,
             "yml_file": "sudoer.yml",
+            "bake": True,
         },
         {
             "name": "User",
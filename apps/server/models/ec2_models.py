@@ -1,6 +1,62 @@
 import os
-import boto3
+import re
+import socket
+import time
 from django.db import models
+from apps.aws.clients import get_client
+from apps.server.cloud_init import render_user_data
+from apps.server.models.ansible_models import AnsiblePlay
+from apps.server.models.static_models import Dotfile, UbuntuPackage
+
+
+# Maximum number of instance ids per waiter and describe_instances call
+INSTANCE_BATCH_SIZE = 200
+
+
+# Seconds to wait for the SSH port of a running instance to accept connections
+SSH_CONNECT_TIMEOUT = 3
+
+
+def ssh_reachable(host, port=22, timeout=SSH_CONNECT_TIMEOUT):
+    """
+    :return: True if the host accepts TCP connections on its SSH port.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+# Attempts, at one every five seconds, to wait for sshd on a bake instance
+BAKE_SSH_WAIT_ATTEMPTS = 60
+
+
+def bake_extravars():
+    """
+    The extra variables the baked plays are run with; they hold nothing specific
+    to a host or project.
+    """
+    return {
+        "dotfiles": sorted(Dotfile.extravars()),
+        "ubuntu_packages": sorted(UbuntuPackage.extravars()),
+    }
+
+
+def instance_batches(instance_ids):
+    return [
+        instance_ids[start : start + INSTANCE_BATCH_SIZE]
+        for start in range(0, len(instance_ids), INSTANCE_BATCH_SIZE)
+    ]
+
+
+def ec2_client(region):
+    return get_client(
+        "ec2",
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
+        region_name=region,
+    )
 
 
 class EC2Instance(models.Model):
@@ -18,6 +74,13 @@ class EC2Instance(models.Model):
             "If blank, the default security group will be used."
         ),
     )
+    cloud_init = models.BooleanField(
+        default=False,
+        help_text=(
+            "Bootstrap new instances with cloud-init user-data rendered from the "
+            "Ubuntu packages, sudo users and dotfiles."
+        ),
+    )
     server_admin = models.EmailField()
     cert_email = models.EmailField()
     created_at = models.DateTimeField(auto_now_add=True)
@@ -32,57 +95,26 @@ class EC2Instance(models.Model):
             "cert_email": self.cert_email,
         }
 
-    def create_instance(self, region):
+    def create_instance(self, region, cloud_init=None):
+        """
+        Launches an instance and waits until it is running.
+        :param region: The AWS region to launch the instance in.
+        :param cloud_init: Bootstrap the instance with cloud-init user-data;
+            defaults to the template's cloud_init.
+        """
         if not self.ami_id:
             print("No AMI ID available, aborting instance creation.")
             return None
 
-        EC2_CLIENT = boto3.client(
-            "ec2",
-            aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
-            aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
-            region_name=region,  # Use the region specified in the model
-        )
-
         try:
-            security_group_ids = (
-                self.security_group_ids.split(",") if self.security_group_ids else []
-            )
-            response = EC2_CLIENT.run_instances(
-                ImageId=self.ami_id,
-                InstanceType=self.instance_type,
-                KeyName=self.key_name,
-                SecurityGroupIds=security_group_ids,
-                MinCount=1,
-                MaxCount=1,
-                TagSpecifications=[
-                    {
-                        "ResourceType": "instance",
-                        "Tags": [
-                            {"Key": "Name", "Value": self.name},
-                        ],
-                    },
-                ],
-            )
-
-            instance = response["Instances"][0]
-            instance_id = instance["InstanceId"]
+            cloud_init = self.cloud_init if cloud_init is None else cloud_init
+            instance_id = self.launch_instances(region, 1, cloud_init=cloud_init)[0]
             print(f"EC2 instance created with Instance ID: {instance_id}")
 
             # Wait until the instance is running and has an IP assigned
-            waiter = EC2_CLIENT.get_waiter("instance_running")
-            waiter.wait(InstanceIds=[instance_id])
-
-            # Retrieve the instance's public IP address
-            instance_description = EC2_CLIENT.describe_instances(
-                InstanceIds=[instance_id]
-            )
-            public_ip = instance_description["Reservations"][0]["Instances"][0].get(
-                "PublicIpAddress"
-            )
-            public_dns = instance_description["Reservations"][0]["Instances"][0].get(
-                "PublicDnsName"
-            )
+            instance = self.wait_for_instances(region, [instance_id])[instance_id]
+            public_ip = instance["public_ip"]
+            public_dns = instance["public_dns"]
 
             print(f"Instance ID: {instance_id}")
             print(f"Instance Public IP: {public_ip}")
@@ -92,13 +124,259 @@ class EC2Instance(models.Model):
                 "instance_id": instance_id,
                 "public_ip": public_ip,
                 "public_dns": public_dns,
+                "cloud_init": cloud_init,
             }
         except Exception as e:
             print(f"Failed to create EC2 instance: {str(e)}")
             return None
 
+    def golden_image(self, region):
+        """
+        :return: The latest available GoldenImage of the template's ami_source in
+            the region baked from the current package set and baked plays, or
+            None if there is none.
+        """
+        return (
+            GoldenImage.objects.filter(
+                region=region,
+                ami_source=self.ami_source,
+                bake_hash=AnsiblePlay.bake_hash(bake_extravars()),
+                status="available",
+            )
+            .order_by("-created_at")
+            .first()
+        )
+
+    def launch_image(self, region):
+        """
+        :return: The AMI new instances are launched from in the region: the
+            current golden image if there is one, otherwise the template's ami_id.
+        """
+        image = self.golden_image(region)
+        return image.ami_id if image else self.ami_id
+
+    def launch_instances(
+        self, region, count, image_id=None, name=None, cloud_init=None
+    ):
+        """
+        Launches count instances from this template with a single run_instances call.
+        :param region: The AWS region to launch the instances in.
+        :param count: The number of instances; either all of them launch or none.
+        :param image_id: Optional AMI to launch; defaults to launch_image.
+        :param name: Optional Name tag instead of the template's name.
+        :param cloud_init: Bootstrap the instances with cloud-init user-data;
+            defaults to the template's cloud_init.
+        :return: The ids of the instances launched.
+        """
+        security_group_ids = (
+            self.security_group_ids.split(",") if self.security_group_ids else []
+        )
+        cloud_init = self.cloud_init if cloud_init is None else cloud_init
+        options = {"UserData": render_user_data()} if cloud_init else {}
+        response = ec2_client(region).run_instances(
+            ImageId=image_id or self.launch_image(region),
+            InstanceType=self.instance_type,
+            KeyName=self.key_name,
+            SecurityGroupIds=security_group_ids,
+            MinCount=count,
+            MaxCount=count,
+            TagSpecifications=[
+                {
+                    "ResourceType": "instance",
+                    "Tags": [
+                        {"Key": "Name", "Value": name or self.name},
+                    ],
+                },
+            ],
+            **options,
+        )
+        return [instance["InstanceId"] for instance in response["Instances"]]
+
+    @staticmethod
+    def wait_for_instances(region, instance_ids):
+        """
+        Waits until all the instances are running, with one waiter per batch of
+        instances rather than one per instance, and then describes them in bulk.
+        :param region: The AWS region of the instances.
+        :param instance_ids: The ids of the instances to wait for.
+        :return: A dictionary mapping each instance id to its public_ip and public_dns.
+        """
+        client = ec2_client(region)
+        # The instances boot in parallel, so later batches are usually ready
+        for batch in instance_batches(instance_ids):
+            client.get_waiter("instance_running").wait(InstanceIds=batch)
+        return EC2Instance.describe_instances(region, instance_ids)
+
+    @staticmethod
+    def describe_instances(region, instance_ids):
+        """
+        Describes instances in batches, without waiting for them.
+        :param region: The AWS region of the instances.
+        :param instance_ids: The ids of the instances to describe.
+        :return: A dictionary mapping each instance id found to its state,
+            image_id, public_ip and public_dns.
+        """
+        client = ec2_client(region)
+        instances = {}
+        for batch in instance_batches(instance_ids):
+            # Filtering rather than passing InstanceIds, so that an instance EC2
+            # has already forgotten does not fail the whole batch
+            paginator = client.get_paginator("describe_instances")
+            for page in paginator.paginate(
+                Filters=[{"Name": "instance-id", "Values": batch}]
+            ):
+                for reservation in page["Reservations"]:
+                    for instance in reservation["Instances"]:
+                        instances[instance["InstanceId"]] = {
+                            "state": instance["State"]["Name"],
+                            "image_id": instance["ImageId"],
+                            "public_ip": instance.get("PublicIpAddress"),
+                            "public_dns": instance.get("PublicDnsName"),
+                        }
+        return instances
+
+    @staticmethod
+    def terminate_instances(region, instance_ids):
+        """
+        Terminates instances in batches.
+        :param region: The AWS region of the instances.
+        :param instance_ids: The ids of the instances to terminate.
+        """
+        client = ec2_client(region)
+        for batch in instance_batches(instance_ids):
+            client.terminate_instances(InstanceIds=batch)
+
+    def ubuntu_release(self):
+        """
+        :return: The Ubuntu release named by ami_source, e.g. "24.04", or None.
+        """
+        match = re.search(r"\d{2}\.\d{2}", self.ami_source)
+        return match.group(0) if match else None
+
+    def bake_golden_image(self, region, force=False):
+        """
+        Bakes the host-independent plays into a golden AMI of the region, which
+        launch_instances then boots new instances of the template from, so that
+        they boot with the plays already applied.
+        An image is baked once per region, ami_source and bake hash; a matching
+        image baked before is reused.
+        The plays run on a temporary instance booted from the latest stock AMI of
+        the ami_source release, skipping their tasks tagged "host".
+        :param region: The AWS region to bake the image in.
+        :param force: Bake a new image even if a matching one exists.
+        :return: The GoldenImage, or None if baking failed.
+        """
+        # pylint: disable=import-outside-toplevel
+        from apps.server.resolver import latest_ami
+
+        extravars = bake_extravars()
+        bake_hash = AnsiblePlay.bake_hash(extravars)
+        image = self.golden_image(region)
+        if image is not None and not force:
+            print(f"Reusing golden AMI {image.ami_id} for {self}")
+            return image
+
+        base_ami_id = latest_ami(region, self.ubuntu_release())
+        if not base_ami_id:
+            print(f"No base AMI found for {self.ami_source}, aborting bake.")
+            return None
+        image = GoldenImage.objects.create(
+            region=region,
+            ami_source=self.ami_source,
+            bake_hash=bake_hash,
+            base_ami_id=base_ami_id,
+        )
+
+        client = ec2_client(region)
+        instance_id = None
+        try:
+            instance_id = self.launch_instances(
+                region,
+                1,
+                image_id=base_ami_id,
+                name=f"{self.name}-bake",
+                cloud_init=False,
+            )[0]
+            public_ip = self.wait_for_instances(region, [instance_id])[instance_id][
+                "public_ip"
+            ]
+            if not public_ip:
+                raise RuntimeError(f"Bake instance {instance_id} has no public IP")
+            for _ in range(BAKE_SSH_WAIT_ATTEMPTS):
+                if ssh_reachable(public_ip):
+                    break
+                time.sleep(5)
+            else:
+                raise RuntimeError(f"Bake instance {instance_id} is not reachable")
+
+            for play in AnsiblePlay.objects.filter(enabled=True, bake=True).order_by(
+                "order"
+            ):
+                print(f"Baking play: {play.name}")
+                result = play.run_play(public_ip, extravars=extravars, skip_tags="host")
+                if result.status != "successful":
+                    raise RuntimeError(
+                        f"Play {play.name} failed with status: {result.status}"
+                    )
+
+            name = re.sub(r"[^\w.-]", "-", self.name)
+            image.ami_id = client.create_image(
+                InstanceId=instance_id,
+                Name=f"{name}-golden-{bake_hash[:12]}-{int(time.time())}",
+                Description=f"{self.ami_source} with the baked plays applied",
+            )["ImageId"]
+            client.get_waiter("image_available").wait(
+                ImageIds=[image.ami_id], WaiterConfig={"Delay": 15, "MaxAttempts": 120}
+            )
+        except Exception as e:
+            print(f"Failed to bake golden AMI for {self}: {str(e)}")
+            image.status = "failed"
+            image.error = str(e)
+            image.save()
+            return None
+        finally:
+            if instance_id:
+                client.terminate_instances(InstanceIds=[instance_id])
+
+        image.status = "available"
+        image.save()
+        print(f"Baked golden AMI {image.ami_id} for {self}")
+        return image
+
     @classmethod
     def populate(cls, data):
         # create a new instance for the given data
         instance = cls.objects.create(**data)
         return instance
+
+
+class GoldenImage(models.Model):
+    STATUS_CHOICES = [
+        ("baking", "Baking"),
+        ("available", "Available"),
+        ("failed", "Failed"),
+    ]
+
+    region = models.CharField(max_length=50)
+    ami_source = models.CharField(max_length=50)
+    # AnsiblePlay.bake_hash of the package set and baked plays
+    bake_hash = models.CharField(max_length=64)
+    base_ami_id = models.CharField(max_length=100)
+    ami_id = models.CharField(max_length=100, blank=True, null=True)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default="baking")
+    error = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        indexes = [models.Index(fields=["region", "ami_source", "bake_hash"])]
+
+    def __str__(self):
+        return f"{self.ami_source} ({self.bake_hash[:12]}) in {self.region}"
+
+    def is_current(self):
+        """
+        :return: True if the image was baked from the current package set and
+            baked plays.
+        """
+        return self.bake_hash == AnsiblePlay.bake_hash(bake_extravars())
@@ -1,11 +1,36 @@
-from django.db import models
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from django.db import models, transaction
+from django.utils import timezone
 import paramiko
 import os
+from apps.server.cloud_init import CLOUD_INIT_PLAYBOOKS, READY_MARKER
 from apps.server.models.git_models import GitHubRepository
-from apps.server.models.ec2_models import EC2Instance
-from apps.server.models.ansible_models import AnsiblePlay
+from apps.server.models.ec2_models import EC2Instance, GoldenImage, ssh_reachable
+from apps.server.models.ansible_models import AnsiblePlay, host_results
 from apps.server.models.static_models import SudoUser, Dotfile, UbuntuPackage
 
+# Seconds a requested project may wait for its launch task before the poller
+# launches it instead
+PROVISIONING_REQUEST_GRACE = 60
+
+# Seconds a launched instance may be missing from describe_instances, which is
+# eventually consistent, before its project fails
+PROVISIONING_MISSING_GRACE = 300
+
+# Seconds a running instance may take to accept SSH connections before its
+# project fails and the instance is terminated
+PROVISIONING_REACHABLE_TIMEOUT = 900
+
+# Maximum number of instances probed for SSH at the same time
+SSH_PROBE_CONCURRENCY = 32
+
+# Seconds to wait for cloud-init to finish bootstrapping an instance
+BOOTSTRAP_WAIT_SECONDS = 1800
+
+# Instance states from which an instance never reaches running
+FAILED_INSTANCE_STATES = ("shutting-down", "terminated", "stopping", "stopped")
+
 
 class DjangoService(models.Model):
     service = models.CharField(max_length=255, blank=True, null=True)
@@ -111,6 +136,23 @@ class DjangoProject(models.Model):
     public_dns_name = models.CharField(max_length=255, blank=True, null=True)
     git_branch = models.CharField(max_length=255, default="main")
 
+    PROVISIONING_STATE_CHOICES = [
+        ("requested", "Requested"),
+        ("pending", "Pending"),
+        ("running", "Running"),
+        ("reachable", "Reachable"),
+        ("failed", "Failed"),
+    ]
+
+    # Blank for projects provisioned before provisioning was tracked
+    provisioning_state = models.CharField(
+        max_length=20, choices=PROVISIONING_STATE_CHOICES, blank=True, null=True
+    )
+    provisioning_error = models.TextField(blank=True, null=True)
+    provisioning_updated_at = models.DateTimeField(blank=True, null=True)
+    # Whether the instance was launched with cloud-init user-data
+    cloud_init = models.BooleanField(default=False)
+
     def __str__(self):
         return f"{self.service} - {self.environment}"
 
@@ -144,6 +186,247 @@ class DjangoProject(models.Model):
         print(extravars)
         return extravars
 
+    @classmethod
+    def set_provisioning_state(cls, projects, state, error=None):
+        now = timezone.now()
+        for project in projects:
+            project.provisioning_state = state
+            project.provisioning_error = error
+            project.provisioning_updated_at = now
+        cls.objects.bulk_update(
+            projects,
+            [
+                "provisioning_state",
+                "provisioning_error",
+                "provisioning_updated_at",
+                "instance_id",
+                "public_ip_address",
+                "public_dns_name",
+                "cloud_init",
+            ],
+        )
+
+    @classmethod
+    def start_fleet(cls, projects):
+        """
+        Launches instances for many projects at once, without waiting for them.
+        Projects are grouped by region and EC2Instance template, and each group is
+        launched with one run_instances call. Launched projects become pending and
+        projects whose group failed to launch become failed.
+        :param projects: The projects to launch.
+        :return: A dictionary mapping each region to the projects launched in it.
+        """
+        groups = {}
+        for project in projects:
+            groups.setdefault((project.aws_region, project.ec2_instance_id), []).append(
+                project
+            )
+
+        launched = {}
+        for (region, _), group in groups.items():
+            template = group[0].ec2_instance
+            cloud_init = template.cloud_init
+            try:
+                instance_ids = template.launch_instances(
+                    region, len(group), cloud_init=cloud_init
+                )
+            except Exception as e:
+                print(f"Failed to launch {len(group)} {template} instances: {e}")
+                cls.set_provisioning_state(group, "failed", str(e))
+                continue
+            for project, instance_id in zip(group, instance_ids):
+                project.instance_id = instance_id
+                project.cloud_init = cloud_init
+            # Instance ids are saved before waiting, so none is lost if it fails
+            cls.set_provisioning_state(group, "pending")
+            launched.setdefault(region, []).extend(group)
+            print(f"Launched {len(group)} {template} instances in {region}")
+        return launched
+
+    @classmethod
+    def launch_fleet(cls, projects=None):
+        """
+        Launches instances for many projects at once and waits for them.
+        All instances of a region are waited for together and their details
+        written back in bulk.
+        :param projects: The projects to launch; defaults to every project without
+            an instance.
+        :return: The list of projects whose instances were launched.
+        """
+        if projects is None:
+            projects = cls.objects.filter(
+                models.Q(instance_id__isnull=True) | models.Q(instance_id="")
+            ).select_related("ec2_instance")
+
+        launched = cls.start_fleet(projects)
+        for region, group in launched.items():
+            try:
+                instances = EC2Instance.wait_for_instances(
+                    region, [project.instance_id for project in group]
+                )
+            except Exception as e:
+                print(f"Failed waiting for instances in {region}: {e}")
+                continue
+            for project in group:
+                instance = instances.get(project.instance_id, {})
+                project.public_ip_address = instance.get("public_ip")
+                project.public_dns_name = instance.get("public_dns")
+            cls.set_provisioning_state(group, "running")
+
+        return [project for group in launched.values() for project in group]
+
+    def request_provisioning(self):
+        """
+        Requests an instance for the project and returns straight away; a Celery
+        worker launches it and the provisioning poller follows it until it is
+        reachable over SSH.
+        A project whose provisioning failed is provisioned again from scratch.
+        :return: True if provisioning was requested, False if the project already
+            has an instance or is being provisioned.
+        """
+        # pylint: disable=import-outside-toplevel
+        from apps.server.tasks import launch_requested_projects
+
+        if self.provisioning_state == "failed":
+            self.instance_id = self.public_ip_address = self.public_dns_name = None
+            self.cloud_init = False
+        elif self.instance_id or self.provisioning_state:
+            return False
+        self.set_provisioning_state([self], "requested")
+        # The task launches every project requested by then, so a burst of
+        # requests shares a few run_instances calls
+        transaction.on_commit(launch_requested_projects.delay)
+        return True
+
+    @classmethod
+    def launch_requested(cls, project_ids=None, requested_before=None):
+        """
+        Launches the instances of requested projects. The projects are locked while
+        they are launched, so concurrent workers never launch a project twice.
+        :param project_ids: Optional ids of the projects to launch.
+        :param requested_before: Optional time; only projects requested before it
+            are launched.
+        :return: The list of projects whose instances were launched.
+        """
+        with transaction.atomic():
+            projects = cls.objects.select_for_update(skip_locked=True).filter(
+                models.Q(instance_id__isnull=True) | models.Q(instance_id=""),
+                provisioning_state="requested",
+            )
+            if project_ids is not None:
+                projects = projects.filter(pk__in=project_ids)
+            if requested_before is not None:
+                projects = projects.filter(provisioning_updated_at__lt=requested_before)
+            launched = cls.start_fleet(projects.select_related("ec2_instance"))
+        return [project for group in launched.values() for project in group]
+
+    @classmethod
+    def poll_provisioning(cls):
+        """
+        Advances every project being provisioned by one step of its state machine:
+        requested -> pending -> running -> reachable, or failed.
+        Instances are described with batched describe_instances calls per region,
+        so a tick costs a few API calls however many projects are in flight.
+        :return: A dictionary with the number of projects moved into each state.
+        """
+        moved = {"pending": 0, "running": 0, "reachable": 0, "failed": 0}
+
+        # Requests whose launch task was lost are launched here instead
+        moved["pending"] += len(
+            cls.launch_requested(
+                requested_before=timezone.now()
+                - timedelta(seconds=PROVISIONING_REQUEST_GRACE)
+            )
+        )
+
+        in_flight = {}
+        for project in cls.objects.filter(
+            provisioning_state__in=["pending", "running"]
+        ):
+            in_flight.setdefault(project.aws_region, []).append(project)
+
+        probes = []
+        for region, projects in in_flight.items():
+            try:
+                instances = EC2Instance.describe_instances(
+                    region, [project.instance_id for project in projects]
+                )
+            except Exception as e:
+                print(f"Failed to describe instances in {region}: {e}")
+                continue
+
+            now = timezone.now()
+            running, missing, stopped, unreachable = [], [], [], []
+            for project in projects:
+                instance = instances.get(project.instance_id)
+                waited = now - (project.provisioning_updated_at or now)
+                if instance is None:
+                    # A new instance may not be described yet; it stays pending
+                    if waited > timedelta(seconds=PROVISIONING_MISSING_GRACE):
+                        missing.append(project)
+                elif instance["state"] in FAILED_INSTANCE_STATES:
+                    stopped.append(project)
+                elif project.provisioning_state == "running":
+                    if waited > timedelta(seconds=PROVISIONING_REACHABLE_TIMEOUT):
+                        unreachable.append(project)
+                    elif project.public_ip_address:
+                        # Only instances already running on the previous tick are
+                        # probed, as sshd starts well after EC2 reports them running
+                        probes.append(project)
+                elif instance["state"] == "running":
+                    project.public_ip_address = instance["public_ip"]
+                    project.public_dns_name = instance["public_dns"]
+                    running.append(project)
+
+            if unreachable:
+                # Terminated, as a failed project gets a new instance when it is
+                # provisioned again
+                try:
+                    EC2Instance.terminate_instances(
+                        region, [project.instance_id for project in unreachable]
+                    )
+                except Exception as e:
+                    # Left running, to be terminated on a later tick
+                    print(f"Failed to terminate unreachable instances: {e}")
+                    unreachable = []
+            cls.set_provisioning_state(running, "running")
+            cls.set_provisioning_state(
+                missing, "failed", "The instance was never described by EC2."
+            )
+            cls.set_provisioning_state(
+                stopped, "failed", "The instance stopped or no longer exists."
+            )
+            cls.set_provisioning_state(
+                unreachable,
+                "failed",
+                "The instance did not accept SSH connections within "
+                f"{PROVISIONING_REACHABLE_TIMEOUT} seconds.",
+            )
+            moved["running"] += len(running)
+            moved["failed"] += len(missing) + len(stopped) + len(unreachable)
+
+        with ThreadPoolExecutor(max_workers=SSH_PROBE_CONCURRENCY) as executor:
+            reachable = [
+                project
+                for project, ok in zip(
+                    probes,
+                    executor.map(
+                        lambda project: ssh_reachable(project.public_ip_address),
+                        probes,
+                    ),
+                )
+                if ok
+            ]
+        cls.set_provisioning_state(reachable, "reachable")
+        moved["reachable"] += len(reachable)
+
+        if any(moved.values()):
+            print(
+                "Provisioning: "
+                + ", ".join(f"{count} {state}" for state, count in moved.items())
+            )
+        return moved
+
     def get_public_key(self, user):
 
         if self.public_ip_address is None:
@@ -169,36 +452,143 @@ class DjangoProject(models.Model):
 
         return public_key
 
-    def deploy_all_plays(self):
+    def deploy_all_plays(self, composite=False):
         """
         Deploys the Django project to the EC2 instance.
+        :param composite: Run all the plays in a single ansible-runner invocation.
+        :return: A dictionary mapping each play run to its status on the instance;
+            plays after a failed one are not run.
         """
+        if composite:
+            results = AnsiblePlay.run_composite(
+                self.public_ip_address, extravars=self.extravars()
+            )
+            return {
+                name: play_results[self.public_ip_address]
+                for name, play_results in results.items()
+            }
+        results = {}
         for play in AnsiblePlay.objects.filter(enabled=True).order_by("order"):
-            self.deploy_play(
+            runner = self.deploy_play(
                 self.public_ip_address, play.name, extravars=self.extravars()
             )
+            status = host_results(runner, [self.public_ip_address])
+            results[play.name] = status[self.public_ip_address]
+            if results[play.name] != "successful":
+                print(f"Play {play.name} failed: {results[play.name]}")
+                break
+        return results
+
+    def wait_for_bootstrap(self, timeout=BOOTSTRAP_WAIT_SECONDS):
+        """
+        Waits over SSH until cloud-init has finished booting the instance.
+        :return: True if cloud-init reports no errors and wrote the readiness
+            marker, False if it failed or the timeout passed first.
+        """
+        ssh = paramiko.SSHClient()
+        ssh.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+        ssh.connect(
+            self.public_ip_address,
+            username="ubuntu",
+            key_filename=os.getenv("PRIVATE_KEY_FILE_PATH"),
+        )
+        try:
+            # Any module failing, e.g. packages or users before the boot
+            # commands, makes cloud-init status exit non-zero
+            _, stdout, _ = ssh.exec_command(
+                f"timeout {int(timeout)} cloud-init status --wait; "
+                f"echo exit=$?; test -e {READY_MARKER} && echo ready"
+            )
+            status = stdout.read().decode().split()
+        finally:
+            ssh.close()
+        if "exit=124" in status:
+            print("Timed out waiting for the bootstrap.")
+            return False
+        if "exit=0" not in status or "ready" not in status:
+            print(f"Bootstrap failed: {' '.join(status)}")
+            return False
+        return True
 
-    def deploy_play(self, instance_ip_address, play_name, extravars):
+    @classmethod
+    def deploy_fleet(cls, projects, forks=None, strategy=None, composite=False):
+        """
+        Deploys many projects, running each enabled play once across all of their
+        instances with each project's variables as host variables.
+        Projects sharing an instance are deployed in successive rounds, so that
+        no two of them run against the same machine at once.
+        :param projects: The projects to deploy; those without an instance are
+            left out.
+        :param forks: Optional number of hosts worked on in parallel.
+        :param strategy: Optional Ansible strategy, e.g. "free".
+        :param composite: Run all the plays in a single ansible-runner invocation.
+        :return: A dictionary mapping each play run to the status of each project,
+            by inventory host name "project-<pk>".
+        """
+        instances = {}
+        for project in projects:
+            if not project.public_ip_address:
+                print(f"No instance available for {project}.")
+                continue
+            instances.setdefault(project.public_ip_address, []).append(project)
+
+        # Round i deploys the i-th project of each instance
+        rounds = {}
+        for instance_projects in instances.values():
+            for i, project in enumerate(instance_projects):
+                # Projects sharing an instance are separate hosts with their own
+                # variables
+                rounds.setdefault(i, {})[f"project-{project.pk}"] = {
+                    "ansible_host": project.public_ip_address,
+                    **project.extravars(),
+                }
+
+        results = {}
+        for i, hosts in rounds.items():
+            if len(rounds) > 1:
+                print(f"Deploying round {i + 1} of {len(rounds)}")
+            round_results = AnsiblePlay.run_all_enabled_plays(
+                hosts, forks=forks, strategy=strategy, composite=composite
+            )
+            for play_name, play_results in round_results.items():
+                results.setdefault(play_name, {}).update(play_results)
+        return results
+
+    def deploy_play(self, instance_ip_address, play_name, extravars, tags=None):
         """
         Runs a single play by name.
         :param play_name: The name of the play to run.
         :param extravars: A dictionary of extra variables to pass to the playbook.
+        :param tags: Optional comma-separated tags; only tasks tagged with one run.
         """
 
         play = AnsiblePlay.objects.get(name=play_name)
-        runner = play.run_play(instance_ip_address, extravars=extravars)
+        runner = play.run_play(instance_ip_address, extravars=extravars, tags=tags)
         return runner
 
+    def golden_image(self):
+        """
+        :return: The GoldenImage the project's instance booted from, or None if it
+            booted from any other AMI.
+        """
+        if not self.instance_id:
+            return None
+        instance = EC2Instance.describe_instances(
+            self.aws_region, [self.instance_id]
+        ).get(self.instance_id)
+        if instance is None:
+            return None
+        return GoldenImage.objects.filter(
+            ami_id=instance["image_id"], status="available"
+        ).first()
+
     def deploy_1(self):
-        # 1. create a new EC2 instance if not already created
-        if not self.public_ip_address:
-            instance = self.ec2_instance.create_instance(self.aws_region)
-            print(f"Instance created: {instance}")
-            # save instance details
-            self.instance_id = instance["instance_id"] if instance else None
-            self.public_ip_address = instance["public_ip"] if instance else None
-            self.public_dns_name = instance["public_dns"] if instance else None
-            self.save()
+        # 1. request a new EC2 instance if not already created; a Celery worker
+        # launches it and the provisioning poller tracks it until it is reachable
+        if not self.public_ip_address and self.request_provisioning():
+            print(f"Instance requested for {self}; run deploy_2 once it is reachable")
+        elif not self.public_ip_address:
+            print(f"Instance provisioning state: {self.provisioning_state}")
         else:
             print("**** Instance already exists ****")
             print(f"Instance ID: {self.instance_id}")
@@ -217,6 +607,16 @@ class DjangoProject(models.Model):
             print("No instance available.")
             return
 
+        # Without the poller, e.g. after launch_fleet, a running instance is
+        # probed here rather than waited for
+        if self.provisioning_state == "running" and ssh_reachable(
+            self.public_ip_address
+        ):
+            self.set_provisioning_state([self], "reachable")
+        if self.provisioning_state and self.provisioning_state != "reachable":
+            print(f"Instance not reachable yet: {self.provisioning_state}")
+            return
+
         if not self.git_repo.exists():
             print("No repository available.")
             return
@@ -224,11 +624,27 @@ class DjangoProject(models.Model):
         extra_vars = self.extravars()
         print(extra_vars)
         plays = AnsiblePlay.objects.filter(enabled=True).order_by("order")
-        plays_basic = [play.name for play in plays if play.order < 5]
-        print(plays_basic)
-        # 3. deploy the basic plays
+        plays_basic = [play for play in plays if play.order < 5]
+        print([play.name for play in plays_basic])
+        # 3. deploy the basic plays; only the host-specific tasks are left of the
+        # plays baked into a golden AMI or run by cloud-init while booting
+        golden_image = self.golden_image()
+        if golden_image and not golden_image.is_current():
+            # Packages or baked plays changed since the image was baked
+            print(f"Golden AMI {golden_image.ami_id} is stale; running full plays")
+            golden_image = None
+        elif golden_image:
+            print(f"Instance booted from golden AMI {golden_image.ami_id}")
+        # The instance's own launch, not the template's current setting
+        bootstrapped = self.cloud_init
+        if bootstrapped and not self.wait_for_bootstrap():
+            return
         for play in plays_basic:
-            self.deploy_play(self.public_ip_address, play, extra_vars)
+            covered = (golden_image and play.bake) or (
+                bootstrapped and play.yml_file in CLOUD_INIT_PLAYBOOKS
+            )
+            tags = "host" if covered else None
+            self.deploy_play(self.public_ip_address, play.name, extra_vars, tags=tags)
 
         finmachines_deploy_key = self.get_public_key("finmachines")
         print(f"FinMachines Deploy Key: {finmachines_deploy_key}")
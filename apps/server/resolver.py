@@ -0,0 +1,97 @@
+import os
+from django.core.cache import cache
+from apps.server.models.ec2_models import ec2_client
+
+# Seconds a resolved AMI or security group is reused before AWS is asked again
+RESOLVER_CACHE_TIMEOUT = int(os.getenv("EC2_RESOLVER_CACHE_TIMEOUT", "86400"))
+
+# Canonical's AWS account ID
+CANONICAL_OWNER_ID = "099720109477"
+
+# Image name patterns of the Ubuntu releases, by release
+UBUNTU_IMAGE_NAMES = {
+    "22.04": "ubuntu/images/hvm-ssd/ubuntu-jammy-22.04-amd64-server-*",
+    "24.04": "ubuntu/images/hvm-ssd-gp3/ubuntu-noble-24.04-amd64-server-*",
+}
+
+
+def cached(key, resolve, refresh=False):
+    """
+    Returns the cached value for key, calling resolve to fill the cache when it is
+    missing, expired or refresh is set. None is never cached, so a failed lookup
+    is retried on the next call.
+    """
+    value = None if refresh else cache.get(key)
+    if value is None:
+        value = resolve()
+        if value is not None:
+            cache.set(key, value, RESOLVER_CACHE_TIMEOUT)
+    return value
+
+
+def latest_ami(region, release="22.04", refresh=False):
+    """
+    Resolves the latest Canonical Ubuntu AMI of a release in a region.
+    :param region: The AWS region.
+    :param release: An Ubuntu release in UBUNTU_IMAGE_NAMES, e.g. "24.04".
+    :param refresh: Ask AWS even if the AMI is cached.
+    :return: The AMI id, or None if there is none or the release is unknown.
+    """
+    if release not in UBUNTU_IMAGE_NAMES:
+        print(f"Unknown Ubuntu release: {release}")
+        return None
+
+    def resolve():
+        images = ec2_client(region).describe_images(
+            Filters=[
+                {"Name": "name", "Values": [UBUNTU_IMAGE_NAMES[release]]},
+                {"Name": "state", "Values": ["available"]},
+            ],
+            Owners=[CANONICAL_OWNER_ID],
+        )["Images"]
+        if not images:
+            print(f"No Ubuntu {release} AMI found in {region}.")
+            return None
+        return max(images, key=lambda image: image["CreationDate"])["ImageId"]
+
+    return cached(f"server:ami:{region}:{release}", resolve, refresh)
+
+
+def default_security_group(region, vpc_id=None, refresh=False):
+    """
+    Resolves the default security group of a VPC.
+    :param region: The AWS region.
+    :param vpc_id: The VPC; defaults to the default VPC of the region.
+    :param refresh: Ask AWS even if the security group is cached.
+    :return: The security group id, or None if there is none.
+    """
+
+    def resolve():
+        client = ec2_client(region)
+        try:
+            vpc = vpc_id
+            if vpc is None:
+                vpcs = client.describe_vpcs(
+                    Filters=[{"Name": "isDefault", "Values": ["true"]}]
+                )["Vpcs"]
+                if not vpcs:
+                    print(f"No default VPC in {region}.")
+                    return None
+                vpc = vpcs[0]["VpcId"]
+            groups = client.describe_security_groups(
+                Filters=[
+                    {"Name": "group-name", "Values": ["default"]},
+                    {"Name": "vpc-id", "Values": [vpc]},
+                ]
+            )["SecurityGroups"]
+        except Exception as e:
+            print(f"Failed to retrieve the default security group: {str(e)}")
+            return None
+        if not groups:
+            return None
+        print(f"Default security group ID: {groups[0]['GroupId']}")
+        return groups[0]["GroupId"]
+
+    return cached(
+        f"server:security_group:{region}:{vpc_id or 'default'}", resolve, refresh
+    )
@@ -1,6 +1,7 @@
 import os
-import boto3
 from dotenv import load_dotenv
+from apps.aws.clients import get_client
+from apps.server.resolver import default_security_group, latest_ami
 from .models import EC2InstanceConfiguration
 
 # Load environment variables from .env file
@@ -8,66 +9,40 @@ load_dotenv()
 
 
 class EC2InstanceManager:
+    # Ubuntu release of the instances created
+    ubuntu_release = "22.04"
+
     def __init__(self, config: EC2InstanceConfiguration):
         self.config = config
-        self.ec2_client = boto3.client(
+        self.ec2_client = get_client(
             "ec2",
             aws_access_key_id=os.getenv("AWS_ACCESS_KEY_ID"),
             aws_secret_access_key=os.getenv("AWS_SECRET_ACCESS_KEY"),
             region_name=self.config.region,  # Use the region specified in the model
         )
+        # Both are cached by the resolver, so this makes no AWS calls once warm
         self.ami_id = self.get_ami_id()
         self.security_group_ids = self.get_security_group_ids()
 
-    def get_ami_id(self):
-        # Search for the latest Ubuntu 22.04 LTS AMI
-        filters = [
-            {
-                "Name": "name",
-                "Values": ["ubuntu/images/hvm-ssd/ubuntu-jammy-22.04-amd64-server-*"],
-            },
-            {
-                "Name": "owner-id",
-                "Values": ["099720109477"],
-            },  # Canonical's AWS account ID
-            {"Name": "state", "Values": ["available"]},
-        ]
-
-        response = self.ec2_client.describe_images(
-            Filters=filters,
-            Owners=["099720109477"],  # Canonical's AWS account ID
-            MaxResults=100,  # Fetch up to 100 results (adjust if needed)
-        )
-
-        images = response.get("Images", [])
-        if images:
-            # Sort the images by CreationDate to get the latest one
-            latest_image = sorted(
-                images, key=lambda x: x["CreationDate"], reverse=True
-            )[0]
-            return latest_image["ImageId"]
+    def get_ami_id(self, refresh=False):
+        return latest_ami(self.config.region, self.ubuntu_release, refresh=refresh)
 
-        print("No Ubuntu 22.04 LTS AMI found.")
-        return None
+    def get_default_security_group(self, refresh=False):
+        return default_security_group(self.config.region, refresh=refresh)
 
-    def get_default_security_group(self):
-        try:
-            response = self.ec2_client.describe_security_groups(
-                Filters=[{"Name": "group-name", "Values": ["default"]}]
-            )
-            default_sg = response["SecurityGroups"][0]["GroupId"]
-            print(f"Default security group ID: {default_sg}")
-            return default_sg
-        except Exception as e:
-            print(f"Failed to retrieve the default security group: {str(e)}")
-            return None
-
-    def get_security_group_ids(self):
+    def get_security_group_ids(self, refresh=False):
         security_group_list = self.config.get_security_group_list()
         if not security_group_list:
-            return [self.get_default_security_group()]
+            return [self.get_default_security_group(refresh=refresh)]
         return security_group_list
 
+    def refresh(self):
+        """
+        Resolves the AMI and default security group again, bypassing the cache.
+        """
+        self.ami_id = self.get_ami_id(refresh=True)
+        self.security_group_ids = self.get_security_group_ids(refresh=True)
+
     def create_instance(self):
         if not self.ami_id:
             print("No AMI ID available, aborting instance creation.")
@@ -0,0 +1,22 @@
+from celery import shared_task
+from apps.server.models.project_models import DjangoProject
+
+
+@shared_task
+def launch_requested_projects(project_ids=None):
+    """
+    Launches the instances of requested projects.
+    :param project_ids: Optional ids of the projects to launch; defaults to every
+        requested project.
+    :return: The number of instances launched.
+    """
+    return len(DjangoProject.launch_requested(project_ids))
+
+
+@shared_task
+def poll_provisioning():
+    """
+    Advances every project being provisioned; scheduled by Celery beat.
+    :return: The number of projects moved into each provisioning state.
+    """
+    return DjangoProject.poll_provisioning()
@@ -0,0 +1,285 @@
+from datetime import timedelta
+from unittest import mock
+from django.test import TestCase
+from django.utils import timezone
+import yaml
+from apps.server.cloud_init import READY_MARKER, render_user_data
+from apps.server.models.ansible_models import AnsiblePlay, populate_plays
+from apps.server.models.ec2_models import EC2Instance, GoldenImage, bake_extravars
+from apps.server.models.git_models import GitHubRepository
+from apps.server.models.project_models import (
+    PROVISIONING_MISSING_GRACE,
+    PROVISIONING_REACHABLE_TIMEOUT,
+    DjangoProject,
+    DjangoService,
+)
+from apps.server.models.static_models import Dotfile, SudoUser, UbuntuPackage
+
+
+class RenderUserDataTests(TestCase):
+    def render(self, **kwargs):
+        user_data = render_user_data(**kwargs)
+        self.assertTrue(user_data.startswith("#cloud-config\n"))
+        return yaml.safe_load(user_data)
+
+    def test_renders_packages_users_and_dotfiles(self):
+        config = self.render(
+            packages=["git", "apache2"],
+            users=[
+                {
+                    "login": "alice",
+                    "sudo": True,
+                    "github": "alice-gh",
+                    "create_ed25519": True,
+                    "key": "https://example.com/alice.pub",
+                },
+                {"login": "bob", "sudo": False},
+            ],
+            dotfiles=["bashrc"],
+        )
+
+        self.assertEqual(config["packages"], ["git", "apache2"])
+        self.assertEqual(
+            config["users"],
+            [
+                "default",
+                {
+                    "name": "alice",
+                    "shell": "/bin/bash",
+                    "groups": "sudo",
+                    "ssh_import_id": ["gh:alice-gh"],
+                },
+                {"name": "bob", "shell": "/bin/bash"},
+            ],
+        )
+        paths = [entry["path"] for entry in config["write_files"]]
+        self.assertIn("/etc/sudoers.d/90-sudo-nopasswd", paths)
+        self.assertIn("/etc/letsencrypt/options-ssl-apache.conf", paths)
+
+        runcmd = config["runcmd"]
+        # A failing command stops the script before the readiness marker
+        self.assertEqual(runcmd[0], "set -e")
+        self.assertIn("/root/.bashrc", runcmd[1])
+        # SSH keys are left to the plays' "host" tasks
+        self.assertFalse(any("ssh-keygen" in command for command in runcmd))
+        self.assertTrue(
+            any("https://example.com/alice.pub" in command for command in runcmd)
+        )
+        # Existing dotfiles of users are kept
+        self.assertTrue(
+            any(
+                command.startswith("test -e /home/bob/.bashrc ||") for command in runcmd
+            )
+        )
+        # The readiness marker is written once everything else has run
+        self.assertIn(READY_MARKER, runcmd[-1])
+
+    def test_quotes_shell_arguments(self):
+        config = self.render(
+            packages=[], users=[{"login": "eve; rm -rf /", "key": "x"}], dotfiles=[]
+        )
+        self.assertFalse(
+            any("-o eve; rm -rf /" in command for command in config["runcmd"])
+        )
+        self.assertTrue(
+            any("'eve; rm -rf /'" in command for command in config["runcmd"])
+        )
+
+    def test_defaults_to_stored_configuration(self):
+        UbuntuPackage.objects.create(name="htop")
+        Dotfile.objects.create(file="vimrc")
+        SudoUser.objects.create(login="carol")
+
+        config = self.render()
+
+        self.assertEqual(config["packages"], ["htop"])
+        self.assertEqual(
+            [user["name"] for user in config["users"][1:]],
+            ["carol"],
+        )
+        self.assertIn("/root/.vimrc", config["runcmd"][1])
+
+
+class PollProvisioningTests(TestCase):
+    def setUp(self):
+        self.service = DjangoService.objects.create(service="piper")
+        self.template = EC2Instance.objects.create(
+            name="web", key_name="key", server_admin="a@b.c", cert_email="a@b.c"
+        )
+        self.repo = GitHubRepository.objects.create(
+            name="piper",
+            template_owner="quxdev",
+            template_repo_name="template",
+            repo_owner="quxdev",
+        )
+
+    def project(self, state, seconds_ago, public_ip=None):
+        return DjangoProject.objects.create(
+            service=self.service,
+            ec2_instance=self.template,
+            git_repo=self.repo,
+            instance_id=f"i-{DjangoProject.objects.count():017x}",
+            public_ip_address=public_ip,
+            provisioning_state=state,
+            provisioning_updated_at=timezone.now() - timedelta(seconds=seconds_ago),
+        )
+
+    def poll(self, instances, reachable=False):
+        with mock.patch.object(
+            EC2Instance, "describe_instances", return_value=instances
+        ), mock.patch.object(
+            EC2Instance, "terminate_instances"
+        ) as terminate, mock.patch(
+            "apps.server.models.project_models.ssh_reachable", return_value=reachable
+        ):
+            moved = DjangoProject.poll_provisioning()
+        return moved, terminate
+
+    def test_missing_instance_stays_pending_within_grace(self):
+        fresh = self.project("pending", 10)
+        stale = self.project("pending", PROVISIONING_MISSING_GRACE + 10)
+
+        moved, _ = self.poll({})
+
+        fresh.refresh_from_db()
+        stale.refresh_from_db()
+        self.assertEqual(fresh.provisioning_state, "pending")
+        self.assertEqual(stale.provisioning_state, "failed")
+        self.assertEqual(moved["failed"], 1)
+
+    def test_unreachable_instance_fails_after_timeout(self):
+        probing = self.project("running", 10, public_ip="1.2.3.4")
+        no_ip = self.project("running", PROVISIONING_REACHABLE_TIMEOUT + 10)
+        running = {"state": "running", "public_ip": None, "public_dns": None}
+
+        moved, terminate = self.poll(
+            {probing.instance_id: running, no_ip.instance_id: running}
+        )
+
+        probing.refresh_from_db()
+        no_ip.refresh_from_db()
+        self.assertEqual(probing.provisioning_state, "running")
+        self.assertEqual(no_ip.provisioning_state, "failed")
+        terminate.assert_called_once_with("us-east-1", [no_ip.instance_id])
+        self.assertEqual(moved["failed"], 1)
+
+    def test_reachable_instance(self):
+        project = self.project("running", 10, public_ip="1.2.3.4")
+
+        moved, _ = self.poll(
+            {
+                project.instance_id: {
+                    "state": "running",
+                    "public_ip": "1.2.3.4",
+                    "public_dns": None,
+                }
+            },
+            reachable=True,
+        )
+
+        project.refresh_from_db()
+        self.assertEqual(project.provisioning_state, "reachable")
+        self.assertEqual(moved["reachable"], 1)
+
+
+class DeployFleetTests(TestCase):
+    def setUp(self):
+        service = DjangoService.objects.create(service="piper")
+        template = EC2Instance.objects.create(
+            name="web", key_name="key", server_admin="a@b.c", cert_email="a@b.c"
+        )
+        repo = GitHubRepository.objects.create(
+            name="piper",
+            template_owner="quxdev",
+            template_repo_name="template",
+            repo_owner="quxdev",
+        )
+        self.projects = [
+            DjangoProject.objects.create(
+                service=service,
+                ec2_instance=template,
+                git_repo=repo,
+                public_ip_address=public_ip,
+            )
+            for public_ip in ("1.2.3.4", "1.2.3.4", "5.6.7.8")
+        ]
+
+    def test_projects_sharing_an_instance_run_in_turn(self):
+        def run_all_enabled_plays(hosts, **kwargs):
+            return {"ubuntu": {host: "successful" for host in hosts}}
+
+        with mock.patch.object(
+            DjangoProject, "extravars", return_value={}
+        ), mock.patch.object(
+            AnsiblePlay, "run_all_enabled_plays", side_effect=run_all_enabled_plays
+        ) as run:
+            results = DjangoProject.deploy_fleet(self.projects)
+
+        rounds = [call.args[0] for call in run.call_args_list]
+        self.assertEqual(len(rounds), 2)
+        for hosts in rounds:
+            addresses = [host["ansible_host"] for host in hosts.values()]
+            self.assertEqual(len(addresses), len(set(addresses)))
+        self.assertEqual(
+            results,
+            {
+                "ubuntu": {
+                    f"project-{project.pk}": "successful" for project in self.projects
+                }
+            },
+        )
+
+    def test_deploy_all_plays_returns_the_status_of_each_play(self):
+        populate_plays()
+        project = self.projects[2]
+        plays = list(
+            AnsiblePlay.objects.filter(enabled=True)
+            .order_by("order")
+            .values_list("name", flat=True)
+        )
+        runners = [
+            mock.Mock(stats={"processed": {"5.6.7.8": 1}}),
+            mock.Mock(stats={"processed": {"5.6.7.8": 1}, "failures": {"5.6.7.8": 1}}),
+        ]
+
+        with mock.patch.object(
+            DjangoProject, "extravars", return_value={}
+        ), mock.patch.object(DjangoProject, "deploy_play", side_effect=runners):
+            results = project.deploy_all_plays()
+
+        # Plays after the failed one are not run
+        self.assertEqual(results, {plays[0]: "successful", plays[1]: "failed"})
+
+
+class LaunchImageTests(TestCase):
+    def setUp(self):
+        populate_plays()
+        self.template = EC2Instance.objects.create(
+            name="web",
+            key_name="key",
+            server_admin="a@b.c",
+            cert_email="a@b.c",
+            ami_id="ami-stock",
+        )
+
+    def golden_image(self, ami_id, bake_hash, region="us-east-1"):
+        return GoldenImage.objects.create(
+            region=region,
+            ami_source=self.template.ami_source,
+            bake_hash=bake_hash,
+            base_ami_id="ami-stock",
+            ami_id=ami_id,
+            status="available",
+        )
+
+    def test_uses_current_golden_image_of_the_region(self):
+        self.golden_image("ami-golden", AnsiblePlay.bake_hash(bake_extravars()))
+
+        self.assertEqual(self.template.launch_image("us-east-1"), "ami-golden")
+        # Other regions keep the template's AMI
+        self.assertEqual(self.template.launch_image("eu-west-1"), "ami-stock")
+
+    def test_ignores_stale_golden_images(self):
+        self.golden_image("ami-stale", "0" * 64)
+
+        self.assertEqual(self.template.launch_image("us-east-1"), "ami-stock")
@@ -11,6 +11,18 @@ app = Celery("project")
 app.config_from_object("django.conf:settings")
 app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
 
+# Seconds between two ticks of the provisioning poller
+PROVISIONING_POLL_INTERVAL = float(os.getenv("PROVISIONING_POLL_INTERVAL", "15"))
+
+app.conf.beat_schedule = {
+    "poll-provisioning": {
+        "task": "apps.server.tasks.poll_provisioning",
+        "schedule": PROVISIONING_POLL_INTERVAL,
+        # A tick still queued when the next one is due is dropped
+        "options": {"expires": PROVISIONING_POLL_INTERVAL},
+    },
+}
+
 
 @app.task(bind=True)
 def debug_task(self):